@@ -0,0 +1,117 @@
+import sys
+sys.dont_write_bytecode = True
+
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+from core.agent.protocol import (
+    AgentConnection,
+    close_listeners,
+    open_agent_connection,
+    start_listeners,
+    unix_sockets_supported,
+)
+
+# Замер задержки "чанк туда-обратно" между UI и агентом: TCP 127.0.0.1 против Unix-сокета.
+# Сервер — эхо поверх того же AgentConnection, что и у агента, чанки — типичного размера дельты.
+
+
+async def _echo(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    conn = AgentConnection(reader, writer)
+    try:
+        while True:
+            msg = await conn.recv()
+            if msg is None:
+                break
+            if msg.get("action") == "hello":
+                await conn.send({"type": "hello", "framing": "frames", "codec": "json"})
+                conn.use_frames("json")
+                continue
+            await conn.send({"type": "chunk", "id": msg.get("id"), "chunk": msg.get("chunk")})
+    finally:
+        await conn.close()
+
+
+def _pct(values, p: float) -> float:
+    values = sorted(values)
+    k = min(int(round(p / 100.0 * (len(values) - 1))), len(values) - 1)
+    return values[k]
+
+
+async def _run_one(host: str, port: int, unix_path, n: int, chunk_size: int, framing: str) -> dict:
+    conn = await open_agent_connection(host, port, unix_path=unix_path, timeout_sec=5)
+    try:
+        if framing == "frames":
+            await conn.send({"action": "hello", "framing": ["json"]})
+            await conn.recv()
+            conn.use_frames("json")
+
+        chunk = "ж" * (chunk_size // 2)
+
+        # прогрев
+        for i in range(100):
+            await conn.send({"id": str(i), "chunk": chunk})
+            await conn.recv()
+
+        rtts = []
+        t_all = time.perf_counter()
+        for i in range(n):
+            t0 = time.perf_counter()
+            await conn.send({"id": str(i), "chunk": chunk})
+            await conn.recv()
+            rtts.append((time.perf_counter() - t0) * 1e6)
+        total = time.perf_counter() - t_all
+    finally:
+        await conn.close()
+
+    return {
+        "transport": conn.transport,
+        "p50_us": statistics.median(rtts),
+        "p95_us": _pct(rtts, 95),
+        "p99_us": _pct(rtts, 99),
+        "msg_per_sec": n / total if total > 0 else 0.0,
+    }
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description="TCP vs Unix socket: chunk round-trip")
+    parser.add_argument("--n", type=int, default=20000, help="число чанков")
+    parser.add_argument("--chunk-size", type=int, default=64, help="размер чанка в байтах")
+    parser.add_argument("--framing", choices=("lines", "frames"), default="frames")
+    args = parser.parse_args()
+
+    if not unix_sockets_supported():
+        raise SystemExit("Unix-сокеты недоступны на этой ОС — сравнивать не с чем.")
+
+    unix_path = os.path.join(tempfile.mkdtemp(prefix="agent_bench_"), "agent.sock")
+    servers = await start_listeners(_echo, "127.0.0.1", 0, unix_path=unix_path)
+    port = servers[0].sockets[0].getsockname()[1]
+
+    try:
+        results = [
+            await _run_one("127.0.0.1", port, None, args.n, args.chunk_size, args.framing),
+            await _run_one("127.0.0.1", port, unix_path, args.n, args.chunk_size, args.framing),
+        ]
+        # даём эхо-обработчикам увидеть EOF и закрыться до остановки цикла
+        await asyncio.sleep(0.05)
+    finally:
+        close_listeners(servers, unix_path=unix_path)
+
+    print(f"n={args.n} chunk={args.chunk_size}B framing={args.framing}")
+    for r in results:
+        print(
+            f"{r['transport']:>5}: p50={r['p50_us']:.1f}us p95={r['p95_us']:.1f}us "
+            f"p99={r['p99_us']:.1f}us  {r['msg_per_sec']:.0f} msg/s"
+        )
+
+    tcp, uds = results
+    if uds["p50_us"] > 0:
+        print(f"UDS/TCP p50: {uds['p50_us'] / tcp['p50_us']:.2f}x")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
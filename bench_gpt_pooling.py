@@ -0,0 +1,124 @@
+import sys
+sys.dont_write_bytecode = True
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import time
+
+from aiohttp import web
+
+from core.api.gptmodel import GPTModel
+
+# TTFT GPTModel.stream_chat с общим пулом соединений и без него (новая сессия на каждый вызов).
+#
+# --target local (по умолчанию): локальный SSE-сервер в стиле /chat/completions.
+#   Стоимость нового соединения (DNS + TCP + TLS до ProxyAPI) эмулируется задержкой
+#   --connect-ms на первом запросе каждого соединения.
+# --target proxyapi: настоящие запросы к ProxyAPI (нужен PROXYAPI_KEY, тратит токены).
+
+
+def _make_local_app(connect_ms: float, chunks: int) -> web.Application:
+    seen_transports = set()
+
+    async def chat_completions(request: web.Request) -> web.StreamResponse:
+        transport = request.transport
+        if transport not in seen_transports:
+            seen_transports.add(transport)
+            await asyncio.sleep(connect_ms / 1000.0)
+
+        await request.json()
+
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await resp.prepare(request)
+        for i in range(chunks):
+            obj = {"choices": [{"delta": {"content": f"t{i} "}}]}
+            await resp.write(f"data: {json.dumps(obj)}\n\n".encode("utf-8"))
+        usage = {"choices": [], "usage": {"prompt_tokens": 10, "completion_tokens": chunks, "total_tokens": 10 + chunks}}
+        await resp.write(f"data: {json.dumps(usage)}\n\n".encode("utf-8"))
+        await resp.write(b"data: [DONE]\n\n")
+        await resp.write_eof()
+        return resp
+
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    return app
+
+
+async def _measure(gpt: GPTModel, n: int, model: str, max_tokens: int) -> dict:
+    ttfts = []
+    totals = []
+
+    await gpt.start()
+    try:
+        for _ in range(n):
+            call_stats = {}
+            t0 = time.perf_counter()
+            async for _chunk in gpt.stream_chat(
+                user_text="Скажи одно слово.",
+                max_tokens=max_tokens,
+                model=model,
+                endpoint="chat",
+                call_stats=call_stats,
+            ):
+                pass
+            totals.append((time.perf_counter() - t0) * 1000.0)
+            if call_stats.get("ttft_sec") is not None:
+                ttfts.append(call_stats["ttft_sec"] * 1000.0)
+    finally:
+        await gpt.close()
+
+    return {
+        "pooled": gpt.pooled,
+        "ttft_p50": statistics.median(ttfts) if ttfts else float("nan"),
+        "ttft_max": max(ttfts) if ttfts else float("nan"),
+        "total_p50": statistics.median(totals) if totals else float("nan"),
+        **gpt.pool_stats(),
+    }
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description="GPTModel: TTFT с пулом соединений и без")
+    parser.add_argument("--target", choices=("local", "proxyapi"), default="local")
+    parser.add_argument("--n", type=int, default=20, help="запросов на вариант")
+    parser.add_argument("--connect-ms", type=float, default=60.0, help="local: цена нового соединения")
+    parser.add_argument("--model", default="gpt-4o-mini")
+    parser.add_argument("--max-tokens", type=int, default=16)
+    args = parser.parse_args()
+
+    runner = None
+    if args.target == "local":
+        os.environ.setdefault("PROXYAPI_KEY", "local-bench")
+        runner = web.AppRunner(_make_local_app(args.connect_ms, chunks=20), access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        base_url = f"http://127.0.0.1:{port}/v1"
+    else:
+        from dotenv import load_dotenv
+        load_dotenv(override=True)
+        base_url = "https://openai.api.proxyapi.ru/v1"
+
+    try:
+        results = []
+        for pooled in (False, True):
+            gpt = GPTModel(base_url=base_url, pooled=pooled)
+            results.append(await _measure(gpt, args.n, args.model, args.max_tokens))
+    finally:
+        if runner is not None:
+            await runner.cleanup()
+
+    print(f"target={args.target} n={args.n}" + (f" connect={args.connect_ms:.0f}ms" if runner else ""))
+    for r in results:
+        name = "pooled" if r["pooled"] else "per-call"
+        print(
+            f"{name:>8}: TTFT p50={r['ttft_p50']:.1f}ms max={r['ttft_max']:.1f}ms "
+            f"total p50={r['total_p50']:.1f}ms  conn new={r['connections_created']} reused={r['connections_reused']}"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,226 @@
+import sys
+sys.dont_write_bytecode = True
+
+import argparse
+import random
+import re
+import time
+from html import unescape
+from html.parser import HTMLParser
+from typing import Any, Dict, List, Optional
+
+from core.api.pricing import PricingTableParser, parse_pricing_html, parse_pricing_row
+
+# Разбор страницы тарифов ProxyAPI: старый регексп-парсер (re.sub по всему документу,
+# findall по <tr>/<td>) против однопроходного PricingTableParser; для сравнения —
+# тот же разбор на html.parser.HTMLParser.
+#
+# Страница: сохранённая копия (--file pricing.html; сохранить: --save pricing.html, нужна сеть)
+# или синтетическая в вёрстке ProxyAPI — с инлайн-скриптами/стилями и --rows строками.
+# --no-row-close убирает </tr> (HTML это допускает): старый <tr>.*?</tr> тогда
+# сканирует документ до конца на каждой строке.
+# Потоковый вариант кормит парсер кусками по --chunk символов, как из resp.content.
+
+
+def legacy_parse(html: str) -> Dict[str, Dict[str, float]]:
+    """Копия GPTModel.get_pricing_rub_per_1m до PricingTableParser."""
+    html = re.sub(r"(?is)<script.*?>.*?</script>", " ", html)
+    html = re.sub(r"(?is)<style.*?>.*?</style>", " ", html)
+
+    def _strip_tags(s: str) -> str:
+        s = re.sub(r"(?is)<[^>]+>", " ", s)
+        s = unescape(s)
+        s = s.replace("\xa0", " ")
+        return re.sub(r"\s+", " ", s).strip()
+
+    def _parse_rub_number(s: str) -> Optional[float]:
+        m = re.search(r"([0-9][0-9\s]*([.,][0-9]+)?)\s*₽", s)
+        if not m:
+            return None
+        num = m.group(1).replace(" ", "").replace("\xa0", "").replace(",", ".")
+        try:
+            return float(num)
+        except Exception:
+            return None
+
+    pricing: Dict[str, Dict[str, float]] = {}
+    for row_html in re.findall(r"(?is)<tr\b[^>]*>.*?</tr>", html):
+        tds = re.findall(r"(?is)<td\b[^>]*>.*?</td>", row_html)
+        if len(tds) < 3:
+            continue
+        cells = [_strip_tags(td) for td in tds]
+        provider, model_id = cells[0], cells[1]
+        if not provider or not model_id:
+            continue
+        prices_blob = " | ".join(cells[2:])
+        in_price = out_price = None
+        m_in = re.search(r"Ввод\s*:\s*([^|]+)", prices_blob)
+        if m_in:
+            in_price = _parse_rub_number(m_in.group(1))
+        m_out = re.search(r"Вывод\s*:\s*([^|]+)", prices_blob)
+        if m_out:
+            out_price = _parse_rub_number(m_out.group(1))
+        if in_price is None:
+            m_in2 = re.search(r"Ввод\s*([0-9][0-9\s]*([.,][0-9]+)?)\s*₽", prices_blob)
+            if m_in2:
+                in_price = _parse_rub_number(m_in2.group(0))
+        if out_price is None:
+            m_out2 = re.search(r"Вывод\s*([0-9][0-9\s]*([.,][0-9]+)?)\s*₽", prices_blob)
+            if m_out2:
+                out_price = _parse_rub_number(m_out2.group(0))
+        if in_price is not None and out_price is not None:
+            pricing[model_id] = {"in": float(in_price), "out": float(out_price)}
+    return pricing
+
+
+class _HTMLParserTable(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.pricing: Dict[str, Dict[str, float]] = {}
+        self._skip = 0
+        self._in_row = False
+        self._cells: List[str] = []
+        self._cell: Optional[List[str]] = None
+
+    def handle_starttag(self, tag: str, attrs: Any) -> None:
+        if tag in ("script", "style"):
+            self._skip += 1
+        elif tag == "tr":
+            self._end_row()
+            self._in_row = True
+        elif tag == "td" and self._in_row:
+            self._end_cell()
+            self._cell = []
+        elif self._cell is not None:
+            self._cell.append(" ")
+
+    def handle_endtag(self, tag: str) -> None:
+        if tag in ("script", "style"):
+            self._skip = max(self._skip - 1, 0)
+        elif tag == "td":
+            self._end_cell()
+        elif tag in ("tr", "table"):
+            self._end_row()
+        elif self._cell is not None:
+            self._cell.append(" ")
+
+    def handle_data(self, data: str) -> None:
+        if self._cell is not None and not self._skip:
+            self._cell.append(data)
+
+    def _end_cell(self) -> None:
+        if self._cell is not None:
+            self._cells.append(" ".join("".join(self._cell).split()))
+            self._cell = None
+
+    def _end_row(self) -> None:
+        if self._in_row:
+            self._end_cell()
+            row = parse_pricing_row(self._cells)
+            if row is not None:
+                self.pricing[row[0]] = row[1]
+        self._in_row = False
+        self._cells = []
+
+
+def htmlparser_parse(html: str) -> Dict[str, Dict[str, float]]:
+    parser = _HTMLParserTable()
+    parser.feed(html)
+    parser.close()
+    parser._end_row()
+    return parser.pricing
+
+
+def streaming_parse(html: str, chunk: int) -> Dict[str, Dict[str, float]]:
+    parser = PricingTableParser()
+    for i in range(0, len(html), chunk):
+        parser.feed(html[i:i + chunk])
+    parser.close()
+    return parser.pricing
+
+
+def _synthetic_page(rows: int, seed: int = 1, close_rows: bool = True) -> str:
+    rnd = random.Random(seed)
+    providers = ["OpenAI", "Anthropic", "Google", "DeepSeek", "xAI"]
+
+    def rub(value: float) -> str:
+        whole = f"{int(value):,}".replace(",", "&nbsp;")
+        return f"{whole},{int(value * 100) % 100:02d}&nbsp;₽"
+
+    out = [
+        "<!DOCTYPE html><html><head><title>Тарифы</title>",
+        "<style>" + ".c{color:#333}td{padding:4px}" * 400 + "</style>",
+        "<script>window.__STATE__=" + '{"k":"<tr><td>x</td></tr>"}' * 300 + ";</script>",
+        "</head><body><div class='page'><h1>Стоимость моделей</h1>",
+    ]
+    for block in range(0, rows, 50):
+        out.append("<table class='pricing'><thead><tr><th>Провайдер</th><th>Модель</th><th>Тариф</th></tr></thead><tbody>")
+        for i in range(block, min(block + 50, rows)):
+            provider = providers[i % len(providers)]
+            price_in, price_out = rnd.uniform(5, 3000), rnd.uniform(20, 12000)
+            out.append(
+                f"<tr class='row'><td><span class='p'>{provider}</span></td>"
+                f"<td><code>model-{i}-{provider.lower()}</code></td>"
+                f"<td><div>Ввод: <b>{rub(price_in)}</b> за 1M токенов</div></td>"
+                f"<td><div>Вывод: <b>{rub(price_out)}</b> за 1M токенов</div></td>"
+                + ("</tr>" if close_rows else "")
+            )
+        out.append("</tbody></table><script>track('block');</script>")
+    out.append("<footer>" + "<p>Сноска &laquo;мелким шрифтом&raquo;</p>" * 200 + "</footer></div></body></html>")
+    return "".join(out)
+
+
+def _bench(name: str, func, html: str, repeat: int) -> float:
+    func(html)  # прогрев
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        func(html)
+    ms = (time.perf_counter() - t0) * 1000.0 / repeat
+    print(f"  {name:>10}: {ms:8.2f} ms/page")
+    return ms
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Тарифы ProxyAPI: регексп-парсер vs PricingTableParser")
+    parser.add_argument("--file", default=None, help="сохранённая страница pricing/list")
+    parser.add_argument("--save", default=None, help="скачать страницу и сохранить в файл (нужна сеть)")
+    parser.add_argument("--rows", type=int, default=600, help="строк в синтетической странице")
+    parser.add_argument("--no-row-close", action="store_true", help="синтетика без </tr>")
+    parser.add_argument("--chunk", type=int, default=64 * 1024, help="размер куска для потокового разбора")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    if args.save:
+        import urllib.request
+        from core.api.pricing import PRICING_URL
+
+        req = urllib.request.Request(PRICING_URL, headers={"User-Agent": "Mozilla/5.0"})
+        with urllib.request.urlopen(req, timeout=30) as resp, open(args.save, "wb") as f:
+            f.write(resp.read())
+        print(f"saved {args.save}")
+        args.file = args.file or args.save
+
+    if args.file:
+        with open(args.file, "r", encoding="utf-8", errors="replace") as f:
+            html = f.read()
+        source = args.file
+    else:
+        html = _synthetic_page(args.rows, close_rows=not args.no_row_close)
+        source = f"synthetic rows={args.rows}" + (" без </tr>" if args.no_row_close else "")
+
+    old, new = legacy_parse(html), parse_pricing_html(html)
+    streamed = streaming_parse(html, args.chunk)
+    print(f"{source}: {len(html)} chars, models legacy={len(old)} parser={len(new)} streamed={len(streamed)}")
+    if old != new or new != streamed:
+        differ: List[str] = sorted(m for m in set(old) | set(new) if old.get(m) != new.get(m))
+        print(f"  WARNING: результаты различаются ({len(differ)} моделей): {differ[:5]}")
+
+    t_old = _bench("legacy", legacy_parse, html, args.repeat)
+    _bench("htmlparser", htmlparser_parse, html, args.repeat)
+    t_new = _bench("parser", parse_pricing_html, html, args.repeat)
+    t_stream = _bench("streamed", lambda h: streaming_parse(h, args.chunk), html, args.repeat)
+    print(f"  speedup: {t_old / t_new:.2f}x (streamed {t_old / t_stream:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
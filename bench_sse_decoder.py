@@ -0,0 +1,188 @@
+import sys
+sys.dont_write_bytecode = True
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from typing import List
+
+import aiohttp
+from aiohttp.base_protocol import BaseProtocol
+
+from core.api.sse_decoder import SSEDecoder, carries_usage, iter_sse, loads_json, orjson
+
+# Микробенчмарк разбора SSE: старый построчный цикл (decode + strip + json.loads на каждую строку)
+# против SSEDecoder (байты, iter_any-куски, JSON только для нужных событий).
+#
+# Потоки — в формате записей ProxyAPI/OpenAI (chat: delta + "usage":null в каждом чанке;
+# responses: event:-строки со служебными событиями). Свой записанный поток: --file stream.txt.
+# Куски нарезаются случайно, как из сети, и кладутся в настоящий aiohttp.StreamReader
+# (то же, что resp.content), чтобы события и строки рвались между чтениями.
+
+
+def _chat_stream(n: int) -> bytes:
+    out = [b": keepalive\n\n"]
+    role = {"id": "c1", "object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {"role": "assistant", "content": ""}}], "usage": None}
+    out.append(b"data: " + json.dumps(role).encode() + b"\n\n")
+    for i in range(n):
+        obj = {
+            "id": "c1", "object": "chat.completion.chunk", "created": 1700000000, "model": "gpt-4o-mini",
+            "choices": [{"index": 0, "delta": {"content": f"слово{i} "}, "finish_reason": None}],
+            "usage": None,
+        }
+        out.append(b"data: " + json.dumps(obj, ensure_ascii=False).encode("utf-8") + b"\n\n")
+    fin = {"id": "c1", "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}], "usage": None}
+    out.append(b"data: " + json.dumps(fin).encode() + b"\n\n")
+    usage = {"id": "c1", "choices": [], "usage": {"prompt_tokens": 120, "completion_tokens": n, "total_tokens": 120 + n}}
+    out.append(b"data: " + json.dumps(usage).encode() + b"\n\n")
+    out.append(b"data: [DONE]\n\n")
+    return b"".join(out)
+
+
+def _responses_stream(n: int) -> bytes:
+    def ev(name: str, obj: dict) -> bytes:
+        return b"event: " + name.encode() + b"\ndata: " + json.dumps(obj, ensure_ascii=False).encode("utf-8") + b"\n\n"
+
+    resp = {"id": "r1", "status": "in_progress", "model": "gpt-4o-mini", "output": [], "usage": None}
+    out = [
+        ev("response.created", {"type": "response.created", "response": resp}),
+        ev("response.in_progress", {"type": "response.in_progress", "response": resp}),
+        ev("response.output_item.added", {"type": "response.output_item.added", "item": {"type": "message"}}),
+        ev("response.content_part.added", {"type": "response.content_part.added", "part": {"type": "output_text", "text": ""}}),
+    ]
+    text = []
+    for i in range(n):
+        text.append(f"слово{i} ")
+        out.append(ev("response.output_text.delta", {"type": "response.output_text.delta", "item_id": "m1", "delta": f"слово{i} "}))
+    out.append(ev("response.output_text.done", {"type": "response.output_text.done", "text": "".join(text)}))
+    done = dict(resp, status="completed", usage={"input_tokens": 120, "output_tokens": n, "total_tokens": 120 + n})
+    out.append(ev("response.completed", {"type": "response.completed", "response": done}))
+    return b"".join(out)
+
+
+def _split(data: bytes, seed: int) -> List[bytes]:
+    rnd = random.Random(seed)
+    chunks, i = [], 0
+    while i < len(data):
+        size = rnd.randint(16, 1400)
+        chunks.append(data[i:i + size])
+        i += size
+    return chunks
+
+
+def _reader(chunks: List[bytes]) -> aiohttp.StreamReader:
+    loop = asyncio.get_running_loop()
+    # лимит больше потока: reader не пытается приостановить (несуществующий) сокет
+    reader = aiohttp.StreamReader(BaseProtocol(loop), 2 ** 30, loop=loop)
+    for chunk in chunks:
+        reader.feed_data(chunk)
+    reader.feed_eof()
+    return reader
+
+
+async def legacy_parse(chunks: List[bytes]) -> int:
+    """Копия старого цикла GPTModel.stream_chat (до SSEDecoder)."""
+    n = 0
+    async for raw_line in _reader(chunks):
+        line = raw_line.decode("utf-8", errors="ignore").strip()
+        if not line or not line.startswith("data:"):
+            continue
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            break
+        try:
+            obj = json.loads(data)
+        except Exception:
+            continue
+        if isinstance(obj.get("usage"), dict):
+            n += 1
+        choices = obj.get("choices")
+        if isinstance(choices, list) and choices:
+            delta = choices[0].get("delta")
+            if isinstance(delta, dict) and delta.get("content"):
+                n += 1
+        elif obj.get("type") == "response.output_text.delta" and obj.get("delta"):
+            n += 1
+        else:
+            resp = obj.get("response")
+            if isinstance(resp, dict) and isinstance(resp.get("usage"), dict):
+                n += 1
+    return n
+
+
+async def decoder_parse(chunks: List[bytes]) -> int:
+    """Тот же результат через SSEDecoder с пропуском ненужных событий (как в GPTModel)."""
+    n = 0
+    async for event in iter_sse(_reader(chunks)):
+        data = event.data
+        if data == b"[DONE]":
+            break
+        want_usage = carries_usage(data)
+        if event.event == "message":
+            if b'"content"' not in data and not want_usage:
+                continue
+        elif event.event != "response.output_text.delta" and not want_usage:
+            continue
+        obj = loads_json(data)
+        if want_usage and isinstance(obj.get("usage"), dict):
+            n += 1
+        choices = obj.get("choices")
+        if isinstance(choices, list) and choices:
+            delta = choices[0].get("delta")
+            if isinstance(delta, dict) and delta.get("content"):
+                n += 1
+        elif obj.get("type") == "response.output_text.delta" and obj.get("delta"):
+            n += 1
+        else:
+            resp = obj.get("response")
+            if want_usage and isinstance(resp, dict) and isinstance(resp.get("usage"), dict):
+                n += 1
+    return n
+
+
+def _count_events(data: bytes) -> int:
+    decoder = SSEDecoder()
+    decoder.feed(data)
+    decoder.close()
+    return decoder.events
+
+
+async def _bench(name: str, func, chunks: List[bytes], events: int, repeat: int) -> float:
+    await func(chunks)  # прогрев
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        await func(chunks)
+    sec = time.perf_counter() - t0
+    rate = events * repeat / sec if sec > 0 else 0.0
+    print(f"  {name:>8}: {rate:>12,.0f} events/s")
+    return rate
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description="SSE: старый построчный разбор vs SSEDecoder")
+    parser.add_argument("--deltas", type=int, default=2000, help="дельт в синтетическом потоке")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--file", default=None, help="записанный поток (сырые байты ответа)")
+    args = parser.parse_args()
+
+    if args.file:
+        with open(args.file, "rb") as f:
+            streams = {args.file: f.read()}
+    else:
+        streams = {"chat": _chat_stream(args.deltas), "responses": _responses_stream(args.deltas)}
+
+    print(f"json backend: {'orjson' if orjson is not None else 'json'}")
+    for name, data in streams.items():
+        chunks = _split(data, seed=1)
+        events = _count_events(data)
+        legacy_n, decoder_n = await legacy_parse(chunks), await decoder_parse(chunks)
+        print(f"{name}: {len(data)} bytes, {len(chunks)} chunks, {events} events (payloads legacy={legacy_n} decoder={decoder_n})")
+        old = await _bench("legacy", legacy_parse, chunks, events, args.repeat)
+        new = await _bench("decoder", decoder_parse, chunks, events, args.repeat)
+        print(f"  speedup: {new / old:.2f}x" if old > 0 else "")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,133 @@
+import sys
+sys.dont_write_bytecode = True
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from typing import Any, Dict, List
+
+from core.agent.memory_store import AgentMemoryStore
+from core.agent.session_io import SessionIO
+from core.agent.session_storage import BACKENDS
+
+# Задержки между чанками одновременных стримов, пока на диск пишется сессия в несколько МБ:
+# запись прямо в цикле событий (как раньше делал сервер) против SessionIO (пул потоков).
+#
+# Стрим — задача, которая каждые --interval мс отдаёт "чанк" и замеряет, насколько позже
+# плана она проснулась: ровно столько клиент ждал бы следующую дельту. Кэша сессий нет,
+# поэтому каждое сохранение — настоящая запись снимка (новая session_id — новый файл).
+#
+# Это и проверка: если с SessionIO худшая задержка больше --max-lag-ms (запись снова
+# попала в цикл событий), скрипт завершается с кодом 1.
+
+
+def _big_session(session_id: str, mb: float) -> Dict[str, Any]:
+    history: Dict[str, Any] = {}
+    turn_text = ("строка ответа модели с кодом и пояснениями " * 40).strip()
+    n_turns = max(int(mb * 1024 * 1024 / (len(turn_text.encode("utf-8")) * 2)), 1)
+    for i in range(1, n_turns + 1):
+        history[str(i)] = {
+            "user_text": f"вопрос {i}: {turn_text}",
+            "assistant_text": turn_text,
+            "model": "gpt-4o-mini",
+            "version": i,
+        }
+    return {
+        "session_id": session_id,
+        "title": "bench",
+        "created_at": "2026-01-01 00:00:00",
+        "updated_at": "2026-01-01 00:00:00",
+        "history": history,
+        "history_summary": "",
+        "history_summary_upto": 0,
+        "version": n_turns,
+    }
+
+
+async def _stream(interval: float, stop: asyncio.Event, gaps: List[float]) -> None:
+    loop = asyncio.get_running_loop()
+    due = loop.time() + interval
+    while not stop.is_set():
+        await asyncio.sleep(max(due - loop.time(), 0))
+        now = loop.time()
+        gaps.append((now - due) * 1000)
+        due = now + interval
+
+
+def _pct(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+async def _run(mode: str, args: argparse.Namespace, template: Dict[str, Any]) -> float:
+    tmp = tempfile.mkdtemp(prefix="bench_storage_io_")
+    store = AgentMemoryStore(base_dir=tmp, backend=args.storage, cache=None)
+    io = SessionIO(store, max_workers=args.io_threads)
+    store.prime_catalog()
+
+    stop = asyncio.Event()
+    gaps: List[float] = []
+    streams = [asyncio.create_task(_stream(args.interval / 1000, stop, gaps)) for _ in range(args.streams)]
+    await asyncio.sleep(0.2)
+    baseline = len(gaps)
+
+    save_ms: List[float] = []
+    for i in range(args.saves):
+        session = dict(template, session_id=f"big{i}")
+        t0 = time.perf_counter()
+        if mode == "loop":
+            store.save_session(session)
+        else:
+            await io.save_session(session)
+        save_ms.append((time.perf_counter() - t0) * 1000)
+        await asyncio.sleep(0.05)
+
+    stop.set()
+    await asyncio.gather(*streams)
+    io.close()
+    store.backend.close()
+
+    during = gaps[baseline:]
+    size = sum(os.path.getsize(os.path.join(tmp, n)) for n in os.listdir(tmp)) / args.saves / 1024 / 1024
+    print(
+        f"  {mode:>4}: save {sum(save_ms) / len(save_ms):7.1f} ms ({size:.1f} MB) | "
+        f"inter-chunk lag p50 {_pct(during, 0.5):6.2f} p99 {_pct(during, 0.99):7.2f} max {max(during):7.2f} ms "
+        f"({len(during)} chunks)"
+    )
+    return max(during)
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description="Запись сессий: в цикле событий vs SessionIO")
+    parser.add_argument("--mb", type=float, default=8.0, help="примерный объём сессии")
+    parser.add_argument("--saves", type=int, default=5)
+    parser.add_argument("--streams", type=int, default=8, help="одновременных стримов")
+    parser.add_argument("--interval", type=float, default=5.0, help="мс между чанками стрима")
+    parser.add_argument("--storage", choices=BACKENDS, default="json")
+    parser.add_argument("--io-threads", type=int, default=4)
+    parser.add_argument(
+        "--max-lag-ms",
+        type=float,
+        default=30.0,
+        help="допустимая худшая задержка чанка с SessionIO (0 — не проверять)",
+    )
+    args = parser.parse_args()
+
+    template = _big_session("big", args.mb)
+    print(f"{args.storage}: {len(template['history'])} turns, {args.streams} streams every {args.interval:g} ms")
+    lag = {mode: await _run(mode, args, template) for mode in ("loop", "io")}
+
+    if args.max_lag_ms > 0:
+        if lag["io"] > args.max_lag_ms:
+            raise SystemExit(
+                f"FAIL: запись сессии задерживает стримы на {lag['io']:.1f} мс (лимит {args.max_lag_ms:g} мс)"
+            )
+        print(f"OK: худшая задержка с SessionIO {lag['io']:.1f} мс <= {args.max_lag_ms:g} мс")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
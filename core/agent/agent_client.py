@@ -2,15 +2,43 @@ import asyncio
 import json, sys
 sys.dont_write_bytecode = True
 
-from typing import Any, AsyncIterator, Dict, Optional, List
+from typing import Any, AsyncIterator, Callable, Dict, Optional, List, Tuple
+
+from core.agent.protocol import AgentConnection, available_codecs, default_unix_path, open_agent_connection
 
 
 class AgentClient:
-    def __init__(self, host: str = "127.0.0.1", port: int = 8765, timeout_sec: int = 10):
+    """
+    Клиент агента поверх ОДНОГО долгоживущего соединения.
+
+    При подключении клиент договаривается с сервером о кадрах с префиксом длины
+    (см. core/agent/protocol.py); со старым сервером остаётся на JSON-строках.
+
+    Каждый запрос получает свой "id", ответы сервера раскладываются по очередям
+    этих id фоновым читателем. Поэтому ping/list_sessions/get_session можно
+    вызывать параллельно с идущим stream_chat — без новых TCP-подключений.
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 8765,
+        timeout_sec: int = 10,
+        coalesce_ms: Optional[float] = None,
+        coalesce_bytes: Optional[int] = None,
+        unix_path: Optional[str] = None,
+    ):
         self.host = host
         self.port = port
         self.timeout_sec = timeout_sec
 
+        # локальный агент: Unix-сокет (по умолчанию из AGENT_UNIX_SOCKET), TCP — запасной путь
+        self.unix_path = unix_path if unix_path is not None else default_unix_path()
+
+        # склейка чанков на сервере (None -> значения сервера по умолчанию, 0 мс -> без склейки)
+        self.coalesce_ms = coalesce_ms
+        self.coalesce_bytes = coalesce_bytes
+
         self.last_usage: Dict[str, Any] = {}
         self.last_cost_rub: Optional[float] = None
         self.last_model: Optional[str] = None
@@ -19,138 +47,380 @@ class AgentClient:
 
         self.last_message_stats: Dict[str, Any] = {}
 
-    async def ping(self) -> bool:
+        # --- постоянное соединение
+        self._conn: Optional[AgentConnection] = None
+        self._read_task: Optional[asyncio.Task] = None
+        self._connect_lock = asyncio.Lock()
+
+        self._next_id = 0
+        self._pending: Dict[str, asyncio.Queue] = {}
+        self._chunked: Dict[str, List[str]] = {}
+
+        # фоновые отправки (cancel) — держим ссылки, чтобы задачи не собрал GC
+        self._background: set = set()
+
+        # старый сервер (не знает hello): один запрос на соединение, ответы без "id".
+        # Запросы идут по одному, каждый на своём соединении; ответы без id — текущему.
+        self._legacy = False
+        self._legacy_lock = asyncio.Lock()
+        self._legacy_owner: Optional[str] = None
+
+    @property
+    def is_connected(self) -> bool:
+        return (
+            self._conn is not None
+            and not self._conn.is_closing()
+            and self._read_task is not None
+            and not self._read_task.done()
+        )
+
+    @property
+    def transport(self) -> Optional[str]:
+        """"unix" / "tcp" для текущего соединения, None — не подключены."""
+        return self._conn.transport if self._conn is not None else None
+
+    async def _open_connection(self, negotiate: bool) -> Optional[AgentConnection]:
+        """Новое соединение; None — сервер старый (hello не знает), см. _legacy."""
+        conn = await open_agent_connection(
+            self.host,
+            self.port,
+            unix_path=self.unix_path,
+            timeout_sec=self.timeout_sec,
+        )
+        if not negotiate:
+            return conn
+
         try:
-            reader, writer = await asyncio.wait_for(
-                asyncio.open_connection(self.host, self.port),
-                timeout=self.timeout_sec,
-            )
-            writer.write((json.dumps({"action": "ping"}) + "\n").encode("utf-8"))
-            await writer.drain()
+            await conn.send({"action": "hello", "framing": available_codecs()})
+            msg = await asyncio.wait_for(conn.recv(), timeout=self.timeout_sec)
+        except Exception:
+            await conn.close()
+            raise
 
-            line = await asyncio.wait_for(reader.readline(), timeout=self.timeout_sec)
+        if isinstance(msg, dict) and msg.get("type") == "hello":
+            if msg.get("framing") == "frames" and msg.get("codec") in available_codecs():
+                conn.use_frames(msg["codec"])
+            return conn
 
-            writer.close()
-            try:
-                await writer.wait_closed()
-            except Exception:
-                pass
+        # старый сервер не знает hello: он ответил ошибкой и закрыл соединение
+        await conn.close()
+        self._legacy = True
+        return None
 
-            if not line:
-                return False
+    async def _ensure_connected(self) -> None:
+        if self.is_connected or self._legacy:
+            return
 
-            data = json.loads(line.decode("utf-8", errors="replace"))
-            return data.get("type") == "pong"
-        except Exception:
-            return False
+        async with self._connect_lock:
+            if self.is_connected or self._legacy:
+                return
 
-    async def list_sessions(self) -> List[dict]:
-        reader, writer = await asyncio.open_connection(self.host, self.port)
-        writer.write((json.dumps({"action": "list_sessions"}, ensure_ascii=False) + "\n").encode("utf-8"))
-        await writer.drain()
+            conn = await self._open_connection(negotiate=True)
+            if conn is not None:
+                self._attach(conn)
 
+    def _attach(self, conn: AgentConnection) -> None:
+        self._conn = conn
+        self._read_task = asyncio.get_event_loop().create_task(self._read_loop(conn))
+
+    async def _read_loop(self, conn: AgentConnection) -> None:
+        error: BaseException = ConnectionResetError("Соединение с агентом закрыто")
         try:
-            line = await reader.readline()
-            if not line:
-                return []
-
-            msg = json.loads(line.decode("utf-8", errors="replace"))
-            if msg.get("type") == "sessions":
-                return msg.get("sessions") or []
-            return []
+            while True:
+                try:
+                    msg = await conn.recv()
+                except ValueError:
+                    continue
+
+                if msg is None:
+                    break
+                self._dispatch(msg)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            error = e
         finally:
+            self._drop_connection(conn, error)
+
+    def _dispatch(self, msg: Dict[str, Any]) -> None:
+        request_id = msg.get("id")
+        if request_id is None:
+            # старый сервер id не возвращает: ответ принадлежит единственному запросу в полёте
+            request_id = self._legacy_owner
+            if request_id is None:
+                return
+        request_id = str(request_id)
+
+        # chunked ответ (режим строк) -> собираем обратно в один payload
+        t = msg.get("type")
+        if t == "chunked_start":
+            self._chunked[request_id] = [""] * int(msg.get("chunks") or 0)
+            return
+
+        if t == "chunked_part":
+            parts = self._chunked.get(request_id)
+            i = int(msg.get("i") or 0)
+            if parts is not None and 0 <= i < len(parts):
+                parts[i] = msg.get("data") or ""
+            return
+
+        if t == "chunked_end":
+            parts = self._chunked.pop(request_id, None) or []
             try:
-                writer.close()
-                await writer.wait_closed()
+                msg = json.loads("".join(parts))
             except Exception:
-                pass
-
-    async def get_session(self, session_id: str) -> Optional[dict]:
-        # ВАЖНО: увеличиваем лимит StreamReader, чтобы readline() не падал на больших JSON-строках
-        reader, writer = await asyncio.open_connection(self.host, self.port, limit=20_000_000)
+                msg = {"type": "error", "message": "Broken chunked payload"}
 
-        writer.write(
-            (json.dumps({"action": "get_session", "session_id": session_id}, ensure_ascii=False) + "\n").encode("utf-8")
-        )
-        await writer.drain()
+        queue = self._pending.get(request_id)
+        if queue is not None:
+            queue.put_nowait(msg)
 
-        try:
-            line = await reader.readline()
-            if not line:
-                return None
+    def _drop_connection(self, conn: Optional[AgentConnection], error: BaseException) -> None:
+        if conn is not None:
+            try:
+                conn.writer.close()
+            except Exception:
+                pass
 
-            msg = json.loads(line.decode("utf-8", errors="replace"))
+        if conn is not self._conn:
+            return
 
-            # обычный короткий ответ
-            if msg.get("type") == "session":
-                return msg.get("session")
-            if msg.get("type") == "error":
-                raise RuntimeError(msg.get("message") or "Agent error")
+        self._conn = None
+        self._chunked.clear()
 
-            # chunked ответ (если сервер уже умеет)
-            if msg.get("type") == "chunked_start" and msg.get("orig_type") == "session":
-                chunks = int(msg.get("chunks") or 0)
-                parts = [""] * chunks
+        # все ждущие запросы узнают, что соединение потеряно
+        pending = self._pending
+        self._pending = {}
+        for queue in pending.values():
+            queue.put_nowait(error)
 
-                while True:
-                    line2 = await reader.readline()
-                    if not line2:
-                        break
+    async def _open_request(self, payload: Dict[str, Any]) -> Tuple[str, asyncio.Queue]:
+        await self._ensure_connected()
 
-                    m2 = json.loads(line2.decode("utf-8", errors="replace"))
-                    t = m2.get("type")
+        self._next_id += 1
+        request_id = str(self._next_id)
 
-                    if t == "chunked_part" and m2.get("orig_type") == "session":
-                        i = int(m2.get("i") or 0)
-                        data = m2.get("data") or ""
-                        if 0 <= i < chunks:
-                            parts[i] = data
-                        continue
+        queue: asyncio.Queue = asyncio.Queue()
 
-                    if t == "chunked_end" and m2.get("orig_type") == "session":
-                        break
+        if self._legacy:
+            # старый сервер: по одному запросу, каждому — новое соединение (сервер закроет его сам)
+            await self._legacy_lock.acquire()
+            try:
+                conn = await self._open_connection(negotiate=False)
+            except Exception:
+                self._legacy_lock.release()
+                raise
+            self._attach(conn)
+            self._legacy_owner = request_id
 
-                    if t == "error":
-                        raise RuntimeError(m2.get("message") or "Agent error")
+        self._pending[request_id] = queue
 
-                full_text = "".join(parts)
-                payload = json.loads(full_text)
+        data = dict(payload)
+        data["id"] = request_id
 
-                if payload.get("type") == "session":
-                    return payload.get("session")
-                if payload.get("type") == "error":
-                    raise RuntimeError(payload.get("message") or "Agent error")
-                return None
+        conn = self._conn
+        try:
+            await conn.send(data)
+        except Exception as e:
+            self._pending.pop(request_id, None)
+            self._drop_connection(conn, e)
+            self._release_legacy(request_id)
+            raise
+
+        return request_id, queue
+
+    def _close_request(self, request_id: str) -> None:
+        self._pending.pop(request_id, None)
+        self._chunked.pop(request_id, None)
+        if request_id == self._legacy_owner:
+            # закрытие соединения — это и есть отмена для старого сервера
+            self._drop_connection(self._conn, ConnectionResetError("Запрос завершён"))
+            self._release_legacy(request_id)
+
+    def _release_legacy(self, request_id: str) -> None:
+        if request_id == self._legacy_owner:
+            self._legacy_owner = None
+            self._legacy_lock.release()
+
+    async def _next_message(self, queue: asyncio.Queue, timeout: Optional[float] = None) -> Dict[str, Any]:
+        if timeout is None:
+            item = await queue.get()
+        else:
+            item = await asyncio.wait_for(queue.get(), timeout=timeout)
+
+        if isinstance(item, BaseException):
+            raise item
+        return item
+
+    async def _send_cancel(self, request_id: str) -> None:
+        conn = self._conn
+        if conn is None or conn.is_closing() or self._legacy:
+            return
+        try:
+            await conn.send({"action": "cancel", "target_id": request_id})
+        except Exception:
+            pass
+
+    def cancel(self, request_id: str) -> None:
+        """
+        Отменить запрос на сервере (стрим перестаёт тянуть токены из апстрима).
+        Не ждёт ответа — можно звать из finally/обработчика отмены.
+        """
+        task = asyncio.get_event_loop().create_task(self._send_cancel(request_id))
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def _request(self, payload: Dict[str, Any], timeout: Optional[float] = None) -> Dict[str, Any]:
+        request_id, queue = await self._open_request(payload)
+        try:
+            return await self._next_message(queue, timeout=timeout)
+        finally:
+            self._close_request(request_id)
 
-            return None
+    async def close(self) -> None:
+        task = self._read_task
+        conn = self._conn
+        self._read_task = None
 
-        finally:
+        if task is not None and not task.done():
+            task.cancel()
             try:
-                writer.close()
-                await writer.wait_closed()
-            except Exception:
+                await task
+            except BaseException:
                 pass
 
+        self._drop_connection(conn, ConnectionResetError("Клиент закрыл соединение"))
+
+        if conn is not None:
+            await conn.close()
+
+    async def ping(self) -> bool:
+        try:
+            msg = await self._request({"action": "ping"}, timeout=self.timeout_sec)
+            return msg.get("type") == "pong"
+        except Exception:
+            return False
+
+    async def list_sessions(self) -> List[dict]:
+        msg = await self._request({"action": "list_sessions"})
+        if msg.get("type") == "sessions":
+            return msg.get("sessions") or []
+        return []
+
+    async def list_sessions_delta(
+        self,
+        since_version: Optional[str] = None,
+        shard: Optional[Tuple[int, int]] = None,
+    ) -> Dict[str, Any]:
+        """
+        Изменения каталога сессий после since_version (версия из прошлого ответа, непрозрачная строка).
+        Ответ: {"version", "full", "sessions", "deleted"}; full=True — пришёл полный список,
+        локальный каталог нужно заменить целиком.
+
+        shard=(номер, всего) — только сессии этого воркера (так спрашивает супервизор).
+        """
+        request: Dict[str, Any] = {"action": "list_sessions"}
+        if since_version is not None:
+            request["since_version"] = since_version
+        if shard is not None:
+            request["shard"] = [int(shard[0]), int(shard[1])]
+
+        msg = await self._request(request)
+        if msg.get("type") != "sessions":
+            raise RuntimeError(msg.get("message") or "Agent error")
+
+        return {
+            "version": msg.get("version"),
+            # старый сервер не знает дельт: его ответ — всегда полный список
+            "full": bool(msg.get("full", True)),
+            "sessions": msg.get("sessions") or [],
+            "deleted": msg.get("deleted") or [],
+        }
+
+    async def get_session(
+        self,
+        session_id: str,
+        from_turn: Optional[int] = None,
+        limit: Optional[int] = None,
+        fields: Optional[List[str]] = None,
+        since_version: Optional[int] = None,
+    ) -> Optional[dict]:
+        """
+        Без параметров — вся сессия. С параметрами — страница: в ответе только выбранные
+        turn'ы (и поля), заголовок сессии, "version" и "page" (first_turn, has_older, ...).
+        """
+        request: Dict[str, Any] = {"action": "get_session", "session_id": session_id}
+        if from_turn is not None:
+            request["from_turn"] = int(from_turn)
+        if limit is not None:
+            request["limit"] = int(limit)
+        if fields is not None:
+            request["fields"] = list(fields)
+        if since_version is not None:
+            request["since_version"] = int(since_version)
+
+        msg = await self._request(request)
+
+        if msg.get("type") == "session":
+            return msg.get("session")
+        if msg.get("type") == "error":
+            raise RuntimeError(msg.get("message") or "Agent error")
+        return None
+
+    async def server_stats(self) -> Dict[str, Any]:
+        msg = await self._request({"action": "server_stats"}, timeout=self.timeout_sec)
+        if msg.get("type") == "server_stats":
+            return msg
+        return {}
+
+    async def model_caps(self, model: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Что агент знает о модели: {"token_param", "temperature", "stream_usage"} (None — не выяснено).
+        Без model — словарь по всем известным моделям.
+        """
+        request: Dict[str, Any] = {"action": "model_caps"}
+        if model:
+            request["model"] = model
+        msg = await self._request(request, timeout=self.timeout_sec)
+        if msg.get("type") == "model_caps":
+            return msg.get("caps") or {}
+        return {}
+
     async def reset_session(self, session_id: str) -> bool:
-        reader, writer = await asyncio.open_connection(self.host, self.port)
-        writer.write(
-            (json.dumps({"action": "reset_session", "session_id": session_id}, ensure_ascii=False) + "\n").encode("utf-8")
-        )
-        await writer.drain()
+        msg = await self._request({"action": "reset_session", "session_id": session_id})
+        return msg.get("type") == "ok"
+
+    async def subscribe(self, heartbeat_sec: float = 2.0) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Поток push-событий агента (subscribed, session_created/updated/deleted, summary_updated,
+        pricing_reloaded, server_draining, resync, heartbeat).
+
+        Если за 3 интервала heartbeat не пришло ничего — агент считается недоступным:
+        TimeoutError. Обрыв соединения — ConnectionError. Старый сервер без подписок — RuntimeError.
+        """
+        request_id, queue = await self._open_request({"action": "subscribe", "heartbeat_sec": float(heartbeat_sec)})
+        dead_after = max(float(heartbeat_sec), 0.2) * 3
 
         try:
-            line = await reader.readline()
-            if not line:
-                return False
+            while True:
+                try:
+                    msg = await self._next_message(queue, timeout=dead_after)
+                except asyncio.TimeoutError:
+                    # соединение "висит": рвём его, остальные запросы тоже получат ошибку
+                    self._drop_connection(self._conn, ConnectionResetError("Агент не присылает heartbeat"))
+                    raise
 
-            msg = json.loads(line.decode("utf-8", errors="replace"))
-            return msg.get("type") == "ok"
+                msg_type = msg.get("type")
+                if msg_type == "event":
+                    yield msg
+                elif msg_type == "subscribed":
+                    # подписка принята — агент доступен, не ждём первого heartbeat
+                    yield {"type": "event", "event": "subscribed", "worker_id": msg.get("worker_id")}
+                elif msg_type == "error":
+                    raise RuntimeError(msg.get("message") or "Agent error")
         finally:
-            try:
-                writer.close()
-                await writer.wait_closed()
-            except Exception:
-                pass
+            self._close_request(request_id)
+            self.cancel(request_id)
 
     async def stream_chat(
         self,
@@ -160,11 +430,17 @@ class AgentClient:
         max_tokens: int,
         temperature: Optional[float],
         session_id: str,
-        char_limit: int,
+        token_limit: int,
         keep_last_n: int,
         summary_model: str,
         summary_endpoint: str,
+        on_queued: Optional[Callable[[int], Any]] = None,
+        hedge: Optional[bool] = None,
     ) -> AsyncIterator[str]:
+        """
+        on_queued(position) — вызывается, если сервер поставил запрос в очередь (позиция с 1).
+        hedge — включить/выключить хеджирование TTFT для этого запроса (None — как на сервере).
+        """
         self.last_usage = {}
         self.last_cost_rub = None
         self.last_model = None
@@ -172,8 +448,6 @@ class AgentClient:
         self.last_title = None
         self.last_message_stats = {}
 
-        reader, writer = await asyncio.open_connection(self.host, self.port)
-
         request = {
             "action": "stream_chat",
             "session_id": session_id,
@@ -183,23 +457,26 @@ class AgentClient:
             "max_tokens": int(max_tokens),
             "temperature": temperature,
 
-            # NEW: параметры контроля длины и суммаризации
-            "char_limit": int(char_limit),
+            # NEW: параметры контроля длины и суммаризации (порог — в токенах)
+            "token_limit": int(token_limit),
             "keep_last_n": int(keep_last_n),
             "summary_model": str(summary_model or "").strip(),
             "summary_endpoint": str(summary_endpoint or "chat"),
         }
 
-        writer.write((json.dumps(request, ensure_ascii=False) + "\n").encode("utf-8"))
-        await writer.drain()
+        if self.coalesce_ms is not None:
+            request["coalesce_ms"] = float(self.coalesce_ms)
+        if self.coalesce_bytes is not None:
+            request["coalesce_bytes"] = int(self.coalesce_bytes)
+        if hedge is not None:
+            request["hedge"] = bool(hedge)
+
+        request_id, queue = await self._open_request(request)
+        finished = False
 
         try:
             while True:
-                line = await reader.readline()
-                if not line:
-                    break
-
-                msg = json.loads(line.decode("utf-8", errors="replace"))
+                msg = await self._next_message(queue)
                 msg_type = msg.get("type")
 
                 if msg_type == "chunk":
@@ -208,6 +485,13 @@ class AgentClient:
                         yield chunk
                     continue
 
+                if msg_type == "queued":
+                    if on_queued is not None:
+                        res = on_queued(int(msg.get("position") or 0))
+                        if asyncio.iscoroutine(res):
+                            await res
+                    continue
+
                 if msg_type == "done":
                     self.last_model = msg.get("model")
                     self.last_endpoint = msg.get("endpoint")
@@ -215,13 +499,16 @@ class AgentClient:
                     self.last_cost_rub = msg.get("cost_rub", None)
                     self.last_title = msg.get("title") or None
                     self.last_message_stats = msg.get("message_stats") or {}
+                    finished = True
                     break
 
                 if msg_type == "error":
+                    finished = True
                     raise RuntimeError(msg.get("message") or "Agent error")
         finally:
-            try:
-                writer.close()
-                await writer.wait_closed()
-            except Exception:
-                pass
\ No newline at end of file
+            self._close_request(request_id)
+
+            # потребитель бросил стрим раньше "done" (STOP, stop sequence, отмена задачи):
+            # просим сервер закрыть апстрим, чтобы не платить за оставшиеся токены
+            if not finished:
+                self.cancel(request_id)
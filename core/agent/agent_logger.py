@@ -1,8 +1,9 @@
 import os, sys
 sys.dont_write_bytecode = True
 
+import queue, threading
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import List, Optional
 
 
 class AgentFileLogger:
@@ -11,6 +12,56 @@ class AgentFileLogger:
         self.prefix = prefix
         os.makedirs(self.logs_dir, exist_ok=True)
 
+        # после start_background() строки пишет отдельный поток, write() не трогает диск
+        self._queue: Optional["queue.SimpleQueue[Optional[str]]"] = None
+        self._thread: Optional[threading.Thread] = None
+        self.write_errors = 0
+
+    def start_background(self) -> None:
+        """Писать в файл из фонового потока (для сервера: цикл событий не ждёт диск)."""
+        if self._thread is not None:
+            return
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._writer_loop, name="agent-log", daemon=True)
+        self._thread.start()
+
+    def close(self, timeout: float = 5.0) -> None:
+        """Дописать очередь и остановить фоновый поток (дальше write() снова синхронный)."""
+        thread, q = self._thread, self._queue
+        if thread is None or q is None:
+            return
+        self._thread = None
+        self._queue = None
+        q.put(None)
+        thread.join(timeout)
+
+    def _writer_loop(self) -> None:
+        q = self._queue
+        if q is None:
+            return
+        while True:
+            lines: List[str] = []
+            line = q.get()
+            # всё, что накопилось, — одной записью
+            while line is not None:
+                lines.append(line)
+                try:
+                    line = q.get_nowait()
+                except queue.Empty:
+                    break
+            if lines:
+                self._append("".join(lines))
+            if line is None:
+                return
+
+    def _append(self, text: str) -> None:
+        path = self._log_path_for_today()
+        try:
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(text)
+        except Exception:
+            self.write_errors += 1
+
     def _log_path_for_today(self) -> str:
         day = datetime.now().strftime("%Y%m%d")
         return os.path.join(self.logs_dir, f"{self.prefix}{day}.txt")
@@ -43,9 +94,8 @@ class AgentFileLogger:
             line += f" | {extra}"
         line += "\n"
 
-        path = self._log_path_for_today()
-        try:
-            with open(path, "a", encoding="utf-8") as f:
-                f.write(line)
-        except Exception:
-            pass
\ No newline at end of file
+        q = self._queue
+        if q is not None:
+            q.put(line)
+            return
+        self._append(line)
\ No newline at end of file
@@ -1,22 +1,59 @@
 import sys
 sys.dont_write_bytecode = True
 
+import argparse
 import asyncio
-import json
 import os
+import time
 import traceback
 from datetime import datetime
-from typing import Any, Dict, Optional
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
 
 from dotenv import load_dotenv
 load_dotenv(override=True)
 
 from core.api.gptmodel import GPTModel
 from core.agent.agent_logger import AgentFileLogger
+from core.agent.agent_supervisor import AgentSupervisor, session_shard
+from core.agent.chunk_coalescer import ChunkCoalescer
+from core.agent.context_packer import ContextPacker, PackedContext
+from core.agent.event_bus import EventBus
 from core.agent.memory_store import AgentMemoryStore
+from core.agent.protocol import (
+    AgentConnection,
+    ProtocolError,
+    choose_codec,
+    close_listeners,
+    default_unix_path,
+    listener_names,
+    start_listeners,
+    unix_sockets_supported,
+)
+from core.agent.request_scheduler import QueueFullError, RequestScheduler
+from core.agent.session_cache import SessionCache
+from core.agent.session_io import SessionIO
+from core.agent.session_storage import BACKENDS
+from core.agent.token_counter import TokenCounter, context_window
+
+# ответ на конкретный запрос клиента (сам проставляет "id" запроса)
+Reply = Callable[[Dict[str, Any]], Awaitable[None]]
 
 
 class LLMAgentServer:
+    # интервал heartbeat подписки на события (клиент может попросить свой)
+    HEARTBEAT_SEC = 2.0
+
+    # повтор сверки тарифов после сетевой ошибки
+    PRICING_RETRY_SEC = 300.0
+
+    # порог суммаризации в токенах, если клиент не прислал свой
+    DEFAULT_TOKEN_LIMIT = 4000
+
+    # старый клиент шлёт порог в символах (char_limit): переводим грубо, ~3 символа на токен
+    LEGACY_CHARS_PER_TOKEN = 3
+
+    SUMMARY_PREFIX = "History summary (compressed context):\n"
+
     def __init__(
         self,
         host: str = "127.0.0.1",
@@ -24,30 +61,185 @@ class LLMAgentServer:
         api_key_env: str = "PROXYAPI_KEY",
         base_url: str = "https://openai.api.proxyapi.ru/v1",
         timeout_sec: int = 60,
+        coalesce_ms: float = 30.0,
+        coalesce_bytes: int = 2048,
+        max_concurrent_streams: int = 4,
+        max_queue: int = 32,
+        worker_id: Optional[int] = None,
+        unix_path: Optional[str] = None,
+        hedge: Optional[bool] = None,
+        pricing_refresh_sec: Optional[float] = None,
+        storage: Optional[str] = None,
+        session_cache_mb: Optional[float] = None,
+        session_flush_sec: Optional[float] = None,
+        io_threads: Optional[int] = None,
     ):
         self.host = host
         self.port = port
 
+        # хеджирование TTFT (второй запрос, если первый токен запаздывает); по умолчанию из AGENT_HEDGE
+        if hedge is None:
+            hedge = (os.getenv("AGENT_HEDGE") or "").strip().lower() in ("1", "true", "yes", "on")
+        self.hedge = bool(hedge)
+        self.hedge_stats: Dict[str, Any] = {"requests": 0, "fired": 0, "hedge_won": 0, "extra_cost_rub": 0.0}
+
+        # Unix-сокет для локального UI (в дополнение к TCP); по умолчанию из AGENT_UNIX_SOCKET
+        self.unix_path = unix_path if unix_path is not None else default_unix_path()
+
+        # номер процесса-воркера в режиме супервизора (None — одиночный сервер)
+        self.worker_id = worker_id
+
+        # склейка мелких дельт в кадры для UI (по умолчанию; клиент может переопределить)
+        self.coalesce_ms = coalesce_ms
+        self.coalesce_bytes = coalesce_bytes
+
         self.base_dir = os.path.dirname(__file__)
         self.logger = AgentFileLogger(logs_dir=self.base_dir, prefix="agentlogs")
         self.logger.cleanup_old_logs(keep_days=3)
 
         self.memory_dir = os.path.join(self.base_dir, "memory")
-        self.memory_store = AgentMemoryStore(base_dir=self.memory_dir)
+        # хранилище сессий: json (по умолчанию) или sqlite; AGENT_STORAGE
+        storage = storage or (os.getenv("AGENT_STORAGE") or "").strip() or "json"
+
+        # горячие сессии в памяти (лимит по объёму, AGENT_SESSION_CACHE_MB; 0 — без кэша),
+        # изменения пишутся на диск не позже чем через session_flush_sec (AGENT_SESSION_FLUSH_SEC)
+        if session_cache_mb is None:
+            session_cache_mb = float(os.getenv("AGENT_SESSION_CACHE_MB") or 64)
+        if session_flush_sec is None:
+            session_flush_sec = float(os.getenv("AGENT_SESSION_FLUSH_SEC") or 1.0)
+        self.session_flush_sec = max(float(session_flush_sec), 0.05)
+        cache = SessionCache(max_bytes=int(session_cache_mb * 1024 * 1024)) if session_cache_mb > 0 else None
+        self.memory_store = AgentMemoryStore(base_dir=self.memory_dir, backend=storage, cache=cache)
+
+        # чтение/запись сессий — в пуле из io_threads потоков (AGENT_IO_THREADS), по сессии — по порядку
+        if io_threads is None:
+            io_threads = int(os.getenv("AGENT_IO_THREADS") or 4)
+        self.session_io = SessionIO(self.memory_store, max_workers=io_threads)
+
+        # push-события для UI (action=subscribe); каталог сессий сообщает о своих изменениях сам
+        self.events = EventBus()
+        self.memory_store.on_change = lambda event, data: self.events.publish(event, **data)
+
+        # выученные возможности моделей — рядом с памятью, общие для всех воркеров
+        self.gpt = GPTModel(
+            api_key_env=api_key_env,
+            base_url=base_url,
+            timeout_sec=timeout_sec,
+            caps_path=os.path.join(self.memory_dir, "model_caps.json"),
+            pricing_path=os.path.join(self.memory_dir, "pricing_cache.json"),
+        )
 
-        self.gpt = GPTModel(api_key_env=api_key_env, base_url=base_url, timeout_sec=timeout_sec)
+        # локальный подсчёт токенов (tiktoken или калибруемая оценка)
+        self.tokens = TokenCounter()
+        # хвост истории под бюджет токенов (размеры turn'ов кэшируются в самих turn'ах)
+        self.packer = ContextPacker(self.tokens)
+
+        # допуск к апстриму: общий лимит параллельных стримов + очередь по session_id
+        self.scheduler = RequestScheduler(max_concurrent=max_concurrent_streams, max_queue=max_queue)
 
         self.pricing_cache: Dict[str, Dict[str, float]] = {}
 
+        # фоновая сверка тарифов; по умолчанию раз в 6 часов (AGENT_PRICING_REFRESH_SEC)
+        if pricing_refresh_sec is None:
+            pricing_refresh_sec = float(os.getenv("AGENT_PRICING_REFRESH_SEC") or 6 * 3600)
+        self.pricing_refresh_sec = max(float(pricing_refresh_sec), 1.0)
+        self.pricing_stats: Dict[str, int] = {"downloads": 0, "not_modified": 0, "errors": 0, "disk_reloads": 0}
+
+        # почему отменили задачу запроса: ("client" | "disconnect", perf_counter момента отмены)
+        self._cancel_reasons: Dict[asyncio.Task, Tuple[str, float]] = {}
+
+        # фоновая суммаризация: не больше одной задачи на сессию
+        self._summary_tasks: Dict[str, asyncio.Task] = {}
+        self.summary_stats: Dict[str, int] = {"scheduled": 0, "applied": 0, "stale": 0, "errors": 0}
+
     async def preload_pricing(self) -> None:
+        """Тарифы с диска — мгновенно и без сети; сверка с сайтом идёт потом в фоне."""
         try:
-            self.logger.write("INFO", "Загрузка тарифов ProxyAPI (pricing/list)...")
-            self.pricing_cache = await self.gpt.get_pricing_rub_per_1m()
-            self.logger.write("SUCCESS", "Тарифы загружены", extra=f"models={len(self.pricing_cache)}")
+            self.pricing_cache = self.gpt.cached_pricing_rub_per_1m()
         except Exception as e:
-            self.logger.write("WARN", "Не удалось загрузить тарифы ProxyAPI", extra=str(e))
+            self.logger.write("WARN", "Не удалось прочитать кэш тарифов", extra=str(e))
             self.pricing_cache = {}
 
+        if self.pricing_cache:
+            age = self.gpt.pricing_store.age_sec()
+            self.logger.write(
+                "INFO",
+                "Тарифы из кэша",
+                extra=f"models={len(self.pricing_cache)} age={age:.0f}s" if age is not None else f"models={len(self.pricing_cache)}",
+            )
+        else:
+            self.logger.write("INFO", "Кэша тарифов нет — загрузятся в фоне")
+
+    async def refresh_pricing(self) -> bool:
+        """Одна сверка тарифов с ProxyAPI (условный запрос); True — удалось."""
+        try:
+            self.logger.write("INFO", "Сверка тарифов ProxyAPI (pricing/list)...")
+            result = await self.gpt.refresh_pricing_rub_per_1m()
+        except Exception as e:
+            self.pricing_stats["errors"] += 1
+            self.logger.write("WARN", "Не удалось обновить тарифы ProxyAPI", extra=str(e))
+            return False
+
+        self.pricing_cache = result["pricing"]
+        if result["not_modified"]:
+            self.pricing_stats["not_modified"] += 1
+            self.logger.write("INFO", "Тарифы не изменились (304)", extra=f"models={len(self.pricing_cache)}")
+        else:
+            self.pricing_stats["downloads"] += 1
+            self.logger.write("SUCCESS", "Тарифы загружены", extra=f"models={len(self.pricing_cache)}")
+
+        if result["changed"]:
+            self.events.publish("pricing_reloaded", models=len(self.pricing_cache))
+        return True
+
+    async def _pricing_refresh_loop(self) -> None:
+        """
+        Фоновая сверка тарифов: сразу, если кэш старше pricing_refresh_sec (или его нет),
+        дальше — по таймеру. После ошибки — повтор через PRICING_RETRY_SEC.
+        """
+        while True:
+            age = self.gpt.pricing_store.age_sec()
+            if age is None or age >= self.pricing_refresh_sec:
+                ok = await self.refresh_pricing()
+                delay = self.pricing_refresh_sec if ok else min(self.PRICING_RETRY_SEC, self.pricing_refresh_sec)
+            else:
+                # свежий кэш (например, его только что обновил соседний воркер)
+                delay = self.pricing_refresh_sec - age
+
+            await asyncio.sleep(max(delay, 1.0))
+            await self._reload_pricing_from_disk()
+
+    async def _reload_pricing_from_disk(self) -> None:
+        """
+        Кэш тарифов общий для воркеров: если его уже обновил соседний, берём таблицу
+        из файла (иначе свежий age_sec() пропустит сверку, а цены останутся старыми).
+        """
+        try:
+            await asyncio.to_thread(self.gpt.pricing_store.load)
+        except Exception as e:
+            self.logger.write("WARN", "Не удалось перечитать кэш тарифов", extra=str(e))
+            return
+
+        pricing = self.gpt.pricing_store.pricing
+        if not pricing or pricing == self.pricing_cache:
+            return
+        self.pricing_cache = pricing
+        self.pricing_stats["disk_reloads"] += 1
+        self.logger.write("INFO", "Тарифы обновлены из общего кэша", extra=f"models={len(pricing)}")
+        self.events.publish("pricing_reloaded", models=len(pricing))
+
+    async def flush_sessions(self) -> None:
+        try:
+            await self.session_io.flush()
+        except Exception as e:
+            self.logger.write("ERROR", "Не удалось записать сессии на диск", extra=str(e))
+
+    async def _session_flush_loop(self) -> None:
+        """Write-behind: грязные сессии из кэша уходят на диск раз в session_flush_sec."""
+        while True:
+            await asyncio.sleep(self.session_flush_sec)
+            await self.flush_sessions()
+
     def _calc_cost_rub(self, model_id: str, usage: Dict[str, Any]) -> Optional[float]:
         try:
             price = self.pricing_cache.get((model_id or "").strip())
@@ -64,43 +256,13 @@ class LLMAgentServer:
         except Exception:
             return None
 
-    async def _send_json(self, writer: asyncio.StreamWriter, payload: Dict[str, Any]) -> None:
-        data = (json.dumps(payload, ensure_ascii=False) + "\n").encode("utf-8")
-        writer.write(data)
-        await writer.drain()
-
-    async def _send_json_maybe_chunked(self, writer: asyncio.StreamWriter, payload: Dict[str, Any], *, max_line_bytes: int = 60000) -> None:
-        """
-        Если payload слишком большой для одной строки readline() у клиента — шлём в несколько строк.
-
-        Протокол:
-        1) {"type":"chunked_start","orig_type":"session","chunks":N}
-        2) N строк {"type":"chunked_part","orig_type":"session","i":0..N-1,"data":"..."}
-        3) {"type":"chunked_end","orig_type":"session"}
-        """
-        text = json.dumps(payload, ensure_ascii=False)
-        raw = (text + "\n").encode("utf-8")
-
-        if len(raw) <= max_line_bytes:
-            writer.write(raw)
-            await writer.drain()
-            return
-
-        part_size = max(1000, max_line_bytes - 2000)
-        parts = [text[i:i + part_size] for i in range(0, len(text), part_size)]
-
-        start = {"type": "chunked_start", "orig_type": payload.get("type"), "chunks": len(parts)}
-        writer.write((json.dumps(start, ensure_ascii=False) + "\n").encode("utf-8"))
-        await writer.drain()
-
-        for i, part in enumerate(parts):
-            msg = {"type": "chunked_part", "orig_type": payload.get("type"), "i": i, "data": part}
-            writer.write((json.dumps(msg, ensure_ascii=False) + "\n").encode("utf-8"))
-            await writer.drain()
-
-        end = {"type": "chunked_end", "orig_type": payload.get("type")}
-        writer.write((json.dumps(end, ensure_ascii=False) + "\n").encode("utf-8"))
-        await writer.drain()
+    def _hedging_stats(self) -> Dict[str, Any]:
+        st = dict(self.hedge_stats)
+        st["enabled"] = self.hedge
+        st["rate"] = (st["fired"] / st["requests"]) if st["requests"] else 0.0
+        st["extra_cost_rub"] = round(float(st["extra_cost_rub"]), 6)
+        st["deadlines"] = self.gpt.ttft_tracker.stats()
+        return st
 
     async def _summarize_history_text(
         self,
@@ -108,20 +270,38 @@ class LLMAgentServer:
         history_text: str,
         model: str,
         endpoint: str,
+        previous_summary: str = "",
     ) -> str:
         """
         Делает суммаризацию истории через GPTModel.stream_chat (стрим), собирает в строку.
+
+        С previous_summary — инкрементально: в запрос идут только прошлая выжимка
+        и новые (выпавшие из хвоста) сообщения, а не вся история заново.
         """
-        prompt = (
-            "Сожми историю диалога в компактную выжимку, сохранив смысл, факты, договорённости и контекст.\n"
+        rules = (
             "Требования:\n"
             "- Пиши по-русски.\n"
             "- Без воды.\n"
             "- Сохраняй имена переменных/методов/классов как есть.\n"
             "- Если есть требования/правила — вынеси их отдельным списком.\n\n"
-            "ИСТОРИЯ:\n"
-            f"{history_text}"
         )
+        if previous_summary.strip():
+            prompt = (
+                "Обнови выжимку диалога: дополни прошлую выжимку новыми сообщениями, "
+                "сохранив смысл, факты, договорённости и контекст. Устаревшее можно сжать сильнее.\n"
+                + rules
+                + "ПРОШЛАЯ ВЫЖИМКА:\n"
+                f"{previous_summary.strip()}\n\n"
+                "НОВЫЕ СООБЩЕНИЯ:\n"
+                f"{history_text}"
+            )
+        else:
+            prompt = (
+                "Сожми историю диалога в компактную выжимку, сохранив смысл, факты, договорённости и контекст.\n"
+                + rules
+                + "ИСТОРИЯ:\n"
+                f"{history_text}"
+            )
 
         out = ""
         gen = self.gpt.stream_chat(
@@ -133,6 +313,8 @@ class LLMAgentServer:
             endpoint=endpoint,
             temperature=None,
             include_usage=False,
+            # фоновая выжимка не должна сдвигать дедлайн хеджирования ходов диалога
+            record_ttft=False,
         )
         try:
             async for ch in gen:
@@ -145,371 +327,967 @@ class LLMAgentServer:
 
         return out.strip()
 
-    def _history_for_llm(self, session: dict) -> list:
-        history = session.get("history") or {}
-        if not isinstance(history, dict):
-            return []
+    def _schedule_summary(
+        self,
+        session_id: str,
+        *,
+        model: str,
+        summary_model: str,
+        summary_endpoint: str,
+        tail_budget: int,
+        keep_last_n: int,
+        reason: str,
+    ) -> bool:
+        """Запустить фоновую суммаризацию сессии; False — по этой сессии она уже идёт."""
+        if session_id in self._summary_tasks:
+            return False
+
+        task = asyncio.create_task(
+            self._background_summary(
+                session_id,
+                model=model,
+                summary_model=summary_model,
+                summary_endpoint=summary_endpoint,
+                tail_budget=tail_budget,
+                keep_last_n=keep_last_n,
+            )
+        )
+        self._summary_tasks[session_id] = task
 
-        out = []
+        def _done(t: asyncio.Task) -> None:
+            if self._summary_tasks.get(session_id) is t:
+                del self._summary_tasks[session_id]
+
+        task.add_done_callback(_done)
+        self.summary_stats["scheduled"] += 1
+        self.logger.write("INFO", "Суммаризация истории запланирована в фоне", extra=f"session={session_id} {reason}")
+        return True
+
+    async def _background_summary(
+        self,
+        session_id: str,
+        *,
+        model: str,
+        summary_model: str,
+        summary_endpoint: str,
+        tail_budget: int,
+        keep_last_n: int,
+    ) -> None:
+        """
+        Дописать в выжимку turn'ы, выпавшие из хвоста, вне хода диалога.
+
+        Снимок сессии и применение результата — под очередью сессии (ход, который запустил
+        задачу, к этому моменту уже сохранён); сам вызов модели — только в слоте апстрима,
+        сессию он не держит. Если выжимку за это время поменяли — результат выбрасывается.
+        """
         try:
-            keys = sorted(history.keys(), key=lambda x: int(x))
-        except Exception:
-            keys = list(history.keys())
+            async with self.scheduler.slot(session_id, upstream=False):
+                session = await self.session_io.load_session(session_id)
+                summary, upto = self._session_summary(session)
+                history = session.get("history")
+                packed = self.packer.pack(
+                    history if isinstance(history, dict) else {},
+                    model=model,
+                    budget=tail_budget,
+                    max_messages=keep_last_n,
+                    summary_upto=upto,
+                )
+                aged_out = packed.aged_out
+                if self._keep_token_cache(session, packed):
+                    await self.session_io.save_session(session)
 
-        for k in keys:
-            turn = history.get(k) or {}
-            user_text = turn.get("user_text")
-            assistant_text = turn.get("assistant_text")
+            aged_out_text = self._messages_text(aged_out)
+            if not aged_out_text:
+                return
+
+            t0 = time.perf_counter()
+            async with self.scheduler.upstream_slot():
+                new_summary = await self._summarize_history_text(
+                    history_text=aged_out_text,
+                    model=summary_model,
+                    endpoint=summary_endpoint,
+                    previous_summary=summary if upto is not None else "",
+                )
+            if not new_summary:
+                return
 
-            if isinstance(user_text, str) and user_text:
-                out.append({"role": "user", "content": user_text})
-            if isinstance(assistant_text, str) and assistant_text:
-                out.append({"role": "assistant", "content": assistant_text})
+            new_upto = int(aged_out[-1]["turn_id"])
+            async with self.scheduler.slot(session_id, upstream=False):
+                session = await self.session_io.load_session(session_id)
+                if self._session_summary(session) != (summary, upto):
+                    self.summary_stats["stale"] += 1
+                    self.logger.write("WARN", "Фоновая выжимка устарела, отброшена", extra=f"session={session_id}")
+                    return
 
-        return out
+                session["history_summary"] = new_summary
+                session["history_summary_upto"] = new_upto
+                session["updated_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                await self.session_io.save_session(session)
+
+            self.summary_stats["applied"] += 1
+            self.events.publish("summary_updated", session_id=session_id, history_summary=new_summary)
+            self.logger.write(
+                "SUCCESS",
+                "История суммаризирована в фоне",
+                extra=(
+                    f"session={session_id} new_msgs={len(aged_out)} upto={new_upto} "
+                    f"ms={(time.perf_counter() - t0) * 1000.0:.0f}"
+                ),
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.summary_stats["errors"] += 1
+            self.logger.write("WARN", "Суммаризация не удалась", extra=f"session={session_id} {e}")
+
+    def _keep_token_cache(self, session: Dict[str, Any], packed: PackedContext) -> bool:
+        """
+        Пометить turn'ы с заново посчитанными токенами изменёнными: журнал и SQLite пишут
+        только turn'ы новее сохранённой версии, иначе кэш терялся бы при каждом перезапуске.
+        """
+        for turn_id in packed.recounted:
+            self.memory_store.bump_turn_version(session, turn_id)
+        return bool(packed.recounted)
+
+    @staticmethod
+    def _session_summary(session: dict) -> Tuple[str, Optional[int]]:
+        """(выжимка, до какого turn'а она дошла); None — выжимка из старой версии без отметки."""
+        summary = session.get("history_summary") or ""
+        if not isinstance(summary, str):
+            summary = ""
+        try:
+            upto = int(session.get("history_summary_upto"))
+        except (TypeError, ValueError):
+            upto = None
+        return summary, upto
+
+    @staticmethod
+    def _messages_text(msgs: list) -> str:
+        out = []
+        for m in msgs:
+            role = m.get("role")
+            content = m.get("content")
+            if not content:
+                continue
+            if role == "user":
+                out.append("USER: " + str(content))
+            elif role == "assistant":
+                out.append("ASSISTANT: " + str(content))
+            else:
+                out.append(str(content))
+        return "\n".join(out).strip()
+
+    def _prompt_tokens_raw(self, model: str, summary_text: str, tail: list, user_tokens: int) -> int:
+        """Промпт так, как он уйдёт в апстрим: system(summary) + хвост + новое сообщение."""
+        contents = []
+        if isinstance(summary_text, str) and summary_text.strip():
+            contents.append(self.tokens.count(self.SUMMARY_PREFIX + summary_text.strip(), model))
+        contents.extend(int(m.get("tokens") or 0) for m in tail)
+        contents.append(int(user_tokens))
+        return self.tokens.count_messages(contents)
+
+    @staticmethod
+    def _parse_page_params(request: Dict[str, Any]) -> Dict[str, Any]:
+        """from_turn / limit / fields / since_version из get_session (только заданные)."""
+        params: Dict[str, Any] = {}
+
+        for key in ("from_turn", "limit", "since_version"):
+            value = request.get(key)
+            if value is None:
+                continue
+            if isinstance(value, bool):
+                raise TypeError(f"{key} must be int")
+            value = int(value)
+            if value < 0:
+                raise ValueError(f"{key} must be >= 0")
+            params[key] = value
+
+        fields = request.get("fields")
+        if fields is not None:
+            if not isinstance(fields, list) or not all(isinstance(f, str) for f in fields):
+                raise TypeError("fields must be a list of strings")
+            params["fields"] = fields
+
+        return params
 
     async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
-        peer = writer.get_extra_info("peername")
+        """
+        Одно долгоживущее соединение на клиента.
+
+        Каждый запрос может нести "id" — тогда он обрабатывается отдельной задачей,
+        а все ответы на него помечаются тем же "id". Так по одному сокету одновременно
+        идут стрим, list_sessions, get_session и т.д.
+
+        Запрос без "id" (старый клиент) обрабатывается последовательно, как раньше.
+        """
+        peer = writer.get_extra_info("peername") or "unix"
         self.logger.write("INFO", "Клиент подключился", extra=str(peer))
 
+        conn = AgentConnection(reader, writer)
+        tasks: Dict[str, asyncio.Task] = {}
+
+        def make_reply(request_id: Optional[str]) -> Reply:
+            async def reply(payload: Dict[str, Any]) -> None:
+                if request_id is not None:
+                    payload = dict(payload)
+                    payload["id"] = request_id
+                await conn.send(payload)
+            return reply
+
         try:
-            line = await reader.readline()
-            if not line:
-                return
+            while True:
+                try:
+                    request = await conn.recv()
+                except ValueError:
+                    await conn.send({"type": "error", "message": "Invalid JSON"})
+                    continue
+
+                if request is None:
+                    break
+
+                if request.get("action") == "hello":
+                    # согласование формата: дальше — кадры с префиксом длины
+                    codec = choose_codec(request.get("framing"))
+                    if codec is None:
+                        await conn.send({"type": "hello", "framing": "lines"})
+                    else:
+                        await conn.send({"type": "hello", "framing": "frames", "codec": codec})
+                        conn.use_frames(codec)
+                    continue
+
+                request_id = request.get("id")
+                if request.get("action") == "cancel":
+                    # STOP в UI: отменяем задачу запроса target_id на этом соединении
+                    target = tasks.get(str(request.get("target_id") or ""))
+                    if target is not None and not target.done():
+                        self._cancel_reasons[target] = ("client", time.perf_counter())
+                        target.cancel()
+                    if request_id is not None:
+                        await make_reply(str(request_id))({"type": "ok"})
+                    continue
+
+                if request_id is None:
+                    await self._run_request(request, make_reply(None))
+                    continue
+
+                request_id = str(request_id)
+                if request_id in tasks:
+                    await make_reply(request_id)({"type": "error", "message": "Duplicate request id"})
+                    continue
+
+                task = asyncio.create_task(self._run_request(request, make_reply(request_id)))
+                tasks[request_id] = task
+
+                def _forget(t: asyncio.Task, rid: str = request_id) -> None:
+                    tasks.pop(rid, None)
+                    self._cancel_reasons.pop(t, None)
+
+                task.add_done_callback(_forget)
+
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
 
+        except ProtocolError as e:
+            self.logger.write("WARN", "Ошибка протокола, соединение закрыто", extra=str(e))
+
+        except Exception as e:
+            self.logger.write("ERROR", "Ошибка соединения с клиентом", extra=str(e))
+
+        finally:
+            # клиент ушёл — незавершённые запросы доставить уже некому:
+            # отменяем их сразу, чтобы стримы апстрима не продолжали тратить токены
+            pending = list(tasks.values())
+            for t in pending:
+                self._cancel_reasons.setdefault(t, ("disconnect", time.perf_counter()))
+                t.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+            await conn.close()
+            self.logger.write("INFO", "Клиент отключился", extra=str(peer))
+
+    async def _run_request(self, request: Dict[str, Any], reply: Reply) -> None:
+        try:
+            await self._handle_request(request, reply)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            tb = traceback.format_exc()
+            msg = str(e) or "Unknown error"
+            self.logger.write("ERROR", "Ошибка обработки запроса", extra=msg)
+            self.logger.write("ERROR", "TRACEBACK", extra=tb)
             try:
-                request = json.loads(line.decode("utf-8", errors="replace"))
+                await reply({"type": "error", "message": msg})
             except Exception:
-                await self._send_json(writer, {"type": "error", "message": "Invalid JSON"})
-                return
-
-            action = request.get("action")
+                pass
 
-            if action == "ping":
-                await self._send_json(writer, {"type": "pong"})
-                return
+    async def _handle_request(self, request: Dict[str, Any], reply: Reply) -> None:
+        action = request.get("action")
 
-            if action == "list_sessions":
-                sessions = self.memory_store.list_sessions()
-                await self._send_json(
-                    writer,
-                    {
-                        "type": "sessions",
-                        "sessions": [
-                            {
-                                "session_id": s.session_id,
-                                "title": s.title,
-                                "created_at": s.created_at,
-                                "updated_at": s.updated_at,
-                            }
-                            for s in sessions
-                        ],
-                    },
-                )
-                return
+        if action == "ping":
+            await reply({"type": "pong"})
+            return
 
-            if action == "get_session":
-                session_id = (request.get("session_id") or "").strip()
-                if not session_id:
-                    await self._send_json(writer, {"type": "error", "message": "session_id is required"})
-                    return
+        if action == "server_stats":
+            await reply(
+                {
+                    "type": "server_stats",
+                    "worker_id": self.worker_id,
+                    "pid": os.getpid(),
+                    "scheduler": self.scheduler.stats(),
+                    "events": self.events.stats(),
+                    "http": self.gpt.pool_stats(),
+                    "hedging": self._hedging_stats(),
+                    "model_caps_learned": self.gpt.caps.learned,
+                    "tokens": self.tokens.stats(),
+                    "packer": self.packer.stats(),
+                    "storage": self.memory_store.storage_stats(),
+                    "session_cache": self.memory_store.cache_stats(),
+                    "io": self.session_io.stats(),
+                    "summaries": {**self.summary_stats, "pending": len(self._summary_tasks)},
+                    "pricing": {**self.gpt.pricing_store.stats(), **self.pricing_stats},
+                }
+            )
+            return
 
-                session = self.memory_store.load_session(session_id)
+        if action == "model_caps":
+            model = (request.get("model") or "").strip()
+            caps = self.gpt.caps.get(model) if model else self.gpt.caps.all()
+            await reply({"type": "model_caps", "caps": caps})
+            return
 
-                # ВАЖНО: сессия может быть огромной -> шлём chunked, чтобы readline() у клиента не падал
-                await self._send_json_maybe_chunked(writer, {"type": "session", "session": session})
-                return
+        if action == "subscribe":
+            await self._handle_subscribe(request, reply)
+            return
 
-            if action == "reset_session":
-                session_id = (request.get("session_id") or "").strip()
-                if not session_id:
-                    await self._send_json(writer, {"type": "error", "message": "session_id is required"})
-                    return
+        if action == "list_sessions":
+            delta = await self.session_io.list_sessions_delta(request.get("since_version"))
+
+            # супервизор спрашивает каждого воркера только про его сессии: shard=[номер, всего]
+            shard = request.get("shard")
+            if isinstance(shard, list) and len(shard) == 2:
+                index, count = int(shard[0]), int(shard[1])
+                delta["sessions"] = [
+                    e for e in delta["sessions"] if session_shard(e["session_id"], count) == index
+                ]
+                delta["deleted"] = [
+                    sid for sid in delta["deleted"] if session_shard(sid, count) == index
+                ]
+
+            await reply({"type": "sessions", **delta})
+            return
 
-                self.memory_store.delete_session_file(session_id)
-                await self._send_json(writer, {"type": "ok"})
+        if action == "get_session":
+            session_id = (request.get("session_id") or "").strip()
+            if not session_id:
+                await reply({"type": "error", "message": "session_id is required"})
                 return
 
-            if action != "stream_chat":
-                await self._send_json(writer, {"type": "error", "message": "Unknown action"})
+            try:
+                page_params = self._parse_page_params(request)
+            except (TypeError, ValueError) as e:
+                await reply({"type": "error", "message": f"Invalid get_session params: {e}"})
                 return
 
-            user_text = (request.get("user_text") or "").strip()
-            session_id = (request.get("session_id") or "").strip()
+            if page_params:
+                session = await self.session_io.load_session_page(session_id, **page_params)
+            else:
+                session = await self.session_io.load_session(session_id)
+
+            # без параметров — вся сессия (старый клиент); в режиме строк AgentConnection сам порежет её на chunked_*
+            await reply({"type": "session", "session": session})
+            return
 
+        if action == "reset_session":
+            session_id = (request.get("session_id") or "").strip()
             if not session_id:
-                await self._send_json(writer, {"type": "error", "message": "session_id is required"})
-                return
-            if not user_text:
-                await self._send_json(writer, {"type": "error", "message": "Empty user_text"})
+                await reply({"type": "error", "message": "session_id is required"})
                 return
 
-            model = (request.get("model") or "").strip() or self.gpt.model
-            endpoint = request.get("endpoint") or "chat"
-            max_tokens = int(request.get("max_tokens") or 512)
+            # не удаляем файл посреди чужого хода этой же сессии
+            async with self.scheduler.slot(session_id, upstream=False):
+                await self.session_io.delete_session_file(session_id)
+            await reply({"type": "ok"})
+            return
 
-            temperature = request.get("temperature", None)
-            if temperature is not None:
-                try:
-                    temperature = float(temperature)
-                except Exception:
-                    temperature = None
+        if action != "stream_chat":
+            await reply({"type": "error", "message": "Unknown action"})
+            return
 
-            # NEW: параметры контроля длины и суммаризации
-            try:
-                char_limit = int(request.get("char_limit") or 12000)
-            except Exception:
-                char_limit = 12000
+        await self._handle_stream_chat(request, reply)
 
-            try:
-                keep_last_n = int(request.get("keep_last_n") or 8)
-            except Exception:
-                keep_last_n = 8
+    async def _handle_subscribe(self, request: Dict[str, Any], reply: Reply) -> None:
+        """
+        Постоянная подписка на события: живёт, пока клиент не отменит её (cancel)
+        или не закроет соединение. Если событий нет — heartbeat каждые heartbeat_sec,
+        по нему UI понимает, что агент жив, без отдельных ping.
+        """
+        if request.get("id") is None:
+            await reply({"type": "error", "message": "subscribe requires id"})
+            return
 
-            summary_model = (request.get("summary_model") or "").strip() or model
-            summary_endpoint = (request.get("summary_endpoint") or "").strip() or "chat"
+        try:
+            heartbeat_sec = float(request.get("heartbeat_sec") or self.HEARTBEAT_SEC)
+        except Exception:
+            heartbeat_sec = self.HEARTBEAT_SEC
+        heartbeat_sec = min(max(heartbeat_sec, 0.2), 60.0)
 
-            session = self.memory_store.load_session(session_id)
-            self.memory_store.set_title_if_empty(session, user_text)
+        sub_id = self.events.subscribe()
+        sub = self.events.get(sub_id)
+        try:
+            await reply({"type": "subscribed", "heartbeat_sec": heartbeat_sec, "worker_id": self.worker_id})
+            while True:
+                event = await sub.next(timeout=heartbeat_sec)
+                if event is None:
+                    event = {"event": "heartbeat", "ts": time.time()}
+                await reply({"type": "event", **event})
+        finally:
+            self.events.unsubscribe(sub_id)
 
-            history = session.get("history") or {}
-            if not isinstance(history, dict):
-                history = {}
+    async def _handle_stream_chat(self, request: Dict[str, Any], reply: Reply) -> None:
+        session_id = (request.get("session_id") or "").strip()
+        if not session_id:
+            await reply({"type": "error", "message": "session_id is required"})
+            return
 
-            # подтянем прошлую суммаризацию
-            history_summary = session.get("history_summary") or ""
-            if not isinstance(history_summary, str):
-                history_summary = ""
+        async def _on_queued(position: int) -> None:
+            await reply({"type": "queued", "position": int(position)})
 
-            # история для LLM (полная) до добавления текущего сообщения
-            session["history"] = history
-            history_for_llm_full = self._history_for_llm(session)
+        try:
+            async with self.scheduler.slot(session_id, on_queued=_on_queued) as admission:
+                await self._stream_chat_turn(request, reply, admission)
+        except QueueFullError as e:
+            self.logger.write("WARN", "Запрос отклонён планировщиком", extra=f"session={session_id} {e}")
+            await reply({"type": "error", "message": str(e)})
 
-            # turn_id
+    async def _stream_chat_turn(self, request: Dict[str, Any], reply: Reply, admission: Dict[str, Any]) -> None:
+        """
+        Один ход диалога. Вызывается только внутри слота планировщика:
+        для этой session_id других ходов параллельно нет.
+        """
+        user_text = (request.get("user_text") or "").strip()
+        session_id = (request.get("session_id") or "").strip()
+
+        if not session_id:
+            await reply({"type": "error", "message": "session_id is required"})
+            return
+        if not user_text:
+            await reply({"type": "error", "message": "Empty user_text"})
+            return
+
+        model = (request.get("model") or "").strip() or self.gpt.model
+        endpoint = request.get("endpoint") or "chat"
+        max_tokens = int(request.get("max_tokens") or 512)
+
+        temperature = request.get("temperature", None)
+        if temperature is not None:
             try:
-                last_idx = max([int(k) for k in history.keys()] or [0])
+                temperature = float(temperature)
             except Exception:
-                last_idx = 0
-            turn_id = str(last_idx + 1)
-
-            # r_prev_prompt_total (из предыдущего turn)
-            r_prev_prompt_total = 0
-            if last_idx > 0:
-                prev_turn = history.get(str(last_idx)) or {}
-                r_prev_prompt_total = int(prev_turn.get("r_prompt_total") or 0)
-
-            # сохраняем turn с user_text заранее
-            history[turn_id] = {
-                "ts": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                "user_text": user_text,
-                "assistant_text": "",
-                "model": model,
-                "endpoint": endpoint,
-                "max_tokens": int(max_tokens),
-                "temperature": temperature,
-                "usage": {},
-                "cost_rub": None,
-                "r_prompt_total": 0,
-                "c_completion": 0,
-                "total_tokens_call": 0,
-                "r_prev_prompt_total": int(r_prev_prompt_total),
-                "current_message_tokens": 0,
-            }
+                temperature = None
 
-            session["history"] = history
-            session["updated_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            session["history_summary"] = history_summary
-            self.memory_store.save_session(session)
+        # порог суммаризации в токенах (старый клиент присылает char_limit в символах)
+        try:
+            if request.get("token_limit") is not None:
+                token_limit = int(request.get("token_limit"))
+            elif request.get("char_limit") is not None:
+                token_limit = int(request.get("char_limit")) // self.LEGACY_CHARS_PER_TOKEN
+            else:
+                token_limit = self.DEFAULT_TOKEN_LIMIT
+        except Exception:
+            token_limit = self.DEFAULT_TOKEN_LIMIT
 
-            gen = None
-            assistant_answer = ""
+        try:
+            keep_last_n = int(request.get("keep_last_n") or 8)
+        except Exception:
+            keep_last_n = 8
 
-            # ====== NEW_MESSAGE сборка на сервере ======
-            # New_message (для измерения длины):
-            # HISTORY_SUMMARY + последние N сообщений + NEW_MESSAGE(user_text)
-            msgs_flat = list(history_for_llm_full)
+        try:
+            coalesce_ms = float(request.get("coalesce_ms", self.coalesce_ms))
+        except Exception:
+            coalesce_ms = self.coalesce_ms
 
-            if keep_last_n > 0:
-                tail_msgs = msgs_flat[-keep_last_n:]
-                old_msgs = msgs_flat[:-keep_last_n]
-            else:
-                tail_msgs = []
-                old_msgs = msgs_flat
-
-            def _to_text(msgs):
-                out = []
-                for m in msgs:
-                    role = m.get("role")
-                    content = m.get("content")
-                    if not content:
-                        continue
-                    if role == "user":
-                        out.append("USER: " + str(content))
-                    elif role == "assistant":
-                        out.append("ASSISTANT: " + str(content))
-                    else:
-                        out.append(str(content))
-                return "\n".join(out).strip()
-
-            old_text = _to_text(old_msgs)
-            tail_text = _to_text(tail_msgs)
-
-            def _build_new_message_preview(summary_text: str) -> str:
-                s = ""
-                if isinstance(summary_text, str) and summary_text.strip():
-                    s += "HISTORY_SUMMARY:\n" + summary_text.strip() + "\n\n"
-                if tail_text:
-                    s += "LAST_MESSAGES:\n" + tail_text + "\n\n"
-                s += "NEW_MESSAGE:\n" + user_text
-                return s
-
-            new_message_preview = _build_new_message_preview(history_summary)
-            new_message_len = len(new_message_preview)
-
-            history_summarized = False
-
-            # Если превышаем порог — суммаризируем old_text и сохраняем history_summary
-            if char_limit > 0 and new_message_len > char_limit:
-                if old_text.strip():
-                    try:
-                        self.logger.write(
-                            "INFO",
-                            "История превышает порог, делаю суммаризацию",
-                            extra=f"len={new_message_len}/{char_limit}",
-                        )
-
-                        # ВАЖНО: метод _summarize_history_text должен быть добавлен в класс LLMAgentServer
-                        new_summary = await self._summarize_history_text(
-                            history_text=old_text,
-                            model=summary_model,
-                            endpoint=summary_endpoint,
-                        )
-
-                        if isinstance(new_summary, str) and new_summary.strip():
-                            history_summary = new_summary.strip()
-                            session["history_summary"] = history_summary
-                            session["updated_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                            self.memory_store.save_session(session)
-                            history_summarized = True
-
-                            # пересчёт длины после обновления summary
-                            new_message_len = len(_build_new_message_preview(history_summary))
-
-                    except Exception as e:
-                        self.logger.write("WARN", "Суммаризация не удалась", extra=str(e))
-
-            # ====== Формируем запрос для GPT ======
-            system_text = None
-            if isinstance(history_summary, str) and history_summary.strip():
-                system_text = "History summary (compressed context):\n" + history_summary.strip()
-
-            # В историю для LLM кладём только хвост последних сообщений
-            history_for_llm = tail_msgs
+        try:
+            coalesce_bytes = int(request.get("coalesce_bytes") or self.coalesce_bytes)
+        except Exception:
+            coalesce_bytes = self.coalesce_bytes
 
-            try:
-                gen = self.gpt.stream_chat(
-                    user_text=user_text,
-                    system_text=system_text,
-                    history=history_for_llm,
-                    max_tokens=max_tokens,
-                    model=model,
-                    endpoint=endpoint,
-                    temperature=temperature,
-                    include_usage=True,
-                )
+        summary_model = (request.get("summary_model") or "").strip() or model
+        summary_endpoint = (request.get("summary_endpoint") or "").strip() or "chat"
+
+        session = await self.session_io.load_session(session_id)
+        self.memory_store.set_title_if_empty(session, user_text)
+
+        history = session.get("history") or {}
+        if not isinstance(history, dict):
+            history = {}
+
+        # подтянем прошлую суммаризацию и до какого turn'а она дошла
+        # (без отметки — выжимка из старой версии: при следующей суммаризации пересоберём её целиком)
+        history_summary, summary_upto = self._session_summary(session)
+
+        session["history"] = history
+        user_tokens = self.tokens.count(user_text, model)
+
+        # ====== Бюджет: окно модели минус max_tokens, не больше порога token_limit ======
+        # Из него вычитаются выжимка (system) и новое сообщение, остаток — на хвост истории.
+        window = context_window(model)
+        token_budget = window - int(max_tokens)
+        context_limit = min(token_limit, token_budget) if token_limit > 0 else token_budget
+        base_raw = self._prompt_tokens_raw(model, history_summary, [], user_tokens)
+        tail_budget = max(int(context_limit / self.tokens.factor(model)) - base_raw, 0)
+
+        # хвост — от новых turn'ов к старым, пока влезает (до добавления текущего сообщения);
+        # токены turn'ов считаются тут один раз и сохраняются вместе с сессией
+        packed = self.packer.pack(
+            history,
+            model=model,
+            budget=tail_budget,
+            max_messages=keep_last_n,
+            summary_upto=summary_upto,
+        )
+        tail_msgs = packed.messages
+        # пересчитанные токены уйдут на диск вместе с сохранением нового turn'а ниже
+        self._keep_token_cache(session, packed)
+
+        # turn_id
+        try:
+            last_idx = max([int(k) for k in history.keys()] or [0])
+        except Exception:
+            last_idx = 0
+        turn_id = str(last_idx + 1)
+
+        # r_prev_prompt_total (из предыдущего turn)
+        r_prev_prompt_total = 0
+        if last_idx > 0:
+            prev_turn = history.get(str(last_idx)) or {}
+            r_prev_prompt_total = int(prev_turn.get("r_prompt_total") or 0)
+
+        # сохраняем turn с user_text заранее
+        history[turn_id] = {
+            "ts": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "user_text": user_text,
+            "assistant_text": "",
+            "model": model,
+            "endpoint": endpoint,
+            "max_tokens": int(max_tokens),
+            "temperature": temperature,
+            "usage": {},
+            "cost_rub": None,
+            "r_prompt_total": 0,
+            "c_completion": 0,
+            "total_tokens_call": 0,
+            "r_prev_prompt_total": int(r_prev_prompt_total),
+            "current_message_tokens": 0,
+            "tokens": {"counter": self.tokens.counter_id(model), "user": int(user_tokens), "assistant": 0},
+        }
+
+        session["history"] = history
+        session["updated_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        session["history_summary"] = history_summary
+        self.memory_store.bump_turn_version(session, turn_id)
+        await self.session_io.save_session(session)
+
+        gen = None
+        assistant_answer = ""
+
+        # ====== NEW_MESSAGE сборка на сервере ======
+        # New_message (для измерения длины):
+        # HISTORY_SUMMARY + хвост истории + NEW_MESSAGE(user_text)
+        tail_text = self._messages_text(tail_msgs)
+
+        def _build_new_message_preview(summary_text: str) -> str:
+            s = ""
+            if isinstance(summary_text, str) and summary_text.strip():
+                s += "HISTORY_SUMMARY:\n" + summary_text.strip() + "\n\n"
+            if tail_text:
+                s += "LAST_MESSAGES:\n" + tail_text + "\n\n"
+            s += "NEW_MESSAGE:\n" + user_text
+            return s
+
+        new_message_len = len(_build_new_message_preview(history_summary))
+        prompt_raw = self._prompt_tokens_raw(model, history_summary, tail_msgs, user_tokens)
+        prompt_tokens = self.tokens.scaled(prompt_raw, model)
+
+        if packed.truncated:
+            self.logger.write(
+                "WARN",
+                "Сообщение не помещается в бюджет контекста, обрезано посередине",
+                extra=f"model={model} truncated={packed.truncated} tokens={prompt_tokens}/{context_limit}",
+            )
 
-                async for chunk in gen:
-                    assistant_answer += chunk
-                    await self._send_json(writer, {"type": "chunk", "chunk": chunk})
+        # выжимка и новое сообщение сами по себе не влезают в окно — хвостом тут не поможешь
+        if prompt_tokens > token_budget:
+            raise RuntimeError(
+                f"Запрос не помещается в окно контекста {model}: "
+                f"~{prompt_tokens} токенов промпта + max_tokens {int(max_tokens)} > {window}"
+            )
 
-                usage = getattr(self.gpt, "last_usage", None) or {}
-                cost_rub = self._calc_cost_rub(model_id=model, usage=usage)
+        # Суммаризация — не на пути к первому токену: её заранее запускает предыдущий ход (см. ниже).
+        # Если выжимка ещё в работе или прогноз промахнулся — отвечаем со старой выжимкой и хвостом
+        # (выпавшие turn'ы пока просто не идут в контекст), а выжимку освежаем в фоне.
+        summary_pending = session_id in self._summary_tasks
+        summary_scheduled = False
+        if packed.over_budget and packed.aged_out and not summary_pending:
+            summary_scheduled = self._schedule_summary(
+                session_id,
+                model=model,
+                summary_model=summary_model,
+                summary_endpoint=summary_endpoint,
+                tail_budget=tail_budget,
+                keep_last_n=keep_last_n,
+                reason=f"now aged_out={len(packed.aged_out)} tokens={prompt_tokens}/{context_limit}",
+            )
 
-                r = int(usage.get("prompt_tokens") or usage.get("input_tokens") or 0)
-                c = int(usage.get("completion_tokens") or usage.get("output_tokens") or 0)
-                total_call = int(usage.get("total_tokens") or (r + c))
+        # ====== Формируем запрос для GPT ======
+        system_text = None
+        if isinstance(history_summary, str) and history_summary.strip():
+            system_text = self.SUMMARY_PREFIX + history_summary.strip()
 
-                current_message_tokens = int(max(r - int(r_prev_prompt_total), 0) + c)
+        # В историю для LLM кладём только хвост последних сообщений
+        history_for_llm = tail_msgs
 
-                history[turn_id]["assistant_text"] = assistant_answer
-                history[turn_id]["usage"] = usage
-                history[turn_id]["cost_rub"] = cost_rub
-                history[turn_id]["r_prompt_total"] = int(r)
-                history[turn_id]["c_completion"] = int(c)
-                history[turn_id]["total_tokens_call"] = int(total_call)
-                history[turn_id]["r_prev_prompt_total"] = int(r_prev_prompt_total)
-                history[turn_id]["current_message_tokens"] = int(current_message_tokens)
+        async def _send_chunk(text: str) -> None:
+            await reply({"type": "chunk", "chunk": text})
 
-                session["history"] = history
-                session["updated_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                session["history_summary"] = history_summary
-                self.memory_store.save_session(session)
-
-                message_stats = {
-                    "turn_id": turn_id,
-                    "r_prompt_total": int(r),
-                    "r_prev_prompt_total": int(r_prev_prompt_total),
-                    "c_completion": int(c),
-                    "current_message_tokens": int(current_message_tokens),
-                    "total_tokens_call": int(total_call),
+        coalescer = ChunkCoalescer(_send_chunk, flush_ms=coalesce_ms, max_bytes=coalesce_bytes)
+        call_stats: Dict[str, Any] = {}
+
+        use_hedge = bool(request.get("hedge", self.hedge))
+        stream = self.gpt.stream_chat_hedged if use_hedge else self.gpt.stream_chat
+
+        try:
+            gen = stream(
+                user_text=user_text,
+                system_text=system_text,
+                history=history_for_llm,
+                max_tokens=max_tokens,
+                model=model,
+                endpoint=endpoint,
+                temperature=temperature,
+                include_usage=True,
+                call_stats=call_stats,
+            )
+
+            async for chunk in gen:
+                assistant_answer += chunk
+                await coalescer.add(chunk)
+
+            await coalescer.close()
+
+            usage = call_stats.get("usage") or {}
+            cost_rub = self._calc_cost_rub(model_id=model, usage=usage)
+
+            r = int(usage.get("prompt_tokens") or usage.get("input_tokens") or 0)
+            c = int(usage.get("completion_tokens") or usage.get("output_tokens") or 0)
+            total_call = int(usage.get("total_tokens") or (r + c))
+
+            current_message_tokens = int(max(r - int(r_prev_prompt_total), 0) + c)
+
+            # оценщик токенов подстраивается под модель по настоящему usage
+            self.tokens.calibrate(model, actual_tokens=r, raw_tokens=prompt_raw)
+
+            # хедж: второй запрос тоже прочитал промпт -> оцениваем доплату по цене ввода
+            hedge = call_stats.get("hedge") or {}
+            hedge_extra_cost = None
+            if use_hedge:
+                self.hedge_stats["requests"] += 1
+            if hedge.get("fired"):
+                hedge_extra_cost = self._calc_cost_rub(model_id=model, usage={"prompt_tokens": r, "completion_tokens": 0})
+                self.hedge_stats["fired"] += 1
+                if hedge.get("winner") == "hedge":
+                    self.hedge_stats["hedge_won"] += 1
+                self.hedge_stats["extra_cost_rub"] += float(hedge_extra_cost or 0.0)
+
+            history[turn_id]["assistant_text"] = assistant_answer
+            history[turn_id]["usage"] = usage
+            history[turn_id]["cost_rub"] = cost_rub
+            history[turn_id]["r_prompt_total"] = int(r)
+            history[turn_id]["c_completion"] = int(c)
+            history[turn_id]["total_tokens_call"] = int(total_call)
+            history[turn_id]["r_prev_prompt_total"] = int(r_prev_prompt_total)
+            history[turn_id]["current_message_tokens"] = int(current_message_tokens)
+            history[turn_id]["tokens"] = None
+            self.packer.turn_tokens(history[turn_id], model)
+            if hedge.get("fired"):
+                history[turn_id]["hedge"] = dict(hedge, extra_cost_rub_est=hedge_extra_cost)
+
+            session["history"] = history
+            session["updated_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            session["history_summary"] = history_summary
+            self.memory_store.bump_turn_version(session, turn_id)
+            await self.session_io.save_session(session)
+
+            # прогноз на следующий ход: этот turn войдёт в хвост, старые выпадут из него.
+            # Если хвост упрётся в бюджет — выжимку готовим сейчас, в фоне,
+            # чтобы к следующему запросу она уже лежала в сессии.
+            next_packed = self.packer.pack(
+                history,
+                model=model,
+                budget=tail_budget,
+                max_messages=keep_last_n,
+                summary_upto=summary_upto,
+            )
+            predicted_tokens = self.tokens.scaled(
+                self._prompt_tokens_raw(model, history_summary, next_packed.messages, user_tokens), model
+            )
+            if (
+                next_packed.over_budget
+                and next_packed.aged_out
+                and not summary_scheduled
+                and session_id not in self._summary_tasks
+            ):
+                summary_scheduled = self._schedule_summary(
+                    session_id,
+                    model=model,
+                    summary_model=summary_model,
+                    summary_endpoint=summary_endpoint,
+                    tail_budget=tail_budget,
+                    keep_last_n=keep_last_n,
+                    reason=f"next aged_out={len(next_packed.aged_out)} tokens~{predicted_tokens}/{context_limit}",
+                )
+
+            message_stats = {
+                "turn_id": turn_id,
+                "r_prompt_total": int(r),
+                "r_prev_prompt_total": int(r_prev_prompt_total),
+                "c_completion": int(c),
+                "current_message_tokens": int(current_message_tokens),
+                "total_tokens_call": int(total_call),
+                "cost_rub": cost_rub,
+
+                # NEW: для UI
+                "new_message_len": int(new_message_len),
+                "prompt_tokens_est": int(prompt_tokens),
+                "token_limit": int(token_limit),
+                "context_window": int(window),
+                "tail_messages": len(tail_msgs),
+                "tail_truncated": int(packed.truncated),
+                "token_counter": self.tokens.counter_id(model),
+                "history_summary": history_summary,
+                "history_summary_upto": summary_upto,
+                "aged_out_msgs": len(packed.aged_out),
+                "predicted_next_tokens": int(predicted_tokens),
+                "summary_pending": bool(summary_pending),
+                "summary_scheduled": bool(summary_scheduled),
+
+                # склейка чанков: сколько пришло от апстрима / ушло в UI / сэкономлено кадров
+                "chunks_upstream": int(coalescer.chunks_in),
+                "chunks_sent": int(coalescer.frames_out),
+                "chunks_merged": int(coalescer.merged),
+
+                # планировщик: место в очереди при постановке и сколько ждали слот
+                "queue_position": int(admission.get("queue_position") or 0),
+                "queue_wait_ms": float(admission.get("queue_wait_ms") or 0.0),
+
+                # хеджирование: сработал ли второй запрос, кто победил, сколько доплатили (оценка)
+                "upstream_ttft_ms": (
+                    round(call_stats["ttft_sec"] * 1000.0, 1) if call_stats.get("ttft_sec") is not None else None
+                ),
+                "hedged": bool(use_hedge),
+                "hedge_fired": bool(hedge.get("fired")),
+                "hedge_winner": hedge.get("winner"),
+                "hedge_deadline_ms": hedge.get("deadline_ms"),
+                "hedge_extra_cost_rub": hedge_extra_cost,
+            }
+
+            await reply(
+                {
+                    "type": "done",
+                    "model": model,
+                    "endpoint": endpoint,
+                    "usage": usage,
                     "cost_rub": cost_rub,
+                    "session_id": session_id,
+                    "title": session.get("title") or "",
+                    "message_stats": message_stats,
+                },
+            )
+
+        except asyncio.CancelledError:
+            # STOP в UI (action=cancel) или обрыв соединения:
+            # рвём апстрим сразу и сохраняем частичный ответ с флагом cancelled
+            reason, t_cancel = self._cancel_reasons.pop(
+                asyncio.current_task(), ("cancelled", time.perf_counter())
+            )
+
+            coalescer.cancel()
+            if gen is not None:
+                try:
+                    await gen.aclose()
+                except Exception:
+                    pass
+                gen = None
+
+            now = time.perf_counter()
+            abort_ms = (now - t_cancel) * 1000.0
+            upstream_sec = (now - call_stats["t_start"]) if call_stats.get("t_start") else 0.0
+
+            # usage апстрим присылает только в конце стрима -> оцениваем, сколько заплатили
+            r_est = int(prompt_tokens)
+            c_est = self.tokens.scaled(self.tokens.count(assistant_answer, model), model)
+            cost_est = self._calc_cost_rub(
+                model_id=model,
+                usage={"prompt_tokens": r_est, "completion_tokens": c_est},
+            )
 
-                    # NEW: для UI
-                    "new_message_len": int(new_message_len),
-                    "char_limit": int(char_limit),
-                    "history_summarized": bool(history_summarized),
-                    "history_summary": history_summary,
+            history[turn_id].update(
+                {
+                    "assistant_text": assistant_answer,
+                    "cancelled": True,
+                    "cancel_reason": reason,
+                    "upstream_sec": round(upstream_sec, 3),
+                    "abort_ms": round(abort_ms, 1),
+                    "r_prompt_est": int(r_est),
+                    "c_completion_est": int(c_est),
+                    "cost_rub_est": cost_est,
+                    "tokens": None,
                 }
+            )
+            self.packer.turn_tokens(history[turn_id], model)
 
-                await self._send_json(
-                    writer,
-                    {
-                        "type": "done",
-                        "model": model,
-                        "endpoint": endpoint,
-                        "usage": usage,
-                        "cost_rub": cost_rub,
-                        "session_id": session_id,
-                        "title": session.get("title") or "",
-                        "message_stats": message_stats,
-                    },
-                )
+            session["history"] = history
+            session["updated_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            session["history_summary"] = history_summary
+            self.memory_store.bump_turn_version(session, turn_id)
+            try:
+                await self.session_io.save_session(session)
+            except Exception as e:
+                self.logger.write("WARN", "Не удалось сохранить отменённый ответ", extra=str(e))
+
+            self.logger.write(
+                "INFO",
+                "Стрим отменён, апстрим закрыт",
+                extra=(
+                    f"reason={reason} session={session_id} turn={turn_id} "
+                    f"upstream={upstream_sec:.3f}s abort={abort_ms:.1f}ms c_est={c_est}"
+                ),
+            )
 
-            finally:
-                if gen is not None:
-                    try:
-                        await gen.aclose()
-                    except Exception:
-                        pass
+            if reason == "client":
+                try:
+                    await reply(
+                        {
+                            "type": "cancelled",
+                            "session_id": session_id,
+                            "message_stats": {
+                                "turn_id": turn_id,
+                                "cancelled": True,
+                                "upstream_sec": round(upstream_sec, 3),
+                                "abort_ms": round(abort_ms, 1),
+                                "c_completion_est": int(c_est),
+                                "cost_rub_est": cost_est,
+                            },
+                        }
+                    )
+                except Exception:
+                    pass
 
-        except Exception as e:
-            tb = traceback.format_exc()
-            msg = str(e) or "Unknown error"
-            self.logger.write("ERROR", "Ошибка обработки клиента", extra=msg)
-            self.logger.write("ERROR", "TRACEBACK", extra=tb)
-            await self._send_json(writer, {"type": "error", "message": msg})
+            raise
 
         finally:
-            try:
-                writer.close()
-                await writer.wait_closed()
-            except Exception:
-                pass
-            self.logger.write("INFO", "Клиент отключился", extra=str(peer))
+            coalescer.cancel()
+            if gen is not None:
+                try:
+                    await gen.aclose()
+                except Exception:
+                    pass
 
     async def run(self) -> None:
+        # лог пишет фоновый поток: запись строки не держит цикл событий
+        self.logger.start_background()
+        # общий HTTP-клиент к ProxyAPI: keep-alive соединения переживают ходы и суммаризации
+        await self.gpt.start()
+        try:
+            await self._serve()
+        finally:
+            await self.gpt.close()
+            # всё несохранённое — на диск до закрытия хранилища
+            await self.flush_sessions()
+            await self.session_io.drain()
+            self.session_io.close()
+            self.memory_store.backend.close()
+            self.logger.close()
+
+    async def _serve(self) -> None:
+        # порт открываем сразу: тарифы берём с диска, сайт сверяем в фоне
         await self.preload_pricing()
 
-        server = await asyncio.start_server(self.handle_client, self.host, self.port)
-        addrs = ", ".join(str(sock.getsockname()) for sock in server.sockets or [])
+        if self.unix_path and not unix_sockets_supported():
+            self.logger.write("WARN", "Unix-сокеты недоступны на этой ОС, только TCP", extra=self.unix_path)
+
+        servers = await start_listeners(self.handle_client, self.host, self.port, unix_path=self.unix_path)
+        addrs = listener_names(servers)
+        if self.worker_id is not None:
+            addrs += f" worker={self.worker_id} pid={os.getpid()}"
         self.logger.write("INFO", "Агент запущен и слушает", extra=addrs)
 
-        async with server:
-            await server.serve_forever()
+        pricing_task = asyncio.create_task(self._pricing_refresh_loop())
+        flush_task = asyncio.create_task(self._session_flush_loop())
+        # каталог сессий строим в пуле сразу, а не в первом list_sessions
+        prime_task = asyncio.create_task(self.session_io.prime())
+        try:
+            await asyncio.gather(*(server.serve_forever() for server in servers))
+        finally:
+            # подписчики узнают об остановке до обрыва соединения
+            self.events.publish("server_draining", worker_id=self.worker_id)
+            if self.events.subscribers:
+                await asyncio.sleep(0.05)
+            close_listeners(servers, unix_path=self.unix_path)
+            pricing_task.cancel()
+            try:
+                await pricing_task
+            except asyncio.CancelledError:
+                pass
+
+            summary_tasks = list(self._summary_tasks.values())
+            for task in summary_tasks:
+                task.cancel()
+            await asyncio.gather(*summary_tasks, return_exceptions=True)
+
+            flush_task.cancel()
+            try:
+                await flush_task
+            except asyncio.CancelledError:
+                pass
+            await asyncio.gather(prime_task, return_exceptions=True)
+            await self.flush_sessions()
 
 
 async def main() -> None:
-    agent = LLMAgentServer()
+    parser = argparse.ArgumentParser(description="LLM agent server")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(os.getenv("AGENT_WORKERS") or 1),
+        help="число процессов-воркеров за одним портом (1 — один процесс без диспетчера)",
+    )
+    parser.add_argument(
+        "--hedge",
+        action="store_true",
+        default=None,
+        help="хеджировать TTFT: второй запрос, если первый токен не пришёл к p95 (или AGENT_HEDGE=1)",
+    )
+    parser.add_argument(
+        "--unix-socket",
+        default=None,
+        help="путь Unix-сокета для локального UI (по умолчанию AGENT_UNIX_SOCKET; пусто — только TCP)",
+    )
+    parser.add_argument(
+        "--storage",
+        choices=BACKENDS,
+        default=None,
+        help="где хранить сессии: json — файл на сессию, sqlite — одна база WAL (или AGENT_STORAGE)",
+    )
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        await AgentSupervisor(
+            workers=args.workers, unix_path=args.unix_socket, hedge=args.hedge, storage=args.storage
+        ).run()
+        return
+
+    agent = LLMAgentServer(unix_path=args.unix_socket, hedge=args.hedge, storage=args.storage)
     await agent.run()
 
 
@@ -0,0 +1,403 @@
+import sys
+sys.dont_write_bytecode = True
+
+import asyncio
+import multiprocessing
+import os
+import signal
+import zlib
+from typing import Any, Dict, List, Optional
+
+from core.agent.agent_client import AgentClient
+from core.agent.agent_logger import AgentFileLogger
+from core.agent.protocol import (
+    READ_LIMIT_BYTES,
+    AgentConnection,
+    ProtocolError,
+    choose_codec,
+    close_listeners,
+    default_unix_path,
+    listener_names,
+    start_listeners,
+)
+
+
+def _worker_main(worker_id: int, host: str, port: int, server_kwargs: Dict[str, Any]) -> None:
+    """Точка входа процесса-воркера: обычный LLMAgentServer на своём порту."""
+    from core.agent.agent_server import LLMAgentServer
+
+    def _stop(*_args):
+        raise SystemExit(0)
+
+    # terminate() от супервизора -> штатное завершение asyncio.run (finally-блоки отработают)
+    signal.signal(signal.SIGTERM, _stop)
+
+    agent = LLMAgentServer(host=host, port=port, worker_id=worker_id, **server_kwargs)
+    try:
+        asyncio.run(agent.run())
+    except (KeyboardInterrupt, SystemExit):
+        pass
+
+
+def session_shard(session_id: str, shards: int) -> int:
+    """Стабильный (между запусками) номер воркера для session_id."""
+    if not session_id or shards <= 1:
+        return 0
+    return zlib.crc32(session_id.encode("utf-8")) % shards
+
+
+class AgentSupervisor:
+    """
+    Режим нескольких процессов за одним портом.
+
+    Родитель слушает внешний порт и работает маленьким диспетчером: разбирает только
+    запросы клиента (они короткие) и отправляет каждый воркеру по хешу session_id.
+    Ответы воркеров (стрим чанков, большие сессии) пересылаются клиенту байт-в-байт,
+    без декодирования. Каждая сессия всегда живёт в одном процессе, поэтому межпроцессные
+    блокировки для состояния сессии не нужны.
+
+    SO_REUSEPORT не подходит: ядро раскладывает соединения, а не сессии,
+    а одно соединение UI несёт запросы разных сессий.
+    """
+
+    # запросы без session_id, которые отвечает сам родитель
+    LOCAL_ACTIONS = ("ping", "server_stats", "list_sessions")
+
+    # версия каталога супервизора = версии воркеров через разделитель
+    CATALOG_TOKEN_SEP = "|"
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 8765,
+        workers: int = 2,
+        worker_base_port: Optional[int] = None,
+        unix_path: Optional[str] = None,
+        **server_kwargs: Any,
+    ):
+        self.host = host
+        self.port = port
+        self.unix_path = unix_path if unix_path is not None else default_unix_path()
+        self.workers = max(int(workers), 1)
+        self.worker_base_port = int(worker_base_port or (port + 1))
+        self.server_kwargs = server_kwargs
+
+        self.base_dir = os.path.dirname(__file__)
+        self.logger = AgentFileLogger(logs_dir=self.base_dir, prefix="agentlogs")
+
+        self._ctx = multiprocessing.get_context("spawn")
+        self._procs: List[Optional[multiprocessing.Process]] = [None] * self.workers
+        self._stats_clients: List[AgentClient] = []
+
+        # --- статистика диспетчера
+        self.connections = 0
+        self.routed: List[int] = [0] * self.workers
+        self.worker_restarts = 0
+
+    def worker_port(self, worker_id: int) -> int:
+        return self.worker_base_port + worker_id
+
+    def worker_for(self, session_id: str) -> int:
+        return session_shard(session_id, self.workers)
+
+    # ====== процессы ======
+
+    def _start_worker(self, worker_id: int) -> None:
+        proc = self._ctx.Process(
+            target=_worker_main,
+            args=(worker_id, "127.0.0.1", self.worker_port(worker_id), dict(self.server_kwargs, unix_path="")),
+            name=f"agent-worker-{worker_id}",
+            daemon=True,
+        )
+        proc.start()
+        self._procs[worker_id] = proc
+        self.logger.write("INFO", "Воркер запущен", extra=f"worker={worker_id} pid={proc.pid} port={self.worker_port(worker_id)}")
+
+    async def _wait_worker_ready(self, worker_id: int, timeout_sec: float = 30.0) -> bool:
+        client = self._stats_clients[worker_id]
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout_sec
+        while loop.time() < deadline:
+            if await client.ping():
+                return True
+            await asyncio.sleep(0.2)
+        return False
+
+    async def _monitor_workers(self) -> None:
+        while True:
+            await asyncio.sleep(1.0)
+            for i, proc in enumerate(self._procs):
+                if proc is not None and proc.is_alive():
+                    continue
+                self.logger.write("WARN", "Воркер упал, перезапускаю", extra=f"worker={i} exitcode={getattr(proc, 'exitcode', None)}")
+                self.worker_restarts += 1
+                self._start_worker(i)
+
+    def _stop_workers(self) -> None:
+        for proc in self._procs:
+            if proc is not None and proc.is_alive():
+                proc.terminate()
+        for proc in self._procs:
+            if proc is not None:
+                proc.join(timeout=10)
+
+    # ====== диспетчер ======
+
+    async def _open_worker_connection(self, worker_id: int, client_conn: AgentConnection) -> AgentConnection:
+        reader, writer = await asyncio.open_connection(
+            "127.0.0.1", self.worker_port(worker_id), limit=READ_LIMIT_BYTES
+        )
+        upstream = AgentConnection(reader, writer)
+
+        # воркер должен говорить в том же формате, что и клиент, — тогда ответы идут байт-в-байт
+        if client_conn.framing == "frames":
+            await upstream.send({"action": "hello", "framing": [client_conn.codec]})
+            msg = await upstream.recv()
+            if not (isinstance(msg, dict) and msg.get("codec") == client_conn.codec):
+                await upstream.close()
+                raise ProtocolError(f"Воркер {worker_id} не поддерживает кодек {client_conn.codec}")
+            upstream.use_frames(client_conn.codec)
+
+        return upstream
+
+    async def _relay(self, upstream: AgentConnection, client_conn: AgentConnection) -> None:
+        try:
+            while True:
+                data = await upstream.recv_raw()
+                if data is None:
+                    break
+                await client_conn.send_raw(data)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            pass
+        finally:
+            # воркер пропал — ответы на его запросы уже не придут: рвём соединение клиента,
+            # клиент переподключится, а его ждущие запросы получат ошибку соединения
+            try:
+                client_conn.writer.close()
+            except Exception:
+                pass
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        peer = writer.get_extra_info("peername") or "unix"
+        self.connections += 1
+        self.logger.write("INFO", "Клиент подключился (диспетчер)", extra=str(peer))
+
+        conn = AgentConnection(reader, writer)
+        upstreams: Dict[int, AgentConnection] = {}
+        relays: List[asyncio.Task] = []
+        routes: Dict[str, int] = {}
+        subscriptions: set = set()
+        local_tasks: set = set()
+
+        async def _upstream(worker_id: int) -> AgentConnection:
+            up = upstreams.get(worker_id)
+            if up is None:
+                up = await self._open_worker_connection(worker_id, conn)
+                upstreams[worker_id] = up
+                relays.append(asyncio.create_task(self._relay(up, conn)))
+            return up
+
+        async def _reply_local(request: Dict[str, Any]) -> None:
+            action = request.get("action")
+            try:
+                if action == "ping":
+                    payload: Dict[str, Any] = {"type": "pong"}
+                elif action == "list_sessions":
+                    payload = await self.aggregate_sessions(request.get("since_version"))
+                else:
+                    payload = await self.aggregate_stats()
+            except Exception as e:
+                self.logger.write("WARN", "Ошибка локального запроса диспетчера", extra=f"action={action} err={e}")
+                payload = {"type": "error", "message": str(e)}
+            if request.get("id") is not None:
+                payload["id"] = request["id"]
+            await conn.send(payload)
+
+        try:
+            while True:
+                try:
+                    request = await conn.recv()
+                except ValueError:
+                    await conn.send({"type": "error", "message": "Invalid JSON"})
+                    continue
+
+                if request is None:
+                    break
+
+                action = request.get("action")
+
+                if action == "hello":
+                    codec = choose_codec(request.get("framing"))
+                    if codec is None or upstreams:
+                        await conn.send({"type": "hello", "framing": "lines"})
+                    else:
+                        await conn.send({"type": "hello", "framing": "frames", "codec": codec})
+                        conn.use_frames(codec)
+                    continue
+
+                if action in self.LOCAL_ACTIONS:
+                    task = asyncio.create_task(_reply_local(request))
+                    local_tasks.add(task)
+                    task.add_done_callback(local_tasks.discard)
+                    continue
+
+                if action == "subscribe" or (
+                    action == "cancel" and str(request.get("target_id") or "") in subscriptions
+                ):
+                    # события идут от всех воркеров: подписка (и её отмена) — в каждый
+                    if action == "subscribe":
+                        subscriptions.add(str(request.get("id") or ""))
+                    else:
+                        subscriptions.discard(str(request.get("target_id") or ""))
+                    for i in range(self.workers):
+                        up = await _upstream(i)
+                        await up.send(request)
+                    continue
+
+                if action == "cancel":
+                    worker_id = routes.pop(str(request.get("target_id") or ""), None)
+                    if worker_id is None:
+                        continue
+                else:
+                    worker_id = self.worker_for((request.get("session_id") or "").strip())
+
+                    request_id = request.get("id")
+                    if action == "stream_chat" and request_id is not None:
+                        routes[str(request_id)] = worker_id
+                        # таблица нужна только для cancel: старые записи выкидываем
+                        while len(routes) > 1000:
+                            routes.pop(next(iter(routes)))
+
+                self.routed[worker_id] += 1
+                up = await _upstream(worker_id)
+                await up.send(request)
+
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+
+        except ProtocolError as e:
+            self.logger.write("WARN", "Ошибка протокола, соединение закрыто", extra=str(e))
+
+        except Exception as e:
+            self.logger.write("ERROR", "Ошибка диспетчера", extra=str(e))
+
+        finally:
+            # закрываем соединения к воркерам: они сами отменят незавершённые запросы
+            for up in upstreams.values():
+                await up.close()
+            for t in relays + list(local_tasks):
+                t.cancel()
+            await asyncio.gather(*relays, *local_tasks, return_exceptions=True)
+
+            await conn.close()
+            self.connections -= 1
+            self.logger.write("INFO", "Клиент отключился (диспетчер)", extra=str(peer))
+
+    async def aggregate_sessions(self, since_version: Optional[str]) -> Dict[str, Any]:
+        """
+        list_sessions по всем воркерам: каждый отдаёт дельту только своих сессий,
+        версия супервизора склеена из версий воркеров.
+        """
+        tokens: List[Optional[str]] = [None] * self.workers
+        if isinstance(since_version, str):
+            parts = since_version.split(self.CATALOG_TOKEN_SEP)
+            if len(parts) == self.workers:
+                tokens = [p or None for p in parts]
+
+        async def _one(i: int, token: Optional[str]) -> Dict[str, Any]:
+            return await self._stats_clients[i].list_sessions_delta(token, shard=(i, self.workers))
+
+        results = list(await asyncio.gather(*(_one(i, tokens[i]) for i in range(self.workers))))
+
+        # хотя бы один воркер отдал полный список (перезапуск воркера) -> клиент заменит
+        # каталог целиком, значит и от остальных нужен полный список
+        full = any(r["full"] for r in results)
+        if full:
+            for i, r in enumerate(results):
+                if not r["full"]:
+                    results[i] = await _one(i, None)
+
+        sessions: List[Dict[str, Any]] = []
+        deleted: List[str] = []
+        for r in results:
+            sessions.extend(r["sessions"])
+            deleted.extend(r["deleted"])
+        sessions.sort(key=lambda e: e.get("updated_at") or "", reverse=True)
+
+        return {
+            "type": "sessions",
+            "version": self.CATALOG_TOKEN_SEP.join(str(r["version"] or "") for r in results),
+            "full": full,
+            "sessions": sessions,
+            "deleted": [] if full else deleted,
+        }
+
+    async def aggregate_stats(self) -> Dict[str, Any]:
+        """server_stats всех воркеров + суммы + статистика самого диспетчера."""
+        results = await asyncio.gather(
+            *(c.server_stats() for c in self._stats_clients),
+            return_exceptions=True,
+        )
+
+        per_worker = []
+        totals: Dict[str, float] = {}
+        for i, res in enumerate(results):
+            item: Dict[str, Any] = {
+                "worker_id": i,
+                "pid": getattr(self._procs[i], "pid", None),
+                "routed": int(self.routed[i]),
+            }
+            if isinstance(res, dict) and res:
+                sched = res.get("scheduler") or {}
+                item["scheduler"] = sched
+                for k in ("active", "queue_depth", "admitted", "queued_total", "rejected"):
+                    totals[k] = totals.get(k, 0) + int(sched.get(k) or 0)
+                totals["wait_max_ms"] = max(float(totals.get("wait_max_ms", 0.0)), float(sched.get("wait_max_ms") or 0.0))
+            else:
+                item["error"] = str(res) if isinstance(res, BaseException) else "no response"
+            per_worker.append(item)
+
+        return {
+            "type": "server_stats",
+            "supervisor": {
+                "workers": self.workers,
+                "connections": int(self.connections),
+                "worker_restarts": int(self.worker_restarts),
+            },
+            "scheduler": totals,
+            "workers": per_worker,
+        }
+
+    async def run(self) -> None:
+        self._stats_clients = [
+            AgentClient(host="127.0.0.1", port=self.worker_port(i), unix_path="")
+            for i in range(self.workers)
+        ]
+
+        for i in range(self.workers):
+            self._start_worker(i)
+
+        monitor = None
+        try:
+            ready = await asyncio.gather(*(self._wait_worker_ready(i) for i in range(self.workers)))
+            if not all(ready):
+                self.logger.write("WARN", "Не все воркеры ответили на ping", extra=str(ready))
+
+            monitor = asyncio.create_task(self._monitor_workers())
+
+            servers = await start_listeners(self.handle_client, self.host, self.port, unix_path=self.unix_path)
+            addrs = listener_names(servers)
+            self.logger.write("INFO", "Супервизор запущен и слушает", extra=f"{addrs} workers={self.workers}")
+
+            try:
+                await asyncio.gather(*(server.serve_forever() for server in servers))
+            finally:
+                close_listeners(servers, unix_path=self.unix_path)
+        finally:
+            if monitor is not None:
+                monitor.cancel()
+            for c in self._stats_clients:
+                await c.close()
+            self._stop_workers()
@@ -0,0 +1,112 @@
+import asyncio
+import sys
+sys.dont_write_bytecode = True
+
+from typing import Awaitable, Callable, List, Optional
+
+
+class ChunkCoalescer:
+    """
+    Склеивает мелкие дельты апстрима перед отправкой в UI.
+
+    - первый чанк уходит сразу, чтобы не ухудшать TTFT;
+    - дальше чанки копятся и уходят одним кадром, когда прошло flush_ms
+      с момента первого чанка в буфере или набралось max_bytes байт;
+    - flush_ms <= 0 отключает склейку (каждый чанк уходит как есть).
+    """
+
+    def __init__(
+        self,
+        send: Callable[[str], Awaitable[None]],
+        *,
+        flush_ms: float = 30.0,
+        max_bytes: int = 2048,
+    ):
+        self._send = send
+        self.flush_sec = max(float(flush_ms), 0.0) / 1000.0
+        self.max_bytes = max(int(max_bytes), 1)
+
+        self._buf: List[str] = []
+        self._buf_bytes = 0
+        self._lock = asyncio.Lock()
+        self._timer: Optional[asyncio.Task] = None
+        self._error: Optional[BaseException] = None
+
+        self.chunks_in = 0
+        self.frames_out = 0
+
+    @property
+    def merged(self) -> int:
+        """Сколько кадров сэкономлено склейкой."""
+        return max(self.chunks_in - self.frames_out, 0)
+
+    def _raise_pending_error(self) -> None:
+        if self._error is not None:
+            err, self._error = self._error, None
+            raise err
+
+    async def _emit(self, text: str) -> None:
+        self.frames_out += 1
+        await self._send(text)
+
+    async def add(self, chunk: str) -> None:
+        self._raise_pending_error()
+        if not chunk:
+            return
+
+        self.chunks_in += 1
+
+        if self.flush_sec <= 0 or (self.frames_out == 0 and not self._buf):
+            async with self._lock:
+                await self._emit(chunk)
+            return
+
+        self._buf.append(chunk)
+        self._buf_bytes += len(chunk.encode("utf-8"))
+
+        if self._buf_bytes >= self.max_bytes:
+            await self.flush()
+            return
+
+        if self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        try:
+            await asyncio.sleep(self.flush_sec)
+        except asyncio.CancelledError:
+            return
+
+        self._timer = None
+        try:
+            await self.flush()
+        except Exception as e:
+            # отдадим ошибку в следующий add()/close()
+            self._error = e
+
+    def _cancel_timer(self) -> None:
+        timer, self._timer = self._timer, None
+        if timer is not None and timer is not asyncio.current_task():
+            timer.cancel()
+
+    async def flush(self) -> None:
+        self._cancel_timer()
+
+        async with self._lock:
+            if not self._buf:
+                return
+            text = "".join(self._buf)
+            self._buf = []
+            self._buf_bytes = 0
+            await self._emit(text)
+
+    async def close(self) -> None:
+        """Дослать хвост буфера (конец стрима)."""
+        await self.flush()
+        self._raise_pending_error()
+
+    def cancel(self) -> None:
+        """Бросить буфер без отправки (ошибка / отмена стрима)."""
+        self._cancel_timer()
+        self._buf = []
+        self._buf_bytes = 0
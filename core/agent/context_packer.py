@@ -0,0 +1,194 @@
+import sys
+sys.dont_write_bytecode = True
+
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from core.agent.token_counter import MESSAGE_OVERHEAD, TokenCounter
+
+
+@dataclass
+class PackedContext:
+    # хвост для LLM по порядку: {"role", "content", "tokens", "turn_id"}
+    messages: List[Dict[str, Any]] = field(default_factory=list)
+    # сообщения старше хвоста, ещё не вошедшие в выжимку (по порядку)
+    aged_out: List[Dict[str, Any]] = field(default_factory=list)
+    # сырые токены хвоста вместе со служебными токенами сообщений
+    tokens: int = 0
+    # хвост упёрся в бюджет токенов (а не в лимит сообщений или начало истории)
+    over_budget: bool = False
+    # сколько сообщений обрезано посередине
+    truncated: int = 0
+    # turn'ы, чьи токены пришлось посчитать заново: их кэш ещё не на диске
+    # (сохраняется только то, что помечено bump_turn_version)
+    recounted: List[str] = field(default_factory=list)
+
+
+class ContextPacker:
+    """
+    Хвост истории под бюджет токенов: turn'ы берутся от новых к старым, пока помещаются.
+
+    Размеры turn'ов считаются один раз и хранятся в самом turn'е ("tokens"), поэтому
+    упаковка проходит только хвост и ещё не суммаризированные turn'ы, а не всю историю.
+    turn'ы в history лежат по возрастанию номера — так их дописывает сервер.
+
+    Если самый свежий turn сам не влезает (вставили огромный лог), его сообщения
+    режутся посередине: начало и конец обычно важнее середины.
+    """
+
+    # меньше этого в остатке бюджета — сообщение не режем, а не берём вовсе
+    MIN_TRUNCATED_TOKENS = 64
+    TRUNCATION_MARK = "\n\n[... пропущено ~{n} токенов ...]\n\n"
+
+    def __init__(self, counter: TokenCounter):
+        self.counter = counter
+        self.packed = 0
+        self.turns_visited = 0
+        self.truncated = 0
+
+    def turn_tokens(self, turn: Dict[str, Any], model: str) -> Dict[str, Any]:
+        """
+        Токены user/assistant одного turn'а. Считаются один раз и хранятся в самом turn'е
+        ("tokens"); пересчёт — только если сменился счётчик (другой словарь BPE, появился tiktoken).
+        """
+        counter_id = self.counter.counter_id(model)
+        cached = turn.get("tokens")
+        if isinstance(cached, dict) and cached.get("counter") == counter_id:
+            return cached
+
+        cached = {
+            "counter": counter_id,
+            "user": self.counter.count(turn.get("user_text") or "", model),
+            "assistant": self.counter.count(turn.get("assistant_text") or "", model),
+        }
+        turn["tokens"] = cached
+        return cached
+
+    def turn_messages(self, turn_id: str, turn: Dict[str, Any], model: str) -> List[Dict[str, Any]]:
+        tokens = self.turn_tokens(turn, model)
+        out = []
+        for role, text_key in (("user", "user_text"), ("assistant", "assistant_text")):
+            text = turn.get(text_key)
+            if isinstance(text, str) and text:
+                out.append({"role": role, "content": text, "tokens": int(tokens.get(role) or 0), "turn_id": turn_id})
+        return out
+
+    def pack(
+        self,
+        history: Dict[str, Any],
+        *,
+        model: str,
+        budget: int,
+        max_messages: int = 0,
+        summary_upto: Optional[int] = None,
+    ) -> PackedContext:
+        """
+        budget — сырые токены на хвост (без выжимки и нового сообщения).
+        max_messages > 0 — ещё и лимит по числу сообщений (turn'ы берутся целиком).
+        summary_upto — до какого turn'а дошла выжимка (None — выжимки с отметкой нет,
+        тогда в aged_out попадает вся старая часть).
+        """
+        self.packed += 1
+        packed = PackedContext()
+        tail_rev: List[List[Dict[str, Any]]] = []
+        aged_rev: List[List[Dict[str, Any]]] = []
+        filling = True
+        n_msgs = 0
+
+        for key in reversed(history):
+            try:
+                tid = int(key)
+            except (TypeError, ValueError):
+                continue
+            if not filling and summary_upto is not None and tid <= summary_upto:
+                break
+
+            turn = history.get(key)
+            if not isinstance(turn, dict):
+                continue
+            self.turns_visited += 1
+            cached = turn.get("tokens")
+            msgs = self.turn_messages(key, turn, model)
+            if turn.get("tokens") is not cached:
+                packed.recounted.append(key)
+            if not msgs:
+                continue
+
+            if filling:
+                cost = sum(m["tokens"] + MESSAGE_OVERHEAD for m in msgs)
+                room_msgs = max_messages <= 0 or n_msgs < max_messages
+                if room_msgs and packed.tokens + cost <= budget:
+                    tail_rev.append(msgs)
+                    packed.tokens += cost
+                    n_msgs += len(msgs)
+                    continue
+
+                if room_msgs:
+                    packed.over_budget = True
+                    if not tail_rev:
+                        fitted = self._fit_turn(msgs, budget, model)
+                        if fitted is not None:
+                            tail_rev.append(fitted)
+                            packed.tokens += sum(m["tokens"] + MESSAGE_OVERHEAD for m in fitted)
+                            packed.truncated += sum(1 for m in fitted if m.get("truncated"))
+                            n_msgs += len(fitted)
+                            continue
+                filling = False
+
+            if summary_upto is None or tid > summary_upto:
+                aged_rev.append(msgs)
+
+        packed.messages = [m for msgs in reversed(tail_rev) for m in msgs]
+        packed.aged_out = [m for msgs in reversed(aged_rev) for m in msgs]
+        self.truncated += packed.truncated
+        return packed
+
+    def _fit_turn(self, msgs: List[Dict[str, Any]], room: int, model: str) -> Optional[List[Dict[str, Any]]]:
+        """Ужать turn до room токенов; меньшее из сообщений остаётся целым, если влезает."""
+        content_room = room - MESSAGE_OVERHEAD * len(msgs)
+        if content_room < self.MIN_TRUNCATED_TOKENS * len(msgs):
+            return None
+
+        if len(msgs) == 1:
+            targets = [content_room]
+        else:
+            a, b = msgs[0]["tokens"], msgs[1]["tokens"]
+            half = content_room // 2
+            if a <= half:
+                targets = [a, content_room - a]
+            elif b <= half:
+                targets = [content_room - b, b]
+            else:
+                targets = [half, content_room - half]
+
+        out = []
+        for msg, target in zip(msgs, targets):
+            out.append(msg if msg["tokens"] <= target else self.truncate_middle(msg, target, model))
+        return out
+
+    def truncate_middle(self, msg: Dict[str, Any], target: int, model: str) -> Dict[str, Any]:
+        """Сообщение, урезанное посередине до ~target токенов (начало и конец сохраняются)."""
+        text = msg["content"]
+        tokens = max(int(msg["tokens"]), 1)
+        keep_chars = int(len(text) * target / tokens)
+        cut, n = text, tokens
+
+        # доля символов на токен в начале/конце может отличаться от средней — пара уточнений
+        for _ in range(3):
+            head = keep_chars // 2
+            tail = keep_chars - head
+            mark = self.TRUNCATION_MARK.format(n=max(tokens - target, 0))
+            cut = text[:head] + mark + (text[len(text) - tail:] if tail > 0 else "")
+            n = self.counter.count(cut, model)
+            if n <= target:
+                break
+            keep_chars = max(int(keep_chars * target / n * 0.95), 0)
+
+        return {**msg, "content": cut, "tokens": int(n), "truncated": True}
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "packed": self.packed,
+            "turns_visited": self.turns_visited,
+            "truncated": self.truncated,
+        }
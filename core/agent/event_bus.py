@@ -0,0 +1,94 @@
+import asyncio
+import sys, time
+sys.dont_write_bytecode = True
+
+from typing import Any, Dict, Optional
+
+
+class Subscription:
+    """
+    Очередь событий одного подписчика (action=subscribe).
+
+    Если подписчик не успевает читать и очередь переполнилась, события
+    выбрасываются, а следующим подписчик получит "resync": пусть перечитает
+    состояние (list_sessions и т.п.) целиком.
+    """
+
+    def __init__(self, max_events: int = 1000):
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max(int(max_events), 1))
+        self._overflow = False
+
+        self.delivered = 0
+        self.dropped = 0
+
+    def put(self, event: Dict[str, Any]) -> None:
+        if self._overflow:
+            self.dropped += 1
+            return
+        try:
+            self._queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self._overflow = True
+            self.dropped += 1
+
+    async def next(self, timeout: float) -> Optional[Dict[str, Any]]:
+        """Следующее событие или None, если за timeout ничего не было (время для heartbeat)."""
+        if self._overflow:
+            self._overflow = False
+            while not self._queue.empty():
+                self._queue.get_nowait()
+            return {"event": "resync"}
+
+        try:
+            event = await asyncio.wait_for(self._queue.get(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return None
+
+        self.delivered += 1
+        return event
+
+
+class EventBus:
+    """
+    Push-события агента для UI: session_created / session_updated / session_deleted,
+    summary_updated, pricing_reloaded, server_draining (+ heartbeat от самой подписки).
+
+    publish() синхронный и не ждёт подписчиков — его можно звать откуда угодно в цикле событий.
+    """
+
+    def __init__(self, max_events_per_subscriber: int = 1000):
+        self.max_events_per_subscriber = max_events_per_subscriber
+        self._subscribers: Dict[int, Subscription] = {}
+        self._next_id = 0
+
+        self.published = 0
+
+    @property
+    def subscribers(self) -> int:
+        return len(self._subscribers)
+
+    def subscribe(self) -> int:
+        self._next_id += 1
+        self._subscribers[self._next_id] = Subscription(self.max_events_per_subscriber)
+        return self._next_id
+
+    def get(self, sub_id: int) -> Subscription:
+        return self._subscribers[sub_id]
+
+    def unsubscribe(self, sub_id: int) -> None:
+        self._subscribers.pop(sub_id, None)
+
+    def publish(self, event: str, **data: Any) -> None:
+        payload = {"event": event, "ts": time.time()}
+        payload.update(data)
+
+        self.published += 1
+        for sub in list(self._subscribers.values()):
+            sub.put(payload)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "subscribers": self.subscribers,
+            "published": int(self.published),
+            "dropped": int(sum(s.dropped for s in self._subscribers.values())),
+        }
@@ -1,190 +1,212 @@
 import os, sys
 sys.dont_write_bytecode = True
 
-import json
-from dataclasses import dataclass
+import uuid
 from datetime import datetime
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from core.agent.session_cache import SessionCache
+from core.agent.session_storage import SessionBackend, SessionInfo, open_backend
 
 
 def _now_iso() -> str:
     return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
 
-@dataclass
-class SessionInfo:
-    session_id: str
-    title: str
-    created_at: str
-    updated_at: str
-    file_path: str
-
-
 class AgentMemoryStore:
-    def __init__(self, base_dir: str):
+    # сколько удалений помнить для дельт list_sessions (старше — клиент получит полный список)
+    MAX_TOMBSTONES = 1000
+
+    def __init__(self, base_dir: str, backend: Optional[str] = None, cache: Optional[SessionCache] = None):
         self.base_dir = base_dir
         os.makedirs(self.base_dir, exist_ok=True)
 
-    def _safe_id(self, session_id: str) -> str:
-        return "".join(ch for ch in session_id if ch.isalnum() or ch in ("-", "_"))
+        # где лежат сессии: json (файл на сессию, по умолчанию) или sqlite (см. session_storage)
+        self.backend: SessionBackend = open_backend(backend or "json", self.base_dir)
 
-    def _session_file_path_today(self, session_id: str) -> str:
-        day = datetime.now().strftime("%Y%m%d")
-        safe_id = self._safe_id(session_id)
-        # ВАЖНО: memmory — как у тебя было
-        return os.path.join(self.base_dir, f"{safe_id}_memmory{day}.json")
+        # горячие сессии в памяти; с кэшем save_session только помечает сессию грязной,
+        # на диск её пишет flush() (сервер зовёт его по таймеру и при остановке)
+        self.cache = cache
+        self.flush_stats: Dict[str, int] = {"flushes": 0, "written": 0, "errors": 0}
 
-    def _find_latest_file_for_session(self, session_id: str) -> Optional[str]:
-        safe_id = self._safe_id(session_id)
-        candidates: List[str] = []
+        # --- каталог сессий в памяти: один проход по папке при первом запросе,
+        #     дальше обновляется в save_session/delete_session_file.
+        #     Каждое изменение получает номер версии каталога -> list_sessions отдаёт дельты.
+        self._catalog: Optional[Dict[str, Dict[str, Any]]] = None
+        self._catalog_version = 0
+        # новая эпоха на каждый запуск: версии клиента от прошлого процесса недействительны
+        self._catalog_epoch = uuid.uuid4().hex[:12]
+        self._tombstones: Dict[str, int] = {}
+        self._tombstones_floor = 0
 
-        try:
-            for name in os.listdir(self.base_dir):
-                if name.startswith(f"{safe_id}_memmory") and name.endswith(".json"):
-                    candidates.append(os.path.join(self.base_dir, name))
-        except Exception:
-            return None
+        # on_change(event, data): session_created / session_updated / session_deleted
+        self.on_change: Optional[Callable[[str, Dict[str, Any]], None]] = None
 
-        if not candidates:
-            return None
+    def list_sessions(self) -> List[SessionInfo]:
+        return self.backend.list_sessions()
+
+    def storage_stats(self) -> Dict[str, Any]:
+        return self.backend.stats()
+
+    # ====== каталог (дельты list_sessions) ======
+
+    @property
+    def catalog_ready(self) -> bool:
+        return self._catalog is not None
+
+    def prime_catalog(self, infos: Optional[List[SessionInfo]] = None) -> None:
+        """
+        Построить каталог заранее, чтобы не платить за проход по хранилищу в первом запросе.
+        infos — готовый list_sessions() (его можно получить в другом потоке); уже построенный
+        каталог не трогаем: в нём могут быть изменения, которых нет в infos.
+        """
+        if self._catalog is None:
+            self._catalog = self._catalog_from(self.list_sessions() if infos is None else infos)
+
+    def _ensure_catalog(self) -> Dict[str, Dict[str, Any]]:
+        if self._catalog is None:
+            self._catalog = self._catalog_from(self.list_sessions())
+        return self._catalog
+
+    @staticmethod
+    def _catalog_from(infos: List[SessionInfo]) -> Dict[str, Dict[str, Any]]:
+        return {
+            info.session_id: {
+                "session_id": info.session_id,
+                "title": info.title,
+                "created_at": info.created_at,
+                "updated_at": info.updated_at,
+                "version": 0,
+            }
+            for info in infos
+        }
 
+    def _emit(self, event: str, data: Dict[str, Any]) -> None:
+        if self.on_change is None:
+            return
         try:
-            candidates.sort(key=lambda p: os.path.getmtime(p), reverse=True)
+            self.on_change(event, data)
         except Exception:
             pass
 
-        return candidates[0]
+    def _catalog_touch(self, session: Dict[str, Any]) -> None:
+        if self._catalog is None:
+            return
 
-    def list_sessions(self) -> List[SessionInfo]:
-        sessions: Dict[str, SessionInfo] = {}
+        session_id = (session.get("session_id") or "").strip()
+        entry = {
+            "session_id": session_id,
+            "title": (session.get("title") or "").strip(),
+            "created_at": session.get("created_at") or "",
+            "updated_at": session.get("updated_at") or "",
+        }
 
-        try:
-            for name in os.listdir(self.base_dir):
-                if not (name.endswith(".json") and "_memmory" in name):
-                    continue
-
-                path = os.path.join(self.base_dir, name)
-
-                try:
-                    with open(path, "r", encoding="utf-8") as f:
-                        data = json.load(f)
-                except Exception:
-                    continue
-
-                session_id = (data.get("session_id") or "").strip()
-                if not session_id:
-                    continue
-
-                title = (data.get("title") or "").strip()
-                created_at = data.get("created_at") or ""
-                updated_at = data.get("updated_at") or ""
-
-                info = SessionInfo(
-                    session_id=session_id,
-                    title=title,
-                    created_at=created_at,
-                    updated_at=updated_at,
-                    file_path=path,
-                )
-
-                if session_id not in sessions:
-                    sessions[session_id] = info
-                else:
-                    try:
-                        if os.path.getmtime(path) > os.path.getmtime(sessions[session_id].file_path):
-                            sessions[session_id] = info
-                    except Exception:
-                        sessions[session_id] = info
-        except Exception:
-            return []
+        old = self._catalog.get(session_id)
+        if old is not None and all(old.get(k) == v for k, v in entry.items()):
+            return
 
-        result = list(sessions.values())
-        try:
-            result.sort(key=lambda s: s.updated_at or "", reverse=True)
-        except Exception:
-            pass
+        self._catalog_version += 1
+        entry["version"] = self._catalog_version
+        self._catalog[session_id] = entry
+        self._tombstones.pop(session_id, None)
+
+        public = {k: v for k, v in entry.items() if k != "version"}
+        self._emit("session_created" if old is None else "session_updated", {"session": public})
+
+    def _catalog_remove(self, session_id: str) -> None:
+        if self._catalog is None or session_id not in self._catalog:
+            return
+
+        self._catalog.pop(session_id, None)
+        self._catalog_version += 1
+        self._tombstones[session_id] = self._catalog_version
+
+        if len(self._tombstones) > self.MAX_TOMBSTONES:
+            oldest = min(self._tombstones, key=self._tombstones.get)
+            self._tombstones_floor = self._tombstones.pop(oldest)
 
-        return result
+        self._emit("session_deleted", {"session_id": session_id})
+
+    def catalog_token(self) -> str:
+        """Непрозрачная для клиента версия каталога."""
+        return f"{self._catalog_epoch}:{self._catalog_version}"
+
+    def _parse_catalog_token(self, token: Any) -> Optional[int]:
+        if not isinstance(token, str) or ":" not in token:
+            return None
+        epoch, _, raw = token.partition(":")
+        if epoch != self._catalog_epoch:
+            return None
+        try:
+            version = int(raw)
+        except ValueError:
+            return None
+        if version < self._tombstones_floor or version > self._catalog_version:
+            return None
+        return version
+
+    def list_sessions_delta(self, since: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Каталог сессий относительно версии клиента.
+
+        since валиден -> только созданные/изменённые ("sessions") и удалённые ("deleted");
+        иначе (первый запрос, перезапуск агента, слишком старая версия) — полный список, full=True.
+        """
+        catalog = self._ensure_catalog()
+        since_version = self._parse_catalog_token(since)
+        full = since_version is None
+
+        if full:
+            changed = list(catalog.values())
+            deleted: List[str] = []
+        else:
+            changed = [e for e in catalog.values() if int(e.get("version") or 0) > since_version]
+            deleted = [sid for sid, v in self._tombstones.items() if v > since_version]
+
+        changed.sort(key=lambda e: e.get("updated_at") or "", reverse=True)
+
+        return {
+            "version": self.catalog_token(),
+            "full": full,
+            "sessions": [{k: e[k] for k in ("session_id", "title", "created_at", "updated_at")} for e in changed],
+            "deleted": deleted,
+        }
 
     def load_session(self, session_id: str) -> Dict[str, Any]:
-        path = self._find_latest_file_for_session(session_id)
+        data = self.cached_session(session_id)
+        if data is not None:
+            return data
 
-        if path and os.path.exists(path):
-            try:
-                with open(path, "r", encoding="utf-8") as f:
-                    data = json.load(f)
-
-                if isinstance(data, dict) and data.get("session_id") == session_id:
-                    data["file_path"] = path
-
-                    # --- миграция старого формата messages -> history
-                    if "history" not in data:
-                        old_messages = data.get("messages")
-                        if isinstance(old_messages, list):
-                            history: Dict[str, Any] = {}
-                            idx = 0
-                            pending_user = None
-
-                            for m in old_messages:
-                                role = (m.get("role") or "").strip()
-                                content = m.get("content")
-
-                                if role == "user" and isinstance(content, str):
-                                    pending_user = {"text": content, "ts": m.get("ts")}
-                                elif role == "assistant" and isinstance(content, str):
-                                    if pending_user is None:
-                                        pending_user = {"text": "", "ts": m.get("ts")}
-                                    idx += 1
-                                    history[str(idx)] = {
-                                        "ts": pending_user.get("ts"),
-                                        "user_text": pending_user.get("text") or "",
-                                        "assistant_text": content,
-                                        "model": None,
-                                        "endpoint": None,
-                                        "usage": {},
-                                        "cost_rub": None,
-                                        "r_prompt_total": 0,
-                                        "c_completion": 0,
-                                        "total_tokens_call": 0,
-                                        "r_prev_prompt_total": 0,
-                                        "current_message_tokens": 0,
-                                    }
-                                    pending_user = None
-
-                            if pending_user is not None:
-                                idx += 1
-                                history[str(idx)] = {
-                                    "ts": pending_user.get("ts"),
-                                    "user_text": pending_user.get("text") or "",
-                                    "assistant_text": "",
-                                    "model": None,
-                                    "endpoint": None,
-                                    "usage": {},
-                                    "cost_rub": None,
-                                    "r_prompt_total": 0,
-                                    "c_completion": 0,
-                                    "total_tokens_call": 0,
-                                    "r_prev_prompt_total": 0,
-                                    "current_message_tokens": 0,
-                                }
-
-                            data["history"] = history
-                            data.pop("messages", None)
-
-                    if not isinstance(data.get("history"), dict):
-                        data["history"] = {}
-
-                    # --- NEW: гарантируем наличие history_summary
-                    if "history_summary" not in data:
-                        data["history_summary"] = ""
-                    if not isinstance(data.get("history_summary"), str):
-                        data["history_summary"] = ""
-
-                    return data
-            except Exception:
-                pass
+        data, evicted = self.adopt_loaded(session_id, self.backend.load(session_id))
+        self._write_now(evicted)
+        return data
 
-        # --- если сессии нет, создаём новую
+    # --- части load_session/save_session без дискового I/O: ими пользуется SessionIO,
+    #     который выполняет сами чтения и записи в пуле потоков
+
+    def cached_session(self, session_id: str) -> Optional[Dict[str, Any]]:
+        return self.cache.get(session_id) if self.cache is not None else None
+
+    def adopt_loaded(
+        self, session_id: str, data: Optional[Dict[str, Any]]
+    ) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+        """
+        Принять результат backend.load: положить в кэш или создать новую сессию.
+        Возвращает (сессия, вытесненные грязные — их надо записать сразу).
+        """
+        if data is None:
+            return self.new_session(session_id), []
+
+        if self.cache is None:
+            return data, []
+        # пока читали с диска, сессию мог положить в кэш другой запрос — она новее
+        cached = self.cache.peek(session_id)
+        if cached is not None:
+            return cached, []
+        # чистая сессия не вытеснит грязных без записи: вытесненные грязные отдаём на запись
+        return data, self.cache.put(session_id, data)
+
+    def new_session(self, session_id: str) -> Dict[str, Any]:
         created_at = _now_iso()
         data = {
             "session_id": session_id,
@@ -193,29 +215,153 @@ class AgentMemoryStore:
             "updated_at": created_at,
             "history": {},
             "history_summary": "",  # NEW
-            "file_path": self._session_file_path_today(session_id),
+            "history_summary_upto": 0,  # последний turn, вошедший в history_summary
+            "version": 0,
         }
+        location = self.backend.new_location(session_id)
+        if location is not None:
+            data["file_path"] = location
         return data
 
+    def bump_turn_version(self, session: Dict[str, Any], turn_id: str) -> int:
+        """
+        Увеличить версию сессии и пометить ею turn (новый или изменённый).
+        По версии клиент догружает только то, что изменилось (get_session since_version).
+        """
+        version = int(session.get("version") or 0) + 1
+        session["version"] = version
+
+        history = session.get("history")
+        if isinstance(history, dict) and isinstance(history.get(turn_id), dict):
+            history[turn_id]["version"] = version
+        return version
+
+    def load_session_page(self, session_id: str, **page_params: Any) -> Dict[str, Any]:
+        """Страница сессии (параметры как у session_page): индексным запросом, если бэкенд умеет."""
+        # горячая сессия в памяти может быть новее диска
+        cached = self.cache.peek(session_id) if self.cache is not None else None
+        page = self.backend.load_page(session_id, **page_params) if cached is None else None
+        if cached is not None:
+            page = self.session_page(cached, **page_params)
+        elif page is None:
+            page = self.session_page(self.load_session(session_id), **page_params)
+        return page
+
+    def session_page(
+        self,
+        session: Dict[str, Any],
+        from_turn: Optional[int] = None,
+        limit: Optional[int] = None,
+        fields: Optional[List[str]] = None,
+        since_version: Optional[int] = None,
+    ) -> Dict[str, Any]:
+        """
+        Часть сессии для UI:
+        - since_version: только turn'ы, изменённые после этой версии;
+        - from_turn: номер первого turn (с 1), limit: сколько turn'ов;
+          limit без from_turn — последние limit turn'ов;
+        - fields: какие поля turn отдавать ("version" отдаётся всегда).
+        """
+        history = session.get("history") or {}
+        if not isinstance(history, dict):
+            history = {}
+
+        try:
+            keys = sorted(history.keys(), key=lambda x: int(x))
+        except Exception:
+            keys = list(history.keys())
+
+        version = int(session.get("version") or 0)
+
+        # версия клиента из "будущего" -> сессию пересоздали (reset), отдаём как с нуля
+        reset = since_version is not None and since_version > version
+        if since_version is not None and not reset:
+            keys = [k for k in keys if int((history.get(k) or {}).get("version") or 0) > since_version]
+
+        turns_total = len(keys)
+
+        if from_turn is not None:
+            start = 0
+            while start < len(keys) and int(keys[start]) < from_turn:
+                start += 1
+            keys = keys[start:]
+            if limit is not None:
+                keys = keys[:max(limit, 0)]
+        elif limit is not None:
+            keys = keys[-limit:] if limit > 0 else []
+
+        page_history: Dict[str, Any] = {}
+        for k in keys:
+            turn = history.get(k) or {}
+            if fields is not None:
+                turn = {f: turn[f] for f in fields if f in turn}
+                turn["version"] = int((history.get(k) or {}).get("version") or 0)
+            page_history[k] = turn
+
+        first_turn = int(keys[0]) if keys else None
+        has_older = False
+        if first_turn is not None and since_version is None:
+            try:
+                has_older = any(int(k) < first_turn for k in history.keys())
+            except Exception:
+                has_older = False
+
+        return {
+            "session_id": session.get("session_id"),
+            "title": session.get("title") or "",
+            "created_at": session.get("created_at") or "",
+            "updated_at": session.get("updated_at") or "",
+            "history_summary": session.get("history_summary") or "",
+            "history_summary_upto": session.get("history_summary_upto"),
+            "version": version,
+            "history": page_history,
+            "page": {
+                "turns_total": int(turns_total),
+                "first_turn": first_turn,
+                "last_turn": int(keys[-1]) if keys else None,
+                "has_older": bool(has_older),
+                "since_version": since_version,
+                "reset": bool(reset),
+            },
+        }
+
     def delete_session_file(self, session_id: str) -> bool:
-        path = self._find_latest_file_for_session(session_id)
-        if not path:
-            return False
         try:
-            if os.path.exists(path):
-                os.remove(path)
-            return True
+            cached = self.forget_session(session_id)
+            return self.finish_delete(session_id, self.backend.delete(session_id) or cached)
         except Exception:
             return False
 
+    def forget_session(self, session_id: str) -> bool:
+        """Убрать сессию из кэша перед удалением; True — она там была (могла ещё не дойти до диска)."""
+        if self.cache is None:
+            return False
+        cached = session_id in self.cache
+        self.cache.drop(session_id)
+        return cached
+
+    def finish_delete(self, session_id: str, deleted: bool) -> bool:
+        if deleted:
+            self._catalog_remove(session_id)
+        return bool(deleted)
+
     def save_session(self, session: Dict[str, Any]) -> str:
+        pending = self.stage_save(session)
+        if self.cache is None:
+            return self.backend.save(session)
+        self._write_now(pending)
+        return session.get("file_path") or ""
+
+    def stage_save(self, session: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """
+        Всё, что save_session делает в памяти: структура, кэш, каталог.
+        Возвращает сессии, которые надо записать на диск прямо сейчас:
+        без кэша — саму сессию, с кэшем — вытесненные грязные.
+        """
         session_id = (session.get("session_id") or "").strip()
         if not session_id:
             raise ValueError("session_id is required")
 
-        path = session.get("file_path") or self._session_file_path_today(session_id)
-        session["file_path"] = path
-
         # --- гарантируем структуру
         if "history" not in session or not isinstance(session.get("history"), dict):
             session["history"] = {}
@@ -223,10 +369,68 @@ class AgentMemoryStore:
         if "history_summary" not in session or not isinstance(session.get("history_summary"), str):
             session["history_summary"] = ""
 
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(session, f, ensure_ascii=False, indent=2)
-
-        return path
+        # каталог строим до записи: иначе новая сессия попадёт в него без события "создана"
+        self._ensure_catalog()
+
+        if self.cache is not None:
+            pending = self.cache.put(session_id, session, dirty=True)
+        else:
+            pending = [session]
+
+        self._catalog_touch(session)
+        return pending
+
+    @staticmethod
+    def detach(session: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Копия сессии для записи из другого потока: словари сессии и turn'ов свои,
+        строки общие (они неизменяемые). Цикл событий тем временем может менять оригинал.
+        """
+        history = session.get("history")
+        if isinstance(history, dict):
+            history = {k: dict(t) if isinstance(t, dict) else t for k, t in history.items()}
+        return {**session, "history": history}
+
+    def _write_now(self, sessions: List[Dict[str, Any]]) -> None:
+        for session in sessions:
+            self.backend.save(session)
+            self.flush_stats["written"] += 1
+
+    def take_dirty(self) -> List[Dict[str, Any]]:
+        """Грязные сессии для flush (пусто без кэша)."""
+        if self.cache is None:
+            return []
+        self.flush_stats["flushes"] += 1
+        return self.cache.take_dirty()
+
+    def flush_failed(self, session: Dict[str, Any]) -> None:
+        # не записали — останется грязной до следующего flush
+        if self.cache is not None:
+            self.cache.mark_dirty((session.get("session_id") or "").strip())
+        self.flush_stats["errors"] += 1
+
+    def flush(self) -> int:
+        """Записать все грязные сессии из кэша. Возвращает, сколько записано."""
+        written = 0
+        error: Optional[Exception] = None
+        for session in self.take_dirty():
+            try:
+                self.backend.save(session)
+                written += 1
+            except Exception as e:
+                # остальные пишем дальше
+                self.flush_failed(session)
+                error = e
+        self.flush_stats["written"] += written
+        self.backend.sync()
+        if error is not None:
+            raise error
+        return written
+
+    def cache_stats(self) -> Optional[Dict[str, Any]]:
+        if self.cache is None:
+            return None
+        return {**self.cache.stats(), **self.flush_stats}
 
     def set_title_if_empty(self, session: Dict[str, Any], user_text: str) -> None:
         title = (session.get("title") or "").strip()
@@ -0,0 +1,304 @@
+import asyncio
+import json, os, socket, stat, struct, sys
+sys.dont_write_bytecode = True
+
+from typing import Any, Callable, Dict, List, Optional
+
+try:
+    import msgpack  # опционально: pip install msgpack
+except ImportError:
+    msgpack = None
+
+
+# Старый режим: одна JSON-строка на сообщение, большие payload режутся на chunked_*
+MAX_LINE_BYTES = 60000
+# лимит readline(): старый сервер режет на части своего размера, а самые старые
+# ответы и запросы (длинный user_text) шли одной строкой — как было у клиента раньше
+READ_LIMIT_BYTES = 20_000_000
+
+# Новый режим: [4 байта длины, big-endian][тело в выбранном кодеке]
+FRAME_HEADER = struct.Struct(">I")
+MAX_FRAME_BYTES = 64 * 1024 * 1024
+
+
+# Локальный транспорт: путь Unix-сокета (UI и агент на одной машине). Пусто — только TCP.
+UNIX_SOCKET_ENV = "AGENT_UNIX_SOCKET"
+
+
+class ProtocolError(RuntimeError):
+    """Поток сообщений сломан (например, кадр больше лимита) — соединение надо закрывать."""
+
+
+def available_codecs() -> List[str]:
+    """Кодеки тела кадра в порядке предпочтения."""
+    codecs = []
+    if msgpack is not None:
+        codecs.append("msgpack")
+    codecs.append("json")
+    return codecs
+
+
+def choose_codec(offered: Any) -> Optional[str]:
+    if not isinstance(offered, list):
+        return None
+    for name in available_codecs():
+        if name in offered:
+            return name
+    return None
+
+
+def encode_body(codec: str, payload: Dict[str, Any]) -> bytes:
+    if codec == "msgpack":
+        return msgpack.packb(payload, use_bin_type=True)
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def decode_body(codec: str, body: bytes) -> Any:
+    if codec == "msgpack":
+        return msgpack.unpackb(body, raw=False)
+    return json.loads(body.decode("utf-8", errors="replace"))
+
+
+def unix_sockets_supported() -> bool:
+    return hasattr(socket, "AF_UNIX") and hasattr(asyncio, "start_unix_server")
+
+
+def default_unix_path() -> Optional[str]:
+    return (os.getenv(UNIX_SOCKET_ENV) or "").strip() or None
+
+
+def _remove_stale_socket(path: str) -> None:
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+async def start_listeners(
+    client_connected_cb: Callable,
+    host: str,
+    port: int,
+    unix_path: Optional[str] = None,
+) -> List[asyncio.AbstractServer]:
+    """
+    TCP-листенер (для удалённого UI) + Unix-сокет, если задан путь и ОС его поддерживает.
+    """
+    servers = [await asyncio.start_server(client_connected_cb, host, port, limit=READ_LIMIT_BYTES)]
+
+    if unix_path and unix_sockets_supported():
+        _remove_stale_socket(unix_path)
+        servers.append(
+            await asyncio.start_unix_server(client_connected_cb, path=unix_path, limit=READ_LIMIT_BYTES)
+        )
+        try:
+            os.chmod(unix_path, 0o600)
+        except OSError:
+            pass
+
+    return servers
+
+
+def close_listeners(servers: List[asyncio.AbstractServer], unix_path: Optional[str] = None) -> None:
+    for server in servers:
+        server.close()
+    if unix_path and unix_sockets_supported():
+        try:
+            _remove_stale_socket(unix_path)
+        except OSError:
+            pass
+
+
+def listener_names(servers: List[asyncio.AbstractServer]) -> str:
+    names = []
+    for server in servers:
+        for sock in server.sockets or []:
+            names.append(str(sock.getsockname()))
+    return ", ".join(names)
+
+
+async def open_agent_connection(
+    host: str,
+    port: int,
+    unix_path: Optional[str] = None,
+    timeout_sec: Optional[float] = None,
+) -> "AgentConnection":
+    """Подключение к агенту: сначала Unix-сокет (если задан), при неудаче — TCP."""
+    if unix_path and unix_sockets_supported():
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_unix_connection(path=unix_path, limit=READ_LIMIT_BYTES),
+                timeout=timeout_sec,
+            )
+            return AgentConnection(reader, writer, transport="unix")
+        except (OSError, asyncio.TimeoutError):
+            pass
+
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(host, port, limit=READ_LIMIT_BYTES),
+        timeout=timeout_sec,
+    )
+    return AgentConnection(reader, writer, transport="tcp")
+
+
+def _split_for_lines(text: str, max_bytes: int) -> List[str]:
+    """
+    Нарезать текст так, чтобы каждый кусок в виде JSON-строки занимал не больше max_bytes
+    байт UTF-8: кириллица — 2 байта на символ, экранирование (\\n, \\") — тоже длиннее символа.
+    """
+    max_bytes = max(int(max_bytes), 1000)
+    parts: List[str] = []
+    i = 0
+    while i < len(text):
+        size = max_bytes
+        while True:
+            part = text[i:i + size]
+            n = len(json.dumps(part, ensure_ascii=False).encode("utf-8"))
+            if n <= max_bytes or size <= 1:
+                break
+            size = max(int(size * max_bytes / n * 0.98), 1)
+        parts.append(part)
+        i += len(part)
+    return parts
+
+
+class AgentConnection:
+    """
+    Обёртка над (reader, writer) для обмена сообщениями UI <-> агент.
+
+    Соединение всегда начинается в режиме JSON-строк ("lines"). Клиент может
+    прислать {"action":"hello","framing":[кодеки]} — после ответа
+    {"type":"hello","framing":"frames","codec":...} обе стороны переходят
+    на кадры с префиксом длины ("frames"): никакого readline() и chunked_*.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, transport: str = "tcp"):
+        self.reader = reader
+        self.writer = writer
+        self.transport = transport
+
+        self.framing = "lines"
+        self.codec = "json"
+
+        self._write_lock = asyncio.Lock()
+
+    def use_frames(self, codec: str) -> None:
+        self.framing = "frames"
+        self.codec = codec
+
+    def is_closing(self) -> bool:
+        return self.writer.is_closing()
+
+    def _encode_lines(self, payload: Dict[str, Any]) -> List[bytes]:
+        """
+        Если payload слишком большой для одной строки readline() у клиента — шлём в несколько строк.
+
+        Протокол (все строки несут "id" исходного сообщения, если он был):
+        1) {"type":"chunked_start","orig_type":"session","chunks":N}
+        2) N строк {"type":"chunked_part","orig_type":"session","i":0..N-1,"data":"..."}
+        3) {"type":"chunked_end","orig_type":"session"}
+        """
+        text = json.dumps(payload, ensure_ascii=False)
+        raw = (text + "\n").encode("utf-8")
+
+        if len(raw) <= MAX_LINE_BYTES:
+            return [raw]
+
+        envelope: Dict[str, Any] = {"orig_type": payload.get("type")}
+        if "id" in payload:
+            envelope["id"] = payload["id"]
+
+        def _line(extra: Dict[str, Any]) -> bytes:
+            msg = dict(envelope)
+            msg.update(extra)
+            return (json.dumps(msg, ensure_ascii=False) + "\n").encode("utf-8")
+
+        parts = _split_for_lines(text, MAX_LINE_BYTES - len(_line({"type": "chunked_part", "i": len(text), "data": ""})))
+
+        out = [_line({"type": "chunked_start", "chunks": len(parts)})]
+        for i, part in enumerate(parts):
+            out.append(_line({"type": "chunked_part", "i": i, "data": part}))
+        out.append(_line({"type": "chunked_end"}))
+        return out
+
+    async def send(self, payload: Dict[str, Any]) -> None:
+        if self.framing == "frames":
+            body = encode_body(self.codec, payload)
+            data = [FRAME_HEADER.pack(len(body)), body]
+        else:
+            data = self._encode_lines(payload)
+
+        async with self._write_lock:
+            self.writer.writelines(data)
+            await self.writer.drain()
+
+    async def send_raw(self, data: bytes) -> None:
+        """Отправить уже закодированное сообщение (кадр целиком или строку) как есть."""
+        async with self._write_lock:
+            self.writer.write(data)
+            await self.writer.drain()
+
+    async def _read_frame(self) -> Optional[bytes]:
+        try:
+            header = await self.reader.readexactly(FRAME_HEADER.size)
+        except asyncio.IncompleteReadError as e:
+            if not e.partial:
+                return None
+            raise ProtocolError("Обрыв заголовка кадра") from e
+
+        (size,) = FRAME_HEADER.unpack(header)
+        if size > MAX_FRAME_BYTES:
+            raise ProtocolError(f"Кадр слишком большой: {size} байт")
+
+        try:
+            return await self.reader.readexactly(size)
+        except asyncio.IncompleteReadError as e:
+            raise ProtocolError("Обрыв тела кадра") from e
+
+    async def _read_line(self) -> Optional[bytes]:
+        try:
+            line = await self.reader.readline()
+        except (ValueError, asyncio.LimitOverrunError) as e:
+            raise ProtocolError("Строка слишком длинная") from e
+        return line or None
+
+    async def recv_raw(self) -> Optional[bytes]:
+        """
+        Следующее сообщение без декодирования (для ретрансляции), None — соединение закрыто.
+        В режиме кадров возвращается кадр вместе с заголовком длины.
+        """
+        if self.framing == "frames":
+            body = await self._read_frame()
+            if body is None:
+                return None
+            return FRAME_HEADER.pack(len(body)) + body
+        return await self._read_line()
+
+    async def recv(self) -> Optional[Dict[str, Any]]:
+        """
+        Следующее сообщение или None, если собеседник закрыл соединение.
+
+        ValueError — сообщение не разобралось, но поток цел (можно читать дальше).
+        ProtocolError — поток сломан.
+        """
+        if self.framing == "frames":
+            body = await self._read_frame()
+            if body is None:
+                return None
+            msg = decode_body(self.codec, body)
+        else:
+            line = await self._read_line()
+            if line is None:
+                return None
+            msg = json.loads(line.decode("utf-8", errors="replace"))
+
+        if not isinstance(msg, dict):
+            raise ValueError("message must be an object")
+        return msg
+
+    async def close(self) -> None:
+        try:
+            self.writer.close()
+            await self.writer.wait_closed()
+        except Exception:
+            pass
@@ -0,0 +1,149 @@
+import asyncio
+import sys, time
+sys.dont_write_bytecode = True
+
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+
+class QueueFullError(RuntimeError):
+    """Очередь ожидания заполнена — запрос отклонён."""
+
+
+class RequestScheduler:
+    """
+    Допуск запросов к апстриму.
+
+    - одновременно к апстриму идёт не больше max_concurrent запросов;
+    - запросы одной session_id выполняются строго по очереди (FIFO), поэтому
+      load_session/save_session одной сессии больше не перетирают друг друга;
+    - если ждущих уже max_queue — новый запрос отклоняется (QueueFullError).
+    """
+
+    def __init__(self, max_concurrent: int = 4, max_queue: int = 32):
+        self.max_concurrent = max(int(max_concurrent), 1)
+        self.max_queue = max(int(max_queue), 0)
+
+        self._upstream = asyncio.Semaphore(self.max_concurrent)
+        self._session_locks: Dict[str, asyncio.Lock] = {}
+        self._session_refs: Dict[str, int] = {}
+        self._waiting: List[object] = []
+
+        # --- статистика
+        self.active = 0
+        self.background = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.queued_total = 0
+        self.wait_total_sec = 0.0
+        self.wait_max_sec = 0.0
+
+    def _acquire_session_lock(self, session_id: str) -> asyncio.Lock:
+        lock = self._session_locks.get(session_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._session_locks[session_id] = lock
+        self._session_refs[session_id] = self._session_refs.get(session_id, 0) + 1
+        return lock
+
+    def _release_session_ref(self, session_id: str) -> None:
+        left = self._session_refs.get(session_id, 1) - 1
+        if left <= 0:
+            self._session_refs.pop(session_id, None)
+            self._session_locks.pop(session_id, None)
+        else:
+            self._session_refs[session_id] = left
+
+    @asynccontextmanager
+    async def slot(
+        self,
+        session_id: str,
+        *,
+        upstream: bool = True,
+        on_queued: Optional[Callable[[int], Awaitable[None]]] = None,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Очередь сессии + (если upstream=True) слот апстрима.
+
+        on_queued(position) вызывается, если сразу войти нельзя: position — место в общей очереди (с 1).
+        Отдаёт словарь {"queue_position", "queue_wait_ms"} для message_stats.
+        """
+        lock = self._acquire_session_lock(session_id)
+        ticket = object()
+        t0 = time.perf_counter()
+        position = 0
+
+        try:
+            must_wait = lock.locked() or (upstream and self._upstream.locked())
+            if must_wait:
+                if len(self._waiting) >= self.max_queue:
+                    self.rejected += 1
+                    raise QueueFullError(f"Сервер перегружен: в очереди уже {len(self._waiting)} запросов")
+
+                self._waiting.append(ticket)
+                self.queued_total += 1
+                position = len(self._waiting)
+                if on_queued is not None:
+                    await on_queued(position)
+
+            try:
+                await lock.acquire()
+                if upstream:
+                    try:
+                        await self._upstream.acquire()
+                    except BaseException:
+                        lock.release()
+                        raise
+            finally:
+                if ticket in self._waiting:
+                    self._waiting.remove(ticket)
+        except BaseException:
+            self._release_session_ref(session_id)
+            raise
+
+        wait_sec = time.perf_counter() - t0
+        self.admitted += 1
+        self.wait_total_sec += wait_sec
+        self.wait_max_sec = max(self.wait_max_sec, wait_sec)
+        if upstream:
+            self.active += 1
+
+        try:
+            yield {"queue_position": position, "queue_wait_ms": round(wait_sec * 1000.0, 1)}
+        finally:
+            if upstream:
+                self.active -= 1
+                self._upstream.release()
+            lock.release()
+            self._release_session_ref(session_id)
+
+    @asynccontextmanager
+    async def upstream_slot(self) -> AsyncIterator[None]:
+        """
+        Только слот апстрима, без очереди сессии: для фоновых вызовов (суммаризация),
+        которые не должны держать сессию, но обязаны уважать общий лимит параллельных запросов.
+        """
+        await self._upstream.acquire()
+        self.active += 1
+        self.background += 1
+        try:
+            yield
+        finally:
+            self.background -= 1
+            self.active -= 1
+            self._upstream.release()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "active": int(self.active),
+            "background": int(self.background),
+            "max_concurrent": int(self.max_concurrent),
+            "queue_depth": len(self._waiting),
+            "max_queue": int(self.max_queue),
+            "sessions_busy": len(self._session_locks),
+            "admitted": int(self.admitted),
+            "queued_total": int(self.queued_total),
+            "rejected": int(self.rejected),
+            "wait_avg_ms": round((self.wait_total_sec / self.admitted) * 1000.0, 1) if self.admitted else 0.0,
+            "wait_max_ms": round(self.wait_max_sec * 1000.0, 1),
+        }
@@ -0,0 +1,142 @@
+import sys
+sys.dont_write_bytecode = True
+
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+# оценка памяти под turn помимо текстов: словарь с ~15 полями, usage, токены
+TURN_OVERHEAD_BYTES = 1024
+SESSION_OVERHEAD_BYTES = 2048
+
+
+def _str_bytes(value: Any) -> int:
+    # CPython: ASCII — байт на символ, кириллица — два (UCS-2)
+    if not isinstance(value, str):
+        return 0
+    return len(value) if value.isascii() else 2 * len(value)
+
+
+def estimate_session_bytes(session: Dict[str, Any]) -> int:
+    """Примерный объём сессии в памяти процесса (тексты turn'ов + накладные расходы)."""
+    size = SESSION_OVERHEAD_BYTES + _str_bytes(session.get("history_summary")) + _str_bytes(session.get("title"))
+    history = session.get("history")
+    if isinstance(history, dict):
+        for turn in history.values():
+            if isinstance(turn, dict):
+                size += TURN_OVERHEAD_BYTES + _str_bytes(turn.get("user_text")) + _str_bytes(turn.get("assistant_text"))
+    return size
+
+
+class SessionCache:
+    """
+    LRU горячих сессий, ограниченный по памяти (max_bytes), а не по числу сессий.
+
+    Только структура данных, без I/O: AgentMemoryStore кладёт сюда загруженные
+    и сохранённые сессии, а запись на диск откладывает (write-behind). Грязные
+    сессии отдаются через take_dirty(); вытесняемые грязные — через put(), чтобы
+    их успели записать до того, как они пропадут из памяти.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max(int(max_bytes), 0)
+        # session_id -> (сессия, байты); порядок — от давно не трогавшихся к свежим
+        self._entries: "OrderedDict[str, Tuple[Dict[str, Any], int]]" = OrderedDict()
+        # session_id -> time.monotonic() первого несохранённого изменения
+        self._dirty: Dict[str, float] = {}
+        self.bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, session_id: str) -> bool:
+        return session_id in self._entries
+
+    def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(session_id)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(session_id)
+        self.hits += 1
+        return entry[0]
+
+    def peek(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """Без учёта в hit/miss и без продвижения в LRU."""
+        entry = self._entries.get(session_id)
+        return entry[0] if entry is not None else None
+
+    def put(self, session_id: str, session: Dict[str, Any], dirty: bool = False) -> List[Dict[str, Any]]:
+        """
+        Положить (обновить) сессию. Возвращает вытесненные грязные сессии —
+        вызывающий обязан их записать. Сессия больше всего бюджета не кэшируется
+        (если она грязная — тоже возвращается на запись).
+        """
+        old = self._entries.pop(session_id, None)
+        if old is not None:
+            self.bytes -= old[1]
+
+        if dirty:
+            self._dirty.setdefault(session_id, time.monotonic())
+
+        size = estimate_session_bytes(session)
+        if size > self.max_bytes:
+            if self._dirty.pop(session_id, None) is not None:
+                return [session]
+            return []
+
+        self._entries[session_id] = (session, size)
+        self.bytes += size
+
+        evicted: List[Dict[str, Any]] = []
+        while self.bytes > self.max_bytes and self._entries:
+            sid, (victim, victim_size) = self._entries.popitem(last=False)
+            self.bytes -= victim_size
+            self.evictions += 1
+            if self._dirty.pop(sid, None) is not None:
+                evicted.append(victim)
+        return evicted
+
+    def drop(self, session_id: str) -> None:
+        entry = self._entries.pop(session_id, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+        self._dirty.pop(session_id, None)
+
+    def is_dirty(self, session_id: str) -> bool:
+        return session_id in self._dirty
+
+    def take_dirty(self) -> List[Dict[str, Any]]:
+        """Все грязные сессии (снимаем отметку: при ошибке записи вызывающий вернёт её через mark_dirty)."""
+        out = []
+        for sid in list(self._dirty):
+            entry = self._entries.get(sid)
+            del self._dirty[sid]
+            if entry is not None:
+                out.append(entry[0])
+        return out
+
+    def mark_dirty(self, session_id: str) -> None:
+        if session_id in self._entries:
+            self._dirty.setdefault(session_id, time.monotonic())
+
+    def oldest_dirty_age(self) -> Optional[float]:
+        if not self._dirty:
+            return None
+        return time.monotonic() - min(self._dirty.values())
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        age = self.oldest_dirty_age()
+        return {
+            "sessions": len(self._entries),
+            "bytes": int(self.bytes),
+            "max_bytes": int(self.max_bytes),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "dirty": len(self._dirty),
+            "oldest_dirty_sec": round(age, 3) if age is not None else None,
+        }
@@ -0,0 +1,181 @@
+import asyncio
+import sys, time
+sys.dont_write_bytecode = True
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+from core.agent.memory_store import AgentMemoryStore
+
+
+class SessionIO:
+    """
+    Асинхронный фасад над AgentMemoryStore для сервера: чтение и запись сессий
+    идут в ограниченном пуле потоков, цикл событий не ждёт диск.
+
+    - всё, что в памяти (кэш, каталог, версии), по-прежнему трогается только из цикла;
+      в пул уходят лишь вызовы бэкенда;
+    - операции одной session_id выполняются строго в порядке вызова (цепочка задач),
+      разные сессии пишутся параллельно, не больше max_workers одновременно;
+    - в поток уходит копия сессии (AgentMemoryStore.detach): стрим может дописывать
+      оригинал, пока предыдущая версия сохраняется;
+    - начатую запись отмена запроса не прерывает — она дойдёт до диска.
+    """
+
+    # ключ очереди для операций не по конкретной сессии (каталог, sync бэкенда)
+    GLOBAL_KEY = ""
+
+    def __init__(self, store: AgentMemoryStore, max_workers: int = 4):
+        self.store = store
+        self.max_workers = max(int(max_workers), 1)
+        self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="agent-io")
+        # session_id -> последняя поставленная операция; следующая ждёт её завершения
+        self._tails: Dict[str, "asyncio.Task[Any]"] = {}
+
+        # --- статистика
+        self.ops = 0
+        self.errors = 0
+        self.pending = 0
+        self.wait_max_sec = 0.0
+        self.run_total_sec = 0.0
+        self.run_max_sec = 0.0
+
+    async def _run(self, key: str, fn: Callable[..., Any], *args: Any) -> Any:
+        loop = asyncio.get_running_loop()
+        prev = self._tails.get(key)
+        queued_at = time.perf_counter()
+
+        def timed() -> Any:
+            t0 = time.perf_counter()
+            self.wait_max_sec = max(self.wait_max_sec, t0 - queued_at)
+            try:
+                return fn(*args)
+            finally:
+                elapsed = time.perf_counter() - t0
+                self.run_total_sec += elapsed
+                self.run_max_sec = max(self.run_max_sec, elapsed)
+
+        async def chained() -> Any:
+            if prev is not None:
+                # исход предыдущей операции не важен — важен только порядок
+                await asyncio.wait([prev])
+            return await loop.run_in_executor(self._pool, timed)
+
+        task = loop.create_task(chained())
+        self._tails[key] = task
+        self.ops += 1
+        self.pending += 1
+
+        def done(t: "asyncio.Task[Any]") -> None:
+            self.pending -= 1
+            if self._tails.get(key) is t:
+                del self._tails[key]
+            # ошибку забираем здесь: вызывающий мог быть отменён и не узнает о ней
+            if not t.cancelled() and t.exception() is not None:
+                self.errors += 1
+
+        task.add_done_callback(done)
+        return await asyncio.shield(task)
+
+    # ====== каталог ======
+
+    async def prime(self) -> None:
+        """Каталог сессий: проход по хранилищу — в пуле, сам каталог собирается в цикле."""
+        if self.store.catalog_ready:
+            return
+        infos = await self._run(self.GLOBAL_KEY, self.store.backend.list_sessions)
+        self.store.prime_catalog(infos)
+
+    async def list_sessions_delta(self, since: Optional[str] = None) -> Dict[str, Any]:
+        await self.prime()
+        return self.store.list_sessions_delta(since)
+
+    # ====== сессии ======
+
+    async def load_session(self, session_id: str) -> Dict[str, Any]:
+        data = self.store.cached_session(session_id)
+        if data is not None:
+            return data
+
+        loaded = await self._run(session_id, self.store.backend.load, session_id)
+        data, evicted = self.store.adopt_loaded(session_id, loaded)
+        await self._write(evicted)
+        return data
+
+    async def load_session_page(self, session_id: str, **page_params: Any) -> Dict[str, Any]:
+        cached = self.store.cache.peek(session_id) if self.store.cache is not None else None
+        if cached is None:
+            page = await self._run(session_id, lambda: self.store.backend.load_page(session_id, **page_params))
+            if page is not None:
+                return page
+            cached = await self.load_session(session_id)
+        return self.store.session_page(cached, **page_params)
+
+    async def save_session(self, session: Dict[str, Any]) -> None:
+        """С кэшем — только пометка грязной (на диск её унесёт flush), без кэша — запись в пуле."""
+        await self.prime()
+        await self._write(self.store.stage_save(session))
+
+    async def delete_session_file(self, session_id: str) -> bool:
+        cached = self.store.forget_session(session_id)
+        try:
+            deleted = await self._run(session_id, self.store.backend.delete, session_id)
+        except Exception:
+            return False
+        await self.prime()
+        return self.store.finish_delete(session_id, deleted or cached)
+
+    async def _write(self, sessions: List[Dict[str, Any]]) -> None:
+        if not sessions:
+            return
+        copies = [self.store.detach(s) for s in sessions]
+        await asyncio.gather(*(self._run(self._key(c), self.store.backend.save, c) for c in copies))
+        self.store.flush_stats["written"] += len(copies)
+
+    @staticmethod
+    def _key(session: Dict[str, Any]) -> str:
+        return (session.get("session_id") or "").strip()
+
+    async def flush(self) -> int:
+        """Грязные сессии из кэша — на диск (параллельно по сессиям). Возвращает, сколько записано."""
+        dirty = self.store.take_dirty()
+        copies = [self.store.detach(s) for s in dirty]
+        results = await asyncio.gather(
+            *(self._run(self._key(c), self.store.backend.save, c) for c in copies),
+            return_exceptions=True,
+        )
+
+        written = 0
+        error: Optional[BaseException] = None
+        for session, result in zip(dirty, results):
+            if isinstance(result, BaseException):
+                self.store.flush_failed(session)
+                error = result
+            else:
+                written += 1
+        self.store.flush_stats["written"] += written
+
+        await self._run(self.GLOBAL_KEY, self.store.backend.sync)
+        if error is not None:
+            raise error
+        return written
+
+    async def drain(self) -> None:
+        """Дождаться всех поставленных операций."""
+        tails = list(self._tails.values())
+        if tails:
+            await asyncio.wait(tails)
+
+    def close(self) -> None:
+        self._pool.shutdown(wait=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.max_workers,
+            "ops": self.ops,
+            "pending": self.pending,
+            "errors": self.errors,
+            "wait_max_ms": round(self.wait_max_sec * 1000, 2),
+            "run_avg_ms": round(self.run_total_sec * 1000 / self.ops, 2) if self.ops else 0.0,
+            "run_max_ms": round(self.run_max_sec * 1000, 2),
+        }
@@ -0,0 +1,888 @@
+import os, sys
+sys.dont_write_bytecode = True
+
+import argparse
+import copy
+import json
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+
+@dataclass
+class SessionInfo:
+    session_id: str
+    title: str
+    created_at: str
+    updated_at: str
+    file_path: str
+
+
+def _session_meta(session: Dict[str, Any]) -> Dict[str, Any]:
+    """Всё, кроме history: поле пишется целиком, если изменилось."""
+    return copy.deepcopy({k: v for k, v in session.items() if k not in ("history", "file_path")})
+
+
+def _turn_version(turn: Any) -> int:
+    try:
+        return int(turn.get("version") or 0)
+    except (AttributeError, TypeError, ValueError):
+        return 0
+
+
+class SessionBackend:
+    """
+    Где и как лежат сессии. AgentMemoryStore держит каталог, версии и страницы,
+    а чтение/запись сессий целиком отдаёт бэкенду.
+
+    Сессия — словарь как в памяти агента: поля сессии + history {turn_id: turn}.
+    turn'ы меняются только через AgentMemoryStore.bump_turn_version, поэтому бэкенд
+    может писать лишь turn'ы с версией новее сохранённой.
+    """
+
+    name = "base"
+
+    def list_sessions(self) -> List[SessionInfo]:
+        raise NotImplementedError
+
+    def load(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """Сессия целиком или None, если её нет."""
+        raise NotImplementedError
+
+    def exists(self, session_id: str) -> bool:
+        return self.load(session_id) is not None
+
+    def new_location(self, session_id: str) -> Optional[str]:
+        """file_path новой сессии (None — у бэкенда нет файла на сессию)."""
+        return None
+
+    def save(self, session: Dict[str, Any]) -> str:
+        """Записать изменения сессии; возвращает, куда записано."""
+        raise NotImplementedError
+
+    def delete(self, session_id: str) -> bool:
+        raise NotImplementedError
+
+    def load_page(
+        self,
+        session_id: str,
+        from_turn: Optional[int] = None,
+        limit: Optional[int] = None,
+        fields: Optional[List[str]] = None,
+        since_version: Optional[int] = None,
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Страница сессии в формате AgentMemoryStore.session_page без загрузки всей истории.
+        None — бэкенд так не умеет (или сессии нет): store соберёт страницу из load().
+        """
+        return None
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": self.name}
+
+    def sync(self) -> None:
+        """Дописать отложенное служебное (индексы, манифесты); зовётся по таймеру и при остановке."""
+        pass
+
+    def close(self) -> None:
+        self.sync()
+
+
+class JsonSessionBackend(SessionBackend):
+    """
+    Файл на сессию в плоской папке: снимок <id>_memmoryYYYYMMDD.json + журнал рядом (.jsonl).
+
+    save() дописывает в журнал одну запись: изменённые turn'ы (по версии) и поля сессии.
+    Снимок переписывается, только когда журнал перерос его: в среднем O(1) записи на ход.
+    """
+
+    name = "json"
+
+    JOURNAL_MIN_COMPACT_BYTES = 256 * 1024
+
+    MANIFEST_NAME = "sessions_manifest.json"
+    MANIFEST_FORMAT = 1
+    # потоков на пересборку манифеста (холодный старт: разбор всех файлов)
+    MANIFEST_WORKERS = 8
+
+    def __init__(self, base_dir: str):
+        self.base_dir = base_dir
+        os.makedirs(self.base_dir, exist_ok=True)
+
+        # что уже лежит на диске (снимок + журнал) по пути снимка:
+        # {"meta": поля сессии, "snapshot_bytes", "journal_bytes"}
+        self._persisted: Dict[str, Dict[str, Any]] = {}
+        self.journal_stats: Dict[str, int] = {"appends": 0, "appended_bytes": 0, "snapshots": 0, "replayed": 0}
+
+        # манифест каталога: {имя снимка: session_id/title/created_at/updated_at + отпечаток файлов};
+        # в памяти обновляется при каждой записи, на диск — при list_sessions и close()
+        self.manifest_path = os.path.join(self.base_dir, self.MANIFEST_NAME)
+        self._manifest: Optional[Dict[str, Dict[str, Any]]] = None
+        self._manifest_dirty = False
+        self.manifest_stats: Dict[str, int] = {"rebuilt": 0, "healed": 0, "writes": 0}
+        # сессии могут писаться из разных потоков (SessionIO): по одной сессии вызовы идут
+        # по очереди, а общий манифест — под замком
+        self._manifest_lock = threading.RLock()
+
+    @staticmethod
+    def _safe_id(session_id: str) -> str:
+        return "".join(ch for ch in session_id if ch.isalnum() or ch in ("-", "_"))
+
+    def new_location(self, session_id: str) -> str:
+        day = datetime.now().strftime("%Y%m%d")
+        safe_id = self._safe_id(session_id)
+        # ВАЖНО: memmory — как у тебя было
+        return os.path.join(self.base_dir, f"{safe_id}_memmory{day}.json")
+
+    def _find_latest_file_for_session(self, session_id: str) -> Optional[str]:
+        safe_id = self._safe_id(session_id)
+        candidates: List[str] = []
+
+        try:
+            for name in os.listdir(self.base_dir):
+                if name.startswith(f"{safe_id}_memmory") and name.endswith(".json"):
+                    candidates.append(os.path.join(self.base_dir, name))
+        except Exception:
+            return None
+
+        if not candidates:
+            return None
+
+        try:
+            candidates.sort(key=lambda p: os.path.getmtime(p), reverse=True)
+        except Exception:
+            pass
+
+        return candidates[0]
+
+    # ====== манифест каталога ======
+
+    @staticmethod
+    def _stamp(path: str) -> Optional[List[int]]:
+        """Отпечаток сессии на диске: mtime/размер снимка и журнала (None — снимка нет)."""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        try:
+            jst = os.stat(os.path.splitext(path)[0] + ".jsonl")
+            journal = [jst.st_mtime_ns, jst.st_size]
+        except OSError:
+            journal = [0, 0]
+        return [st.st_mtime_ns, st.st_size] + journal
+
+    def _catalog_entry(self, path: str) -> Optional[Dict[str, Any]]:
+        """Поля каталога из снимка и журнала (медленный путь: разбор файла целиком)."""
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            # заголовок и updated_at могли поменяться после снимка
+            for record in self._read_journal(path):
+                meta = record.get("meta")
+                if isinstance(meta, dict):
+                    data.update(meta)
+        except Exception:
+            return None
+
+        session_id = (data.get("session_id") or "").strip() if isinstance(data, dict) else ""
+        if not session_id:
+            return None
+        return {
+            "session_id": session_id,
+            "title": (data.get("title") or "").strip(),
+            "created_at": data.get("created_at") or "",
+            "updated_at": data.get("updated_at") or "",
+        }
+
+    def _load_manifest(self) -> Dict[str, Dict[str, Any]]:
+        if self._manifest is None:
+            manifest: Dict[str, Any] = {}
+            try:
+                with open(self.manifest_path, "r", encoding="utf-8") as f:
+                    manifest = json.load(f)
+            except (OSError, ValueError):
+                manifest = {}
+            if not isinstance(manifest, dict) or manifest.get("format") != self.MANIFEST_FORMAT:
+                manifest = {}
+            files = manifest.get("files")
+            self._manifest = {k: v for k, v in files.items() if isinstance(v, dict)} if isinstance(files, dict) else {}
+        return self._manifest
+
+    def _save_manifest(self) -> None:
+        with self._manifest_lock:
+            if self._manifest is None or not self._manifest_dirty:
+                return
+            tmp = f"{self.manifest_path}.{os.getpid()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"format": self.MANIFEST_FORMAT, "files": self._manifest}, f, ensure_ascii=False)
+            os.replace(tmp, self.manifest_path)
+            self._manifest_dirty = False
+            self.manifest_stats["writes"] += 1
+
+    def _manifest_touch(self, session: Dict[str, Any], path: str) -> None:
+        """После записи сессии: свежая строка манифеста без разбора файла."""
+        if self._manifest is None:
+            return
+        stamp = self._stamp(path)
+        if stamp is None:
+            return
+        with self._manifest_lock:
+            if self._manifest is None:
+                return
+            self._manifest[os.path.basename(path)] = {
+                "session_id": (session.get("session_id") or "").strip(),
+                "title": (session.get("title") or "").strip(),
+                "created_at": session.get("created_at") or "",
+                "updated_at": session.get("updated_at") or "",
+                "stamp": stamp,
+            }
+            self._manifest_dirty = True
+
+    def list_sessions(self) -> List[SessionInfo]:
+        """
+        Каталог из манифеста: один файл на чтение плюс stat сессий. Строки, у которых
+        не сходится отпечаток (файл правили в обход агента, писал другой воркер, упали
+        до записи манифеста) или которых нет, пересобираются из файлов параллельно.
+        """
+        try:
+            names = [n for n in os.listdir(self.base_dir) if n.endswith(".json") and "_memmory" in n]
+        except Exception:
+            return []
+
+        with self._manifest_lock:
+            return self._list_from_manifest(names)
+
+    def _list_from_manifest(self, names: List[str]) -> List[SessionInfo]:
+        manifest = self._load_manifest()
+        stale: List[Tuple[str, List[int]]] = []
+        for name in names:
+            stamp = self._stamp(os.path.join(self.base_dir, name))
+            entry = manifest.get(name)
+            if stamp is not None and (entry is None or entry.get("stamp") != stamp):
+                stale.append((name, stamp))
+
+        gone = set(manifest) - set(names)
+        for name in gone:
+            del manifest[name]
+        if gone:
+            self._manifest_dirty = True
+
+        if stale:
+            if len(stale) == len(names):
+                self.manifest_stats["rebuilt"] += 1
+            else:
+                self.manifest_stats["healed"] += len(stale)
+            paths = [os.path.join(self.base_dir, name) for name, _ in stale]
+            with ThreadPoolExecutor(max_workers=min(self.MANIFEST_WORKERS, len(paths))) as pool:
+                entries = list(pool.map(self._catalog_entry, paths))
+            for (name, stamp), entry in zip(stale, entries):
+                # битый файл тоже запоминаем с отпечатком: не разбирать его при каждом запросе
+                manifest[name] = dict(entry or {"session_id": ""}, stamp=stamp)
+            self._manifest_dirty = True
+
+        try:
+            self._save_manifest()
+        except OSError:
+            pass
+
+        # несколько файлов одной сессии (разные дни) -> берём самый свежий по mtime
+        latest: Dict[str, Tuple[int, SessionInfo]] = {}
+        for name in names:
+            entry = manifest.get(name)
+            if not entry or not entry.get("session_id"):
+                continue
+            mtime = int((entry.get("stamp") or [0])[0])
+            info = SessionInfo(
+                session_id=entry["session_id"],
+                title=entry.get("title") or "",
+                created_at=entry.get("created_at") or "",
+                updated_at=entry.get("updated_at") or "",
+                file_path=os.path.join(self.base_dir, name),
+            )
+            if info.session_id not in latest or mtime > latest[info.session_id][0]:
+                latest[info.session_id] = (mtime, info)
+
+        result = [info for _, info in latest.values()]
+        result.sort(key=lambda i: i.updated_at or "", reverse=True)
+        return result
+
+    def load(self, session_id: str) -> Optional[Dict[str, Any]]:
+        path = self._find_latest_file_for_session(session_id)
+
+        if path and os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+
+                if isinstance(data, dict) and data.get("session_id") == session_id:
+                    data["file_path"] = path
+                    migrated = False
+
+                    # --- миграция старого формата messages -> history
+                    if "history" not in data:
+                        old_messages = data.get("messages")
+                        if isinstance(old_messages, list):
+                            history: Dict[str, Any] = {}
+                            idx = 0
+                            pending_user = None
+
+                            for m in old_messages:
+                                role = (m.get("role") or "").strip()
+                                content = m.get("content")
+
+                                if role == "user" and isinstance(content, str):
+                                    pending_user = {"text": content, "ts": m.get("ts")}
+                                elif role == "assistant" and isinstance(content, str):
+                                    if pending_user is None:
+                                        pending_user = {"text": "", "ts": m.get("ts")}
+                                    idx += 1
+                                    history[str(idx)] = {
+                                        "ts": pending_user.get("ts"),
+                                        "user_text": pending_user.get("text") or "",
+                                        "assistant_text": content,
+                                        "model": None,
+                                        "endpoint": None,
+                                        "usage": {},
+                                        "cost_rub": None,
+                                        "r_prompt_total": 0,
+                                        "c_completion": 0,
+                                        "total_tokens_call": 0,
+                                        "r_prev_prompt_total": 0,
+                                        "current_message_tokens": 0,
+                                    }
+                                    pending_user = None
+
+                            if pending_user is not None:
+                                idx += 1
+                                history[str(idx)] = {
+                                    "ts": pending_user.get("ts"),
+                                    "user_text": pending_user.get("text") or "",
+                                    "assistant_text": "",
+                                    "model": None,
+                                    "endpoint": None,
+                                    "usage": {},
+                                    "cost_rub": None,
+                                    "r_prompt_total": 0,
+                                    "c_completion": 0,
+                                    "total_tokens_call": 0,
+                                    "r_prev_prompt_total": 0,
+                                    "current_message_tokens": 0,
+                                }
+
+                            data["history"] = history
+                            data.pop("messages", None)
+                            migrated = True
+
+                    if not isinstance(data.get("history"), dict):
+                        data["history"] = {}
+
+                    journal_bytes = self._replay_journal(data, path)
+
+                    # --- NEW: гарантируем наличие history_summary
+                    if "history_summary" not in data:
+                        data["history_summary"] = ""
+                    if not isinstance(data.get("history_summary"), str):
+                        data["history_summary"] = ""
+
+                    if migrated:
+                        # старый формат: следующий save_session перепишет снимок целиком
+                        self._persisted.pop(path, None)
+                    else:
+                        self._persisted[path] = {
+                            "meta": _session_meta(data),
+                            "snapshot_bytes": os.path.getsize(path),
+                            "journal_bytes": journal_bytes,
+                        }
+
+                    return data
+            except Exception:
+                pass
+        return None
+
+    @staticmethod
+    def _journal_path(path: str) -> str:
+        return os.path.splitext(path)[0] + ".jsonl"
+
+    def _read_journal(self, path: str, valid: Optional[List[int]] = None):
+        """
+        Записи журнала по порядку. Оборванная запись (упали посреди дописывания) и всё
+        после неё не отдаются; valid, если передан, получит длину целой части в байтах.
+        """
+        good = 0
+        try:
+            with open(self._journal_path(path), "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    good += len(line)
+                    if isinstance(record, dict):
+                        yield record
+        except FileNotFoundError:
+            pass
+        finally:
+            if valid is not None:
+                valid.append(good)
+
+    def _replay_journal(self, data: Dict[str, Any], path: str) -> int:
+        """Накатить журнал на снимок; отрезает оборванный хвост. Возвращает размер журнала."""
+        valid: List[int] = []
+        history = data.get("history")
+        for record in self._read_journal(path, valid):
+            meta = record.get("meta")
+            if isinstance(meta, dict):
+                data.update(meta)
+            turns = record.get("turns")
+            if isinstance(turns, dict) and isinstance(history, dict):
+                history.update(turns)
+            self.journal_stats["replayed"] += 1
+
+        good = valid[0] if valid else 0
+        journal_path = self._journal_path(path)
+        try:
+            if os.path.getsize(journal_path) > good:
+                with open(journal_path, "r+b") as f:
+                    f.truncate(good)
+        except OSError:
+            pass
+        return good
+
+    def _write_snapshot(self, session: Dict[str, Any], path: str) -> None:
+        """Сессия целиком в снимок (через временный файл), журнал после этого не нужен."""
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(session, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, path)
+
+        # упадём тут — при загрузке журнал накатится на снимок повторно, записи идемпотентны
+        try:
+            os.remove(self._journal_path(path))
+        except FileNotFoundError:
+            pass
+
+        self.journal_stats["snapshots"] += 1
+        self._persisted[path] = {
+            "meta": _session_meta(session),
+            "snapshot_bytes": os.path.getsize(path),
+            "journal_bytes": 0,
+        }
+
+    def _append_journal(self, session: Dict[str, Any], path: str) -> None:
+        persisted = self._persisted[path]
+        old_meta = persisted["meta"]
+        meta = _session_meta(session)
+        changed_meta = {k: v for k, v in meta.items() if k not in old_meta or old_meta[k] != v}
+
+        # turn'ы меняются только через bump_turn_version -> новее сохранённой версии сессии
+        try:
+            saved_version = int(old_meta.get("version") or 0)
+        except (TypeError, ValueError):
+            saved_version = 0
+        turns = {
+            k: turn
+            for k, turn in session["history"].items()
+            if isinstance(turn, dict) and int(turn.get("version") or 0) > saved_version
+        }
+
+        if not changed_meta and not turns:
+            return
+
+        record: Dict[str, Any] = {}
+        if changed_meta:
+            record["meta"] = changed_meta
+        if turns:
+            record["turns"] = turns
+        line = (json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+
+        with open(self._journal_path(path), "ab") as f:
+            f.write(line)
+
+        persisted["meta"] = meta
+        persisted["journal_bytes"] += len(line)
+        self.journal_stats["appends"] += 1
+        self.journal_stats["appended_bytes"] += len(line)
+
+        # журнал перерос снимок -> сворачиваем (переписывание снимка амортизируется дописываниями)
+        if persisted["journal_bytes"] > max(persisted["snapshot_bytes"], self.JOURNAL_MIN_COMPACT_BYTES):
+            self._write_snapshot(session, path)
+
+    def save(self, session: Dict[str, Any]) -> str:
+        session_id = (session.get("session_id") or "").strip()
+        path = session.get("file_path") or self.new_location(session_id)
+        session["file_path"] = path
+
+        if path in self._persisted and os.path.exists(path):
+            self._append_journal(session, path)
+        else:
+            self._write_snapshot(session, path)
+        self._manifest_touch(session, path)
+        return path
+
+    def delete(self, session_id: str) -> bool:
+        path = self._find_latest_file_for_session(session_id)
+        if not path:
+            return False
+        if os.path.exists(path):
+            os.remove(path)
+        journal_path = self._journal_path(path)
+        if os.path.exists(journal_path):
+            os.remove(journal_path)
+        self._persisted.pop(path, None)
+        with self._manifest_lock:
+            if self._manifest is not None and self._manifest.pop(os.path.basename(path), None) is not None:
+                self._manifest_dirty = True
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": self.name,
+            "sessions_open": len(self._persisted),
+            **self.journal_stats,
+            "manifest": {"sessions": len(self._manifest or {}), **self.manifest_stats},
+        }
+
+    def sync(self) -> None:
+        try:
+            self._save_manifest()
+        except OSError:
+            pass
+
+
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    title      TEXT NOT NULL DEFAULT '',
+    created_at TEXT NOT NULL DEFAULT '',
+    updated_at TEXT NOT NULL DEFAULT '',
+    version    INTEGER NOT NULL DEFAULT 0,
+    meta       TEXT NOT NULL DEFAULT '{}'
+);
+CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions(updated_at);
+
+CREATE TABLE IF NOT EXISTS turns (
+    session_id TEXT NOT NULL,
+    turn_id    INTEGER NOT NULL,
+    version    INTEGER NOT NULL DEFAULT 0,
+    data       TEXT NOT NULL,
+    PRIMARY KEY (session_id, turn_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS turns_session_version ON turns(session_id, version);
+
+CREATE TABLE IF NOT EXISTS storage_meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# поля сессии, у которых своя колонка; остальное (history_summary, ...) — в meta JSON
+_SESSION_COLUMNS = ("session_id", "title", "created_at", "updated_at", "version")
+
+
+class SqliteSessionBackend(SessionBackend):
+    """
+    Сессии в одной базе SQLite (WAL: читатели не ждут писателя, воркеры супервизора
+    работают с одним файлом). Список сессий и страницы turn'ов — запросы по индексам,
+    save() пишет строку сессии и только изменённые turn'ы.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+
+        # autocommit: транзакции открываем сами (BEGIN IMMEDIATE — сразу берём блокировку записи)
+        self._db = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self._lock = threading.RLock()
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("PRAGMA busy_timeout=5000")
+        self._db.executescript(_SQLITE_SCHEMA)
+
+        self.saves = 0
+        self.turns_written = 0
+
+    @contextmanager
+    def _tx(self) -> Iterator[sqlite3.Connection]:
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._db
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def _query(self, sql: str, args: tuple = ()) -> List[tuple]:
+        with self._lock:
+            return self._db.execute(sql, args).fetchall()
+
+    def get_meta(self, key: str) -> Optional[str]:
+        rows = self._query("SELECT value FROM storage_meta WHERE key = ?", (key,))
+        return rows[0][0] if rows else None
+
+    def set_meta(self, key: str, value: str) -> None:
+        with self._tx() as db:
+            db.execute("INSERT OR REPLACE INTO storage_meta(key, value) VALUES (?, ?)", (key, value))
+
+    def list_sessions(self) -> List[SessionInfo]:
+        rows = self._query(
+            "SELECT session_id, title, created_at, updated_at FROM sessions ORDER BY updated_at DESC"
+        )
+        return [
+            SessionInfo(session_id=sid, title=title, created_at=created_at, updated_at=updated_at, file_path=self.path)
+            for sid, title, created_at, updated_at in rows
+        ]
+
+    def exists(self, session_id: str) -> bool:
+        return bool(self._query("SELECT 1 FROM sessions WHERE session_id = ?", (session_id,)))
+
+    def _load_header(self, session_id: str) -> Optional[Dict[str, Any]]:
+        rows = self._query(
+            "SELECT title, created_at, updated_at, version, meta FROM sessions WHERE session_id = ?",
+            (session_id,),
+        )
+        if not rows:
+            return None
+
+        title, created_at, updated_at, version, meta = rows[0]
+        try:
+            data = json.loads(meta)
+        except ValueError:
+            data = {}
+        if not isinstance(data, dict):
+            data = {}
+        data.update(
+            session_id=session_id,
+            title=title,
+            created_at=created_at,
+            updated_at=updated_at,
+            version=int(version),
+        )
+        return data
+
+    @staticmethod
+    def _turns(rows: List[tuple]) -> Dict[str, Any]:
+        history: Dict[str, Any] = {}
+        for turn_id, data in rows:
+            try:
+                history[str(turn_id)] = json.loads(data)
+            except ValueError:
+                continue
+        return history
+
+    def load(self, session_id: str) -> Optional[Dict[str, Any]]:
+        data = self._load_header(session_id)
+        if data is None:
+            return None
+        data["history"] = self._turns(
+            self._query("SELECT turn_id, data FROM turns WHERE session_id = ? ORDER BY turn_id", (session_id,))
+        )
+        return data
+
+    def save(self, session: Dict[str, Any]) -> str:
+        session_id = (session.get("session_id") or "").strip()
+        history = session.get("history") or {}
+        meta = {k: v for k, v in _session_meta(session).items() if k not in _SESSION_COLUMNS}
+
+        with self._tx() as db:
+            row = db.execute("SELECT version FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+            saved_version = int(row[0]) if row else None
+
+            db.execute(
+                "INSERT INTO sessions(session_id, title, created_at, updated_at, version, meta) "
+                "VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(session_id) DO UPDATE SET title = excluded.title, created_at = excluded.created_at, "
+                "updated_at = excluded.updated_at, version = excluded.version, meta = excluded.meta",
+                (
+                    session_id,
+                    session.get("title") or "",
+                    session.get("created_at") or "",
+                    session.get("updated_at") or "",
+                    int(session.get("version") or 0),
+                    json.dumps(meta, ensure_ascii=False),
+                ),
+            )
+
+            # новая сессия — все turn'ы; иначе только тронутые bump_turn_version после прошлой записи
+            changed = []
+            for key, turn in history.items():
+                if not isinstance(turn, dict):
+                    continue
+                version = _turn_version(turn)
+                if saved_version is not None and version <= saved_version:
+                    continue
+                try:
+                    turn_id = int(key)
+                except (TypeError, ValueError):
+                    continue
+                changed.append((session_id, turn_id, version, json.dumps(turn, ensure_ascii=False)))
+
+            if changed:
+                db.executemany(
+                    "INSERT OR REPLACE INTO turns(session_id, turn_id, version, data) VALUES (?, ?, ?, ?)",
+                    changed,
+                )
+
+        self.saves += 1
+        self.turns_written += len(changed)
+        return self.path
+
+    def delete(self, session_id: str) -> bool:
+        with self._tx() as db:
+            db.execute("DELETE FROM turns WHERE session_id = ?", (session_id,))
+            deleted = db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,)).rowcount
+        return deleted > 0
+
+    def load_page(
+        self,
+        session_id: str,
+        from_turn: Optional[int] = None,
+        limit: Optional[int] = None,
+        fields: Optional[List[str]] = None,
+        since_version: Optional[int] = None,
+    ) -> Optional[Dict[str, Any]]:
+        header = self._load_header(session_id)
+        if header is None:
+            return None
+
+        version = int(header.get("version") or 0)
+        reset = since_version is not None and since_version > version
+
+        where, args = "session_id = ?", [session_id]
+        if since_version is not None and not reset:
+            where += " AND version > ?"
+            args.append(since_version)
+
+        turns_total = int(self._query(f"SELECT COUNT(*) FROM turns WHERE {where}", tuple(args))[0][0])
+
+        if from_turn is not None:
+            sql = f"SELECT turn_id, data FROM turns WHERE {where} AND turn_id >= ? ORDER BY turn_id"
+            page_args = args + [from_turn]
+            if limit is not None:
+                sql += " LIMIT ?"
+                page_args.append(max(limit, 0))
+            rows = self._query(sql, tuple(page_args))
+        elif limit is not None:
+            rows = self._query(
+                f"SELECT turn_id, data FROM turns WHERE {where} ORDER BY turn_id DESC LIMIT ?",
+                tuple(args + [max(limit, 0)]),
+            )[::-1]
+        else:
+            rows = self._query(f"SELECT turn_id, data FROM turns WHERE {where} ORDER BY turn_id", tuple(args))
+
+        page_history = self._turns(rows)
+        if fields is not None:
+            page_history = {
+                k: dict({f: turn[f] for f in fields if f in turn}, version=_turn_version(turn))
+                for k, turn in page_history.items()
+            }
+
+        first_turn = int(rows[0][0]) if rows else None
+        has_older = False
+        if first_turn is not None and since_version is None:
+            has_older = bool(
+                self._query("SELECT 1 FROM turns WHERE session_id = ? AND turn_id < ? LIMIT 1", (session_id, first_turn))
+            )
+
+        return {
+            "session_id": session_id,
+            "title": header.get("title") or "",
+            "created_at": header.get("created_at") or "",
+            "updated_at": header.get("updated_at") or "",
+            "history_summary": header.get("history_summary") or "",
+            "history_summary_upto": header.get("history_summary_upto"),
+            "version": version,
+            "history": page_history,
+            "page": {
+                "turns_total": turns_total,
+                "first_turn": first_turn,
+                "last_turn": int(rows[-1][0]) if rows else None,
+                "has_older": has_older,
+                "since_version": since_version,
+                "reset": bool(reset),
+            },
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": self.name, "path": self.path, "saves": self.saves, "turns_written": self.turns_written}
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+# ====== импорт и выбор бэкенда ======
+
+def import_json_sessions(json_dir: str, target: SessionBackend, overwrite: bool = False) -> Dict[str, int]:
+    """Перенести сессии из папки с *_memmory*.json (+ журналы) в другой бэкенд."""
+    source = JsonSessionBackend(json_dir)
+    result = {"imported": 0, "skipped": 0, "failed": 0}
+
+    for info in source.list_sessions():
+        if not overwrite and target.exists(info.session_id):
+            result["skipped"] += 1
+            continue
+        try:
+            data = source.load(info.session_id)
+            if data is None:
+                result["failed"] += 1
+                continue
+            data.pop("file_path", None)
+            if overwrite:
+                target.delete(info.session_id)
+            target.save(data)
+            result["imported"] += 1
+        except Exception:
+            result["failed"] += 1
+    return result
+
+
+SQLITE_FILENAME = "sessions.sqlite3"
+BACKENDS = ("json", "sqlite")
+
+
+def open_backend(kind: str, base_dir: str) -> SessionBackend:
+    """
+    json — файлы в base_dir (как раньше); sqlite — base_dir/sessions.sqlite3.
+    База SQLite при первом открытии забирает себе JSON-сессии из той же папки.
+    """
+    kind = (kind or "json").strip().lower()
+    if kind == "json":
+        return JsonSessionBackend(base_dir)
+    if kind != "sqlite":
+        raise ValueError(f"Unknown session storage: {kind!r} (expected one of {', '.join(BACKENDS)})")
+
+    backend = SqliteSessionBackend(os.path.join(base_dir, SQLITE_FILENAME))
+    if backend.get_meta("json_imported_at") is None:
+        result = import_json_sessions(base_dir, backend)
+        backend.set_meta("json_imported_at", datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        backend.set_meta("json_import_result", json.dumps(result))
+    return backend
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Импорт JSON-сессий агента в SQLite")
+    parser.add_argument("--memory-dir", default=os.path.join(os.path.dirname(__file__), "memory"))
+    parser.add_argument("--db", default=None, help=f"файл базы (по умолчанию <memory-dir>/{SQLITE_FILENAME})")
+    parser.add_argument("--overwrite", action="store_true", help="перезаписать сессии, которые уже есть в базе")
+    args = parser.parse_args()
+
+    backend = SqliteSessionBackend(args.db or os.path.join(args.memory_dir, SQLITE_FILENAME))
+    try:
+        result = import_json_sessions(args.memory_dir, backend, overwrite=args.overwrite)
+        backend.set_meta("json_imported_at", datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        print(f"{backend.path}: {result}")
+    finally:
+        backend.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+import sys
+sys.dont_write_bytecode = True
+
+import re
+from typing import Any, Dict, List, Optional
+
+try:
+    import tiktoken  # опционально: pip install tiktoken (точный BPE; словари кэшируются локально)
+except ImportError:
+    tiktoken = None
+
+
+# --- окна контекста по префиксу имени модели (самый длинный подходящий префикс побеждает)
+CONTEXT_WINDOWS: Dict[str, int] = {
+    "gpt-3.5-turbo": 16_385,
+    "gpt-4": 8_192,
+    "gpt-4-turbo": 128_000,
+    "gpt-4o": 128_000,
+    "gpt-4.1": 1_047_576,
+    "gpt-5": 400_000,
+    "gpt-5-chat": 128_000,
+    "gpt-5.1-chat": 128_000,
+    "gpt-5.2-chat": 128_000,
+    "o1": 200_000,
+    "o3": 200_000,
+    "o4-mini": 200_000,
+}
+DEFAULT_CONTEXT_WINDOW = 128_000
+
+# --- словарь BPE по префиксу модели (для tiktoken)
+_ENCODINGS: Dict[str, str] = {
+    "gpt-3.5": "cl100k_base",
+    "gpt-4": "cl100k_base",
+    "gpt-4o": "o200k_base",
+    "gpt-4.1": "o200k_base",
+    "gpt-5": "o200k_base",
+    "o1": "o200k_base",
+    "o3": "o200k_base",
+    "o4": "o200k_base",
+}
+DEFAULT_ENCODING = "o200k_base"
+
+# служебные токены chat-формата: на каждое сообщение и на затравку ответа
+MESSAGE_OVERHEAD = 4
+REPLY_OVERHEAD = 3
+
+# --- оценщик без словаря: символов на токен по типу текста (o200k, замеры на нашем трафике)
+_CYR_RUN = re.compile(r"[А-Яа-яЁё]+")
+_LAT_RUN = re.compile(r"[A-Za-z0-9_]+")
+_SPACE_RUN = re.compile(r"\s+")
+CYR_CHARS_PER_TOKEN = 3.2
+LAT_CHARS_PER_TOKEN = 4.0
+OTHER_TOKENS_PER_CHAR = 0.6
+
+
+def _by_prefix(table: Dict[str, Any], model: str, default: Any) -> Any:
+    model = (model or "").strip().lower()
+    if "/" in model:
+        # openai/gpt-4o -> gpt-4o
+        model = model.rsplit("/", 1)[-1]
+    best = None
+    for prefix in table:
+        if model.startswith(prefix) and (best is None or len(prefix) > len(best)):
+            best = prefix
+    return table[best] if best is not None else default
+
+
+def context_window(model: str) -> int:
+    return int(_by_prefix(CONTEXT_WINDOWS, model, DEFAULT_CONTEXT_WINDOW))
+
+
+def estimate_tokens(text: str) -> int:
+    """Оценка без словаря: кириллица, латиница/цифры и прочие символы считаются по-разному."""
+    if not text:
+        return 0
+    cyr = sum(len(m) for m in _CYR_RUN.findall(text))
+    lat = sum(len(m) for m in _LAT_RUN.findall(text))
+    spaces = sum(len(m) for m in _SPACE_RUN.findall(text))
+    other = max(len(text) - cyr - lat - spaces, 0)
+    return max(1, round(cyr / CYR_CHARS_PER_TOKEN + lat / LAT_CHARS_PER_TOKEN + other * OTHER_TOKENS_PER_CHAR))
+
+
+class TokenCounter:
+    """
+    Локальный подсчёт токенов, без сети.
+
+    С tiktoken — точный BPE нужного словаря (o200k_base / cl100k_base). Без него
+    (или если словарь не скачан) — оценщик estimate_tokens, который подстраивается
+    под модель по настоящему usage.prompt_tokens (calibrate).
+
+    count() отдаёт «сырое» число: его можно хранить в сессии (вместе с counter_id),
+    поправочный коэффициент применяется при сравнении с бюджетом (scaled).
+    """
+
+    # сглаживание калибровки и допустимый разброс коэффициента
+    CALIBRATION_ALPHA = 0.2
+    CALIBRATION_RANGE = (0.5, 2.0)
+
+    def __init__(self, use_tiktoken: bool = True):
+        self.use_tiktoken = bool(use_tiktoken) and tiktoken is not None
+        self._encodings: Dict[str, Any] = {}
+        self.calibration: Dict[str, float] = {}
+        self.counted = 0
+
+    def _encoding(self, model: str) -> Optional[Any]:
+        if not self.use_tiktoken:
+            return None
+        name = _by_prefix(_ENCODINGS, model, DEFAULT_ENCODING)
+        if name not in self._encodings:
+            try:
+                self._encodings[name] = tiktoken.get_encoding(name)
+            except Exception:
+                # словаря нет в локальном кэше и нет сети — считаем оценщиком
+                self._encodings[name] = None
+        return self._encodings[name]
+
+    def counter_id(self, model: str) -> str:
+        """Чем посчитаны числа: при смене счётчика закэшированные в сессии значения пересчитываются."""
+        if self._encoding(model) is not None:
+            return "tiktoken:" + _by_prefix(_ENCODINGS, model, DEFAULT_ENCODING)
+        return "estimate:v1"
+
+    def count(self, text: str, model: str) -> int:
+        if not text:
+            return 0
+        self.counted += 1
+        enc = self._encoding(model)
+        if enc is not None:
+            return len(enc.encode(text, disallowed_special=()))
+        return estimate_tokens(text)
+
+    def count_messages(self, contents: List[int]) -> int:
+        """Промпт из сообщений с уже посчитанным содержимым: + служебные токены chat-формата."""
+        return sum(contents) + MESSAGE_OVERHEAD * len(contents) + REPLY_OVERHEAD
+
+    def factor(self, model: str) -> float:
+        if self._encoding(model) is not None:
+            return 1.0
+        return self.calibration.get((model or "").strip(), 1.0)
+
+    def scaled(self, raw_tokens: int, model: str) -> int:
+        return int(round(raw_tokens * self.factor(model)))
+
+    def calibrate(self, model: str, actual_tokens: int, raw_tokens: int) -> None:
+        """Подстроить оценщик под модель по фактическому usage (для tiktoken не нужно)."""
+        if actual_tokens <= 0 or raw_tokens <= 0 or self._encoding(model) is not None:
+            return
+        model = (model or "").strip()
+        lo, hi = self.CALIBRATION_RANGE
+        observed = min(max(actual_tokens / raw_tokens, lo), hi)
+        current = self.calibration.get(model)
+        if current is None:
+            self.calibration[model] = observed
+        else:
+            self.calibration[model] = current + self.CALIBRATION_ALPHA * (observed - current)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "tiktoken": self.use_tiktoken,
+            "encodings": {name: enc is not None for name, enc in self._encodings.items()},
+            "calibration": {m: round(f, 3) for m, f in self.calibration.items()},
+            "counted": self.counted,
+        }
@@ -1,10 +1,15 @@
+import asyncio
+import codecs
 import os
-import json
 import aiohttp
-import re
 import time
-from html import unescape
-from typing import AsyncIterator, List, Dict, Optional, Literal, Any
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, List, Dict, Optional, Literal, Any, Set
+
+from core.api.hedging import TTFTTracker, hedged_stream
+from core.api.model_caps import TOKEN_PARAMS, ModelCapsRegistry, rejected_param
+from core.api.pricing import PRICING_URL, PricingStore, PricingTableParser
+from core.api.sse_decoder import carries_usage, iter_sse, loads_json
 
 class GPTModel:
     def __init__(
@@ -13,6 +18,13 @@ class GPTModel:
         base_url: str = "https://openai.api.proxyapi.ru/v1",
         model: str = "gpt-5.2-chat-latest",
         timeout_sec: int = 60,
+        pooled: bool = True,
+        pool_limit: int = 32,
+        pool_limit_per_host: int = 8,
+        keepalive_sec: float = 30.0,
+        dns_ttl_sec: int = 300,
+        caps_path: Optional[str] = None,
+        pricing_path: Optional[str] = None,
     ):
         self.api_key = os.getenv(api_key_env)
         if not self.api_key:
@@ -28,125 +40,187 @@ class GPTModel:
         # Последняя статистика usage по стриму (токены и т.п.)
         self.last_usage: Optional[Dict[str, Any]] = None
 
+        # --- общий HTTP-клиент: keep-alive соединения, DNS-кэш, лимиты на хост.
+        #     pooled=False — старое поведение (новая сессия и TCP+TLS на каждый вызов).
+        self.pooled = pooled
+        self.pool_limit = int(pool_limit)
+        self.pool_limit_per_host = int(pool_limit_per_host)
+        self.keepalive_sec = float(keepalive_sec)
+        self.dns_ttl_sec = int(dns_ttl_sec)
+
+        self._session: Optional[aiohttp.ClientSession] = None
+
+        self.connections_created = 0
+        self.connections_reused = 0
+
+        # TTFT по модели|эндпоинту -> дедлайн для stream_chat_hedged
+        self.ttft_tracker = TTFTTracker()
+
+        # что принимает каждая модель (token-параметр, temperature, usage в стриме); caps_path — файл на диске
+        self.caps = ModelCapsRegistry(caps_path)
+
+        # тарифы: разобранная таблица на диске (pricing_path) + условные запросы к сайту
+        self.pricing_store = PricingStore(pricing_path)
+        self._pricing_cache: Optional[Dict[str, Dict[str, float]]] = None
+
+    def _trace_config(self) -> aiohttp.TraceConfig:
+        trace = aiohttp.TraceConfig()
+
+        async def _on_create(_session, _ctx, _params) -> None:
+            self.connections_created += 1
+
+        async def _on_reuse(_session, _ctx, _params) -> None:
+            self.connections_reused += 1
+
+        trace.on_connection_create_end.append(_on_create)
+        trace.on_connection_reuseconn.append(_on_reuse)
+        return trace
+
+    def _new_session(self, pooled: bool) -> aiohttp.ClientSession:
+        if pooled:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_limit,
+                limit_per_host=self.pool_limit_per_host,
+                keepalive_timeout=self.keepalive_sec,
+                ttl_dns_cache=self.dns_ttl_sec,
+                enable_cleanup_closed=True,
+            )
+        else:
+            connector = aiohttp.TCPConnector(force_close=True)
+
+        return aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.timeout_sec),
+            trace_configs=[self._trace_config()],
+        )
+
+    async def start(self) -> None:
+        """Открыть общий HTTP-клиент (вызывать внутри работающего цикла событий)."""
+        if self.pooled and (self._session is None or self._session.closed):
+            self._session = self._new_session(pooled=True)
+
+    async def close(self) -> None:
+        session, self._session = self._session, None
+        if session is not None and not session.closed:
+            await session.close()
+
+    @asynccontextmanager
+    async def _http(self) -> AsyncIterator[aiohttp.ClientSession]:
+        if self.pooled:
+            await self.start()
+            yield self._session
+            return
+
+        session = self._new_session(pooled=False)
+        try:
+            yield session
+        finally:
+            await session.close()
+
+    def pool_stats(self) -> Dict[str, Any]:
+        return {
+            "pooled": bool(self.pooled),
+            "connections_created": int(self.connections_created),
+            "connections_reused": int(self.connections_reused),
+        }
+
     async def get_model_price_rub_per_1m(self, model_id: str) -> Optional[Dict[str, float]]:
         table = await self.get_pricing_rub_per_1m()
         return table.get((model_id or "").strip())
     
-    async def get_pricing_rub_per_1m(self) -> Dict[str, Dict[str, float]]:
-        """
-        Парсит https://proxyapi.ru/pricing/list по таблице (<tr>/<td>) и возвращает:
-        {
-            "model_id": {"in": <руб за 1M>, "out": <руб за 1M>},
-            ...
-        }
+    def cached_pricing_rub_per_1m(self) -> Dict[str, Dict[str, float]]:
+        """Таблица тарифов с диска, без сети (пустая, если кэша ещё нет)."""
+        self.pricing_store.load()
+        return self.pricing_store.pricing
 
-        Загружается ОДИН раз и кэшируется до перезапуска приложения.
+    async def refresh_pricing_rub_per_1m(self) -> Dict[str, Any]:
         """
-        if not hasattr(self, "_pricing_cache"):
-            self._pricing_cache = None
+        Сверяет таблицу тарифов с сайтом условным запросом (ETag / Last-Modified).
 
-        if isinstance(self._pricing_cache, dict) and self._pricing_cache:
-            return self._pricing_cache
+        Возвращает {"changed": bool, "not_modified": bool, "pricing": {...}}.
+        304 — таблица та же, страница не скачивается и не парсится.
+        """
+        # другой воркер мог обновить кэш, пока мы ждали — берём его валидаторы
+        self.pricing_store.load()
 
-        url = "https://proxyapi.ru/pricing/list"
         headers = {
             "User-Agent": "Mozilla/5.0",
             "Accept": "text/html,application/xhtml+xml",
+            **self.pricing_store.validators(),
         }
 
-        timeout = aiohttp.ClientTimeout(total=self.timeout_sec)
+        async with self._http() as session:
+            async with session.get(PRICING_URL, headers=headers) as resp:
+                if resp.status == 304:
+                    self.pricing_store.update(None)
+                    self._pricing_cache = self.pricing_store.pricing
+                    return {"changed": False, "not_modified": True, "pricing": self._pricing_cache}
 
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            async with session.get(url, headers=headers) as resp:
                 if resp.status < 200 or resp.status >= 300:
                     body_text = await resp.text()
                     raise RuntimeError(f"ProxyAPI pricing fetch error: HTTP {resp.status}\n{body_text}")
 
-                html = await resp.text()
-
-        # Убираем script/style чтобы не мешали
-        html = re.sub(r"(?is)<script.*?>.*?</script>", " ", html)
-        html = re.sub(r"(?is)<style.*?>.*?</style>", " ", html)
-
-        def _strip_tags(s: str) -> str:
-            s = re.sub(r"(?is)<[^>]+>", " ", s)
-            s = unescape(s)
-            s = s.replace("\xa0", " ")
-            return re.sub(r"\s+", " ", s).strip()
-
-        def _parse_rub_number(s: str) -> Optional[float]:
-            """
-            Вытаскивает число перед ₽, поддерживает пробелы и запятую:
-            'Ввод: 129 ₽ за 1M токенов' -> 129.0
-            '2 577 ₽' -> 2577.0
-            '7 895,00 ₽' -> 7895.0
-            """
-            m = re.search(r"([0-9][0-9\s]*([.,][0-9]+)?)\s*₽", s)
-            if not m:
-                return None
-            num = m.group(1).replace(" ", "").replace("\xa0", "")
-            num = num.replace(",", ".")
-            try:
-                return float(num)
-            except Exception:
-                return None
-
-        pricing: Dict[str, Dict[str, float]] = {}
-
-        # Находим строки таблицы
-        rows = re.findall(r"(?is)<tr\b[^>]*>.*?</tr>", html)
-
-        for row_html in rows:
-            # Берём ячейки
-            tds = re.findall(r"(?is)<td\b[^>]*>.*?</td>", row_html)
-            if len(tds) < 3:
-                continue
-
-            cells = [_strip_tags(td) for td in tds]
-            if not cells:
-                continue
-
-            # По факту у ProxyAPI в строке обычно:
-            # 0: Provider (OpenAI)
-            # 1: Model (gpt-3.5-turbo)
-            # 2..: Тарифы (ввод/вывод) текстом
-            provider = cells[0]
-            model_id = cells[1] if len(cells) > 1 else ""
-
-            if not provider or not model_id:
-                continue
-
-            # Склеим остальные колонки (там и "Ввод", и "Вывод")
-            prices_blob = " | ".join(cells[2:])
-
-            # Ищем "Ввод:" и "Вывод:" (иногда они в разных td, но мы уже склеили)
-            in_price = None
-            out_price = None
-
-            m_in = re.search(r"Ввод\s*:\s*([^|]+)", prices_blob)
-            if m_in:
-                in_price = _parse_rub_number(m_in.group(1))
-
-            m_out = re.search(r"Вывод\s*:\s*([^|]+)", prices_blob)
-            if m_out:
-                out_price = _parse_rub_number(m_out.group(1))
-
-            # Иногда "Ввод" / "Вывод" могут быть без двоеточия, подстрахуемся:
-            if in_price is None:
-                m_in2 = re.search(r"Ввод\s*([0-9][0-9\s]*([.,][0-9]+)?)\s*₽", prices_blob)
-                if m_in2:
-                    in_price = _parse_rub_number(m_in2.group(0))
-
-            if out_price is None:
-                m_out2 = re.search(r"Вывод\s*([0-9][0-9\s]*([.,][0-9]+)?)\s*₽", prices_blob)
-                if m_out2:
-                    out_price = _parse_rub_number(m_out2.group(0))
-
-            if in_price is not None and out_price is not None:
-                pricing[model_id] = {"in": float(in_price), "out": float(out_price)}
+                etag = resp.headers.get("ETag")
+                last_modified = resp.headers.get("Last-Modified")
+
+                # разбираем по мере прихода: страницу целиком в память не собираем
+                parser = PricingTableParser()
+                decoder = codecs.getincrementaldecoder(resp.charset or "utf-8")(errors="replace")
+                async for chunk in resp.content.iter_chunked(64 * 1024):
+                    parser.feed(decoder.decode(chunk))
+                parser.feed(decoder.decode(b"", final=True))
+                parser.close()
 
+        pricing = parser.pricing
+        if not pricing:
+            # вёрстка поменялась или отдали заглушку — старую таблицу не затираем
+            raise RuntimeError("ProxyAPI pricing: в ответе не найдено ни одной модели")
+
+        changed = pricing != self.pricing_store.pricing
+        self.pricing_store.update(pricing, etag=etag, last_modified=last_modified)
         self._pricing_cache = pricing
-        return pricing
+        return {"changed": changed, "not_modified": False, "pricing": pricing}
+
+    async def get_pricing_rub_per_1m(self) -> Dict[str, Dict[str, float]]:
+        """
+        Таблица тарифов:
+        {
+            "model_id": {"in": <руб за 1M>, "out": <руб за 1M>},
+            ...
+        }
+
+        Память процесса -> кэш на диске -> сайт (только если кэша нет).
+        Освежать кэш — refresh_pricing_rub_per_1m.
+        """
+        if isinstance(self._pricing_cache, dict) and self._pricing_cache:
+            return self._pricing_cache
+
+        self._pricing_cache = self.cached_pricing_rub_per_1m()
+        if self._pricing_cache:
+            return self._pricing_cache
+
+        return (await self.refresh_pricing_rub_per_1m())["pricing"]
+
+    def stream_chat_hedged(
+        self,
+        call_stats: Optional[Dict[str, Any]] = None,
+        hedge_after_sec: Optional[float] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[str]:
+        """
+        stream_chat с хеджированием: если первый токен не пришёл за дедлайн
+        (percentile TTFT этой модели, см. TTFTTracker, или hedge_after_sec), уходит
+        второй такой же запрос; стримит тот, кто ответил первым, второй отменяется.
+        В call_stats["hedge"] — fired / winner / deadline_ms.
+        """
+        key = f"{kwargs.get('model') or self.model}|{kwargs.get('endpoint', 'chat')}"
+        deadline = hedge_after_sec if hedge_after_sec is not None else self.ttft_tracker.deadline(key)
+
+        def _open_leg(leg_stats: Dict[str, Any]) -> AsyncIterator[str]:
+            # TTFT ног не пишем: замер один на запрос, от его начала (см. hedged_stream)
+            return self.stream_chat(call_stats=leg_stats, record_ttft=False, **kwargs)
+
+        return hedged_stream(_open_leg, deadline, call_stats, on_ttft=lambda sec: self.ttft_tracker.add(key, sec))
 
     async def stream_chat(
         self,
@@ -158,9 +232,42 @@ class GPTModel:
         endpoint: str = "chat",
         temperature: Optional[float] = None,
         include_usage: bool = True,
+        call_stats: Optional[Dict[str, Any]] = None,
+        record_ttft: bool = True,
     ):
+        """
+        Стрим ответа модели.
+
+        call_stats (опционально) — словарь, который заполняется статистикой ИМЕННО этого вызова
+        (в отличие от self.last_usage, общего для всех параллельных запросов):
+        t_start, ttft_sec, usage, aborted.
+
+        record_ttft — добавить TTFT в окно дедлайна хеджирования. Выключают ноги хеджа
+        (за них пишет hedged_stream) и фоновые вызовы (суммаризация), чтобы они не
+        смешивались с TTFT ходов диалога.
+
+        Если генератор закрыли раньше конца (aclose / отмена задачи) — HTTP-ответ апстрима
+        закрывается сразу, не дочитывая стрим, чтобы не платить за ненужные токены.
+        """
         selected_model = model or self.model
 
+        if call_stats is None:
+            call_stats = {}
+        call_stats["t_start"] = time.perf_counter()
+        call_stats["ttft_sec"] = None
+        call_stats["usage"] = {}
+        call_stats["aborted"] = False
+
+        def _set_usage(usage: Dict[str, Any]) -> None:
+            self.last_usage = usage
+            call_stats["usage"] = usage
+
+        def _mark_first_token() -> None:
+            if call_stats.get("ttft_sec") is None:
+                call_stats["ttft_sec"] = time.perf_counter() - call_stats["t_start"]
+                if record_ttft:
+                    self.ttft_tracker.add(f"{selected_model}|{endpoint}", call_stats["ttft_sec"])
+
         headers = {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json",
@@ -180,108 +287,62 @@ class GPTModel:
 
         messages.append({"role": "user", "content": user_text})
 
-        timeout = aiohttp.ClientTimeout(total=self.timeout_sec)
         self.last_usage = {}
 
         async def _post_chat(payload: Dict[str, object]) -> AsyncIterator[str]:
             url = f"{self.base_url}/chat/completions"
 
-            async with aiohttp.ClientSession(timeout=timeout) as session:
+            async with self._http() as session:
                 async with session.post(url, headers=headers, json=payload) as resp:
 
                     if resp.status < 200 or resp.status >= 300:
                         body_text = await resp.text()
                         raise RuntimeError(f"ProxyAPI error: HTTP {resp.status}\n{body_text}")
 
-                    async for raw_line in resp.content:
-                        line = raw_line.decode("utf-8", errors="ignore").strip()
-                        if not line or not line.startswith("data:"):
-                            continue
-
-                        data = line[len("data:"):].strip()
-                        if data == "[DONE]":
-                            break
-
-                        try:
-                            obj = json.loads(data)
-                        except Exception:
-                            continue
-
-                        try:
-                            if include_usage and isinstance(obj.get("usage"), dict):
-                                self.last_usage = obj.get("usage")
-                        except Exception:
-                            pass
-
-                        try:
-                            choices = obj.get("choices")
-                            if isinstance(choices, list) and choices:
-                                delta = choices[0].get("delta")
-                                if isinstance(delta, dict):
-                                    content = delta.get("content")
-                                    if content:
-                                        yield content
-                        except Exception:
-                            continue
-
-        if endpoint == "chat":
-            # --- 1) Сначала пробуем max_completion_tokens (нужно для gpt-5.2-chat-latest)
-            payload_c: Dict[str, object] = {
-                "model": selected_model,
-                "messages": messages,
-                "stream": True,
-                "max_completion_tokens": int(max_tokens),
-            }
-
-            # usage в chat-стриме придёт только если это попросить явно
-            if include_usage:
-                payload_c["stream_options"] = {"include_usage": True}
-
-            if temperature is not None and float(temperature) != 1.0:
-                payload_c["temperature"] = float(temperature)
-
-            try:
-                async for chunk in _post_chat(payload_c):
-                    yield chunk
-                return
-
-            except RuntimeError as e:
-                # --- 2) Fallback: если модель/прокси не поддерживает max_completion_tokens, повторяем с max_tokens
-                msg = str(e)
-                if "max_completion_tokens" not in msg:
-                    raise
-
-                payload_c2: Dict[str, object] = {
-                    "model": selected_model,
-                    "messages": messages,
-                    "stream": True,
-                    "max_tokens": int(max_tokens),
-                }
-
-                if include_usage:
-                    payload_c2["stream_options"] = {"include_usage": True}
-
-                if temperature is not None and float(temperature) != 1.0:
-                    payload_c2["temperature"] = float(temperature)
-
-                async for chunk in _post_chat(payload_c2):
-                    yield chunk
-
-        else:
+                    try:
+                        async for event in iter_sse(resp.content):
+                            data = event.data.strip()
+                            if data == b"[DONE]":
+                                break
+
+                            # ни текста, ни usage (роль, finish_reason) — JSON не разбираем
+                            want_usage = include_usage and carries_usage(data)
+                            if b'"content"' not in data and not want_usage:
+                                continue
+
+                            try:
+                                obj = loads_json(data)
+                            except Exception:
+                                continue
+
+                            try:
+                                if want_usage and isinstance(obj.get("usage"), dict):
+                                    _set_usage(obj.get("usage"))
+                            except Exception:
+                                pass
+
+                            try:
+                                choices = obj.get("choices")
+                                if isinstance(choices, list) and choices:
+                                    delta = choices[0].get("delta")
+                                    if isinstance(delta, dict):
+                                        content = delta.get("content")
+                                        if content:
+                                            _mark_first_token()
+                                            yield content
+                            except Exception:
+                                continue
+                    except (asyncio.CancelledError, GeneratorExit):
+                        # клиент ушёл: рвём апстрим немедленно, не дочитывая стрим
+                        call_stats["aborted"] = True
+                        resp.close()
+                        raise
+
+        async def _post_responses(payload: Dict[str, object]) -> AsyncIterator[str]:
             url = f"{self.base_url}/responses"
 
-            payload_r: Dict[str, object] = {
-                "model": selected_model,
-                "input": messages,
-                "stream": True,
-                "max_output_tokens": int(max_tokens),
-            }
-
-            if temperature is not None and float(temperature) != 1.0:
-                payload_r["temperature"] = float(temperature)
-
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.post(url, headers=headers, json=payload_r) as resp:
+            async with self._http() as session:
+                async with session.post(url, headers=headers, json=payload) as resp:
 
                     if resp.status < 200 or resp.status >= 300:
                         body_text = await resp.text()
@@ -289,36 +350,139 @@ class GPTModel:
                             f"ProxyAPI error: HTTP {resp.status}\n{body_text}"
                         )
 
-                    async for raw_line in resp.content:
-                        line = raw_line.decode("utf-8", errors="ignore").strip()
-                        if not line or not line.startswith("data:"):
-                            continue
-
-                        data = line[len("data:"):].strip()
-                        if data == "[DONE]":
-                            break
-
-                        try:
-                            obj = json.loads(data)
-                        except Exception:
-                            continue
+                    try:
+                        async for event in iter_sse(resp.content):
+                            data = event.data.strip()
+                            if data == b"[DONE]":
+                                break
+
+                            # тип события виден в поле event: — служебные события (created, in_progress,
+                            # output_item.added, ...) не разбираем; без event: (прокси) — разбираем всё
+                            want_usage = include_usage and carries_usage(data)
+                            if event.event not in ("message", "response.output_text.delta") and not want_usage:
+                                continue
+
+                            try:
+                                obj = loads_json(data)
+                            except Exception:
+                                continue
+
+                            try:
+                                if include_usage and isinstance(obj.get("usage"), dict):
+                                    _set_usage(obj.get("usage"))
+
+                                resp_obj = obj.get("response")
+                                if include_usage and isinstance(resp_obj, dict) and isinstance(resp_obj.get("usage"), dict):
+                                    _set_usage(resp_obj.get("usage"))
+                            except Exception:
+                                pass
+
+                            try:
+                                if obj.get("type") == "response.output_text.delta":
+                                    delta_text = obj.get("delta")
+                                    if delta_text:
+                                        _mark_first_token()
+                                        yield delta_text
+                            except Exception:
+                                continue
+                    except (asyncio.CancelledError, GeneratorExit):
+                        # клиент ушёл: рвём апстрим немедленно, не дочитывая стрим
+                        call_stats["aborted"] = True
+                        resp.close()
+                        raise
+
+        # --- что модель принимает (реестр учится на ошибках 400 и помнит это между запусками)
+        caps = self.caps.get(selected_model)
+        token_param = caps["token_param"] or "max_completion_tokens"
+        send_temperature = temperature is not None and float(temperature) != 1.0 and caps["temperature"] is not False
+        send_usage = include_usage and caps["stream_usage"] is not False
+        call_stats["retries"] = 0
 
-                        try:
-                            if include_usage and isinstance(obj.get("usage"), dict):
-                                self.last_usage = obj.get("usage")
+        if endpoint == "chat":
+            adjusted: Set[str] = set()
+            while True:
+                payload_c: Dict[str, object] = {
+                    "model": selected_model,
+                    "messages": messages,
+                    "stream": True,
+                    token_param: int(max_tokens),
+                }
 
-                            resp_obj = obj.get("response")
-                            if include_usage and isinstance(resp_obj, dict) and isinstance(resp_obj.get("usage"), dict):
-                                self.last_usage = resp_obj.get("usage")
-                        except Exception:
-                            pass
+                # usage в chat-стриме придёт только если это попросить явно
+                if send_usage:
+                    payload_c["stream_options"] = {"include_usage": True}
+
+                if send_temperature:
+                    payload_c["temperature"] = float(temperature)
+
+                yielded = False
+                try:
+                    async for chunk in _post_chat(payload_c):
+                        yielded = True
+                        yield chunk
+
+                except RuntimeError as e:
+                    # апстрим отверг параметр до начала стрима: запоминаем и повторяем без него
+                    rejected = None if yielded else rejected_param(str(e))
+
+                    # каждый параметр меняем не больше одного раза за вызов: иначе при
+                    # ошибке, которую замена не лечит, max_tokens <-> max_completion_tokens по кругу
+                    if rejected in adjusted:
+                        raise
+
+                    if rejected == token_param:
+                        # что сработало, запишем после успешного ответа
+                        token_param = "max_tokens" if token_param == "max_completion_tokens" else "max_completion_tokens"
+                        adjusted.update(TOKEN_PARAMS)
+                    elif rejected == "temperature" and send_temperature:
+                        send_temperature = False
+                        self.caps.learn(selected_model, temperature=False)
+                    elif rejected in ("stream_options", "include_usage") and send_usage:
+                        send_usage = False
+                        self.caps.learn(selected_model, stream_usage=False)
+                    else:
+                        raise
+
+                    adjusted.add(rejected)
+                    call_stats["retries"] += 1
+                    continue
+
+                # прошло — фиксируем то, что сработало (на диск пишется только новое)
+                learned: Dict[str, Any] = {"token_param": token_param}
+                if send_temperature:
+                    learned["temperature"] = True
+                if send_usage:
+                    learned["stream_usage"] = True
+                self.caps.learn(selected_model, **learned)
+                return
 
-                        try:
-                            if obj.get("type") == "response.output_text.delta":
-                                delta_text = obj.get("delta")
-                                if delta_text:
-                                    yield delta_text
-                        except Exception:
-                            continue
+        else:
+            while True:
+                payload_r: Dict[str, object] = {
+                    "model": selected_model,
+                    "input": messages,
+                    "stream": True,
+                    "max_output_tokens": int(max_tokens),
+                }
 
+                if send_temperature:
+                    payload_r["temperature"] = float(temperature)
+
+                yielded = False
+                try:
+                    async for chunk in _post_responses(payload_r):
+                        yielded = True
+                        yield chunk
+
+                except RuntimeError as e:
+                    rejected = None if yielded else rejected_param(str(e))
+                    if rejected == "temperature" and send_temperature:
+                        send_temperature = False
+                        self.caps.learn(selected_model, temperature=False)
+                        call_stats["retries"] += 1
+                        continue
+                    raise
 
+                if send_temperature:
+                    self.caps.learn(selected_model, temperature=True)
+                return
@@ -0,0 +1,212 @@
+import asyncio
+import sys, time
+sys.dont_write_bytecode = True
+
+from collections import deque
+from typing import Any, AsyncIterator, Callable, Deque, Dict, List, Optional, Tuple
+
+
+class TTFTTracker:
+    """
+    Скользящее окно TTFT по ключу (модель|эндпоинт) -> дедлайн хеджирования.
+
+    Дедлайн = percentile последних window замеров, но не меньше floor_sec.
+    Пока замеров меньше min_samples — default_sec.
+    """
+
+    def __init__(
+        self,
+        percentile: float = 95.0,
+        window: int = 200,
+        min_samples: int = 20,
+        default_sec: float = 3.0,
+        floor_sec: float = 0.3,
+    ):
+        self.percentile = min(max(float(percentile), 1.0), 100.0)
+        self.window = max(int(window), 1)
+        self.min_samples = max(int(min_samples), 1)
+        self.default_sec = float(default_sec)
+        self.floor_sec = float(floor_sec)
+
+        self._samples: Dict[str, Deque[float]] = {}
+
+    def add(self, key: str, ttft_sec: float) -> None:
+        samples = self._samples.get(key)
+        if samples is None:
+            samples = deque(maxlen=self.window)
+            self._samples[key] = samples
+        samples.append(float(ttft_sec))
+
+    def deadline(self, key: str) -> float:
+        samples = self._samples.get(key)
+        if not samples or len(samples) < self.min_samples:
+            return self.default_sec
+
+        ordered = sorted(samples)
+        k = min(int(round(self.percentile / 100.0 * (len(ordered) - 1))), len(ordered) - 1)
+        return max(ordered[k], self.floor_sec)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            key: {"samples": len(samples), "deadline_ms": round(self.deadline(key) * 1000.0, 1)}
+            for key, samples in self._samples.items()
+        }
+
+
+# сколько чанков нога может прочитать впрок, пока потребитель занят
+_LEG_QUEUE = 16
+
+
+class _Leg:
+    __slots__ = ("name", "stats", "queue", "task", "first")
+
+    def __init__(self, name: str, stats: Dict[str, Any]):
+        self.name = name
+        self.stats = stats
+        # чанки из задачи ноги: ("chunk", текст) / ("end", None) / ("error", исключение)
+        self.queue: "asyncio.Queue[Tuple[str, Any]]" = asyncio.Queue(maxsize=_LEG_QUEUE)
+        self.task: Optional[asyncio.Task] = None
+        self.first: Optional[asyncio.Future] = None
+
+
+async def _pump(gen: AsyncIterator[str], queue: "asyncio.Queue[Tuple[str, Any]]") -> None:
+    """
+    Весь стрим ноги читается в ОДНОЙ задаче: HTTP-запрос и его ClientTimeout живут там же,
+    где читается ответ, поэтому зависший после первого чанка апстрим тоже упадёт по таймауту.
+    """
+    try:
+        async for chunk in gen:
+            await queue.put(("chunk", chunk))
+        await queue.put(("end", None))
+    except Exception as e:
+        await queue.put(("error", e))
+    finally:
+        try:
+            await gen.aclose()
+        except Exception:
+            pass
+
+
+async def _close_leg(leg: _Leg) -> None:
+    for fut in (leg.first, leg.task):
+        if fut is not None and not fut.done():
+            fut.cancel()
+    for fut in (leg.first, leg.task):
+        if fut is not None:
+            try:
+                await fut
+            except BaseException:
+                pass
+
+
+async def hedged_stream(
+    open_leg: Callable[[Dict[str, Any]], AsyncIterator[str]],
+    deadline_sec: float,
+    call_stats: Optional[Dict[str, Any]] = None,
+    on_ttft: Optional[Callable[[float], None]] = None,
+) -> AsyncIterator[str]:
+    """
+    Стрим с хеджированием первого токена.
+
+    open_leg(stats) открывает одинаковый запрос к апстриму. Если за deadline_sec первый чанк
+    не пришёл — открывается второй; дальше стримит тот, кто первым дал чанк (или закончил),
+    второй сразу отменяется (его HTTP-ответ закрывается — токены больше не идут).
+
+    call_stats получает статистику победителя (t_start/ttft_sec — от старта ПЕРВОГО запроса)
+    и "hedge": {fired, winner, deadline_ms, hedge_delay_ms}.
+
+    on_ttft(sec) — один замер на весь логический запрос, от его начала. Ноги сами TTFT
+    не пишут: иначе медленная (отменённая) нога в окно не попадает, и percentile
+    сползает вниз до floor_sec. Если запрос закрыли до первого токена — пишется
+    прошедшее время (TTFT не меньше его).
+    """
+    if call_stats is None:
+        call_stats = {}
+
+    t_start = time.perf_counter()
+    call_stats["t_start"] = t_start
+    call_stats["ttft_sec"] = None
+    legs: List[_Leg] = []
+    # замер записан или писать нечего (ошибка апстрима, пустой ответ)
+    ttft_done = False
+
+    def _record(sec: float) -> None:
+        nonlocal ttft_done
+        ttft_done = True
+        if on_ttft is not None:
+            on_ttft(sec)
+
+    def _open(name: str) -> _Leg:
+        leg = _Leg(name, {})
+        leg.task = asyncio.ensure_future(_pump(open_leg(leg.stats), leg.queue))
+        leg.first = asyncio.ensure_future(leg.queue.get())
+        legs.append(leg)
+        return leg
+
+    hedge_info: Dict[str, Any] = {
+        "fired": False,
+        "winner": "primary",
+        "deadline_ms": round(float(deadline_sec) * 1000.0, 1),
+        "hedge_delay_ms": None,
+    }
+    call_stats["hedge"] = hedge_info
+
+    winner: Optional[_Leg] = None
+    try:
+        primary = _open("primary")
+        done, _ = await asyncio.wait([primary.first], timeout=max(float(deadline_sec), 0.0))
+
+        if not done:
+            hedge_info["fired"] = True
+            hedge_info["hedge_delay_ms"] = round((time.perf_counter() - t_start) * 1000.0, 1)
+            _open("hedge")
+
+        errors: List[BaseException] = []
+        pending = list(legs)
+        while winner is None and pending:
+            done, _ = await asyncio.wait([leg.first for leg in pending], return_when=asyncio.FIRST_COMPLETED)
+            for leg in list(pending):
+                if leg.first not in done:
+                    continue
+                pending.remove(leg)
+                kind, value = leg.first.result()
+                if kind != "error":
+                    winner = leg
+                    break
+                errors.append(value)
+
+        if winner is None:
+            ttft_done = True
+            raise errors[0]
+
+        ttft_sec = time.perf_counter() - t_start
+        hedge_info["winner"] = winner.name
+        for leg in legs:
+            if leg is not winner:
+                await _close_leg(leg)
+
+        kind, value = winner.first.result()
+        if kind == "chunk":
+            call_stats["ttft_sec"] = ttft_sec
+            _record(ttft_sec)
+        else:
+            # пустой ответ: первого токена не было, замерять нечего
+            ttft_done = True
+
+        while kind == "chunk":
+            yield value
+            kind, value = await winner.queue.get()
+        if kind == "error":
+            raise value
+    finally:
+        if not ttft_done:
+            # закрыли до первого токена (клиент ушёл, отмена) — известна только нижняя граница
+            _record(time.perf_counter() - t_start)
+        for leg in legs:
+            await _close_leg(leg)
+        if winner is not None:
+            ttft = call_stats.get("ttft_sec")
+            call_stats.update(winner.stats)
+            call_stats["t_start"] = t_start
+            call_stats["ttft_sec"] = ttft
+            call_stats["hedge"] = hedge_info
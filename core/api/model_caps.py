@@ -0,0 +1,184 @@
+import sys
+sys.dont_write_bytecode = True
+
+import json
+import os
+import time
+from typing import Any, Dict, Optional
+
+
+# --- что известно о модели (None — ещё не выяснили, пробуем вариант по умолчанию)
+#     token_param   — "max_completion_tokens" | "max_tokens" (chat/completions)
+#     temperature   — можно ли передавать temperature != 1
+#     stream_usage  — принимает ли stream_options.include_usage
+CAP_FIELDS = ("token_param", "temperature", "stream_usage")
+
+TOKEN_PARAMS = ("max_completion_tokens", "max_tokens")
+
+# известное заранее (ProxyAPI запрещает temperature != 1 для gpt-5.2-chat-latest)
+KNOWN_CAPS: Dict[str, Dict[str, Any]] = {
+    "gpt-5.2-chat-latest": {"temperature": False},
+}
+
+
+# параметры, которые реестр умеет убрать или заменить (stream_options.include_usage -> stream_options)
+_KNOWN_PARAMS = ("max_completion_tokens", "stream_options", "include_usage", "temperature", "max_tokens")
+
+
+def _error_body(text: str) -> Dict[str, Any]:
+    """Объект "error" из JSON-тела ответа ("ProxyAPI error: HTTP 400\n{...}"), если он там есть."""
+    start = text.find("{")
+    if start < 0:
+        return {}
+    try:
+        body = json.loads(text[start:])
+    except ValueError:
+        return {}
+    error = body.get("error") if isinstance(body, dict) else None
+    return error if isinstance(error, dict) else {}
+
+
+def _known_param(value: Any) -> Optional[str]:
+    if not isinstance(value, str):
+        return None
+    for part in value.split("."):
+        if part in _KNOWN_PARAMS:
+            return "stream_options" if part == "include_usage" else part
+    return None
+
+
+def _quoted_param(text: str) -> Optional[str]:
+    for name in _KNOWN_PARAMS:
+        if f"'{name}'" in text or f'"{name}"' in text or f"`{name}`" in text:
+            return "stream_options" if name == "include_usage" else name
+    return None
+
+
+def rejected_param(error_text: str) -> Optional[str]:
+    """
+    Какой параметр апстрим не поддерживает для этой модели (по ошибке 4xx), или None.
+
+    Только ошибки "параметр не поддерживается" (code=unsupported_parameter,
+    "Unsupported parameter: 'max_tokens'"). Ошибки значения ("integer above maximum
+    value" и т.п.) сюда не попадают: без параметра или с другим именем запрос не
+    исправится. Исключение — temperature: модели с фиксированной температурой отвечают
+    "Unsupported value: 'temperature' does not support 0.7", и её надо просто не слать.
+    """
+    text = error_text or ""
+    if "HTTP 4" not in text:
+        return None
+
+    error = _error_body(text)
+    code = error.get("code")
+    param = _known_param(error.get("param"))
+    if code == "unsupported_parameter" and param:
+        return param
+    if code == "unsupported_value" and param == "temperature":
+        return param
+
+    if "Unsupported parameter" in text:
+        return _quoted_param(text)
+    if "Unsupported value" in text and _quoted_param(text) == "temperature":
+        return "temperature"
+    return None
+
+
+class ModelCapsRegistry:
+    """
+    Реестр возможностей моделей, который учится на ошибках апстрима и живёт на диске.
+
+    Файл общий для всех процессов агента (воркеры супервизора): перед чтением
+    проверяется mtime, запись — слиянием с тем, что на диске, через временный файл.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._caps: Dict[str, Dict[str, Any]] = {}
+        self._mtime: Optional[float] = None
+
+        self.learned = 0
+        self._reload()
+
+    def _read_file(self) -> Dict[str, Dict[str, Any]]:
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception:
+            return {}
+        if not isinstance(data, dict):
+            return {}
+        return {str(k): v for k, v in data.items() if isinstance(v, dict)}
+
+    def _reload(self) -> None:
+        if not self.path:
+            return
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime == self._mtime:
+            return
+        self._caps = self._read_file()
+        self._mtime = mtime
+
+    def _save(self) -> None:
+        if not self.path:
+            return
+
+        # сливаем с диском: другой воркер мог узнать что-то своё
+        merged = self._read_file()
+        for model, caps in self._caps.items():
+            merged.setdefault(model, {}).update(caps)
+        self._caps = merged
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(merged, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, self.path)
+
+        try:
+            self._mtime = os.path.getmtime(self.path)
+        except OSError:
+            self._mtime = None
+
+    def get(self, model: str) -> Dict[str, Any]:
+        """Возможности модели: выученное поверх известного заранее, неизвестное — None."""
+        self._reload()
+        model = (model or "").strip()
+        caps: Dict[str, Any] = {name: None for name in CAP_FIELDS}
+        caps.update(KNOWN_CAPS.get(model, {}))
+        caps.update({k: v for k, v in self._caps.get(model, {}).items() if k in CAP_FIELDS})
+        return caps
+
+    def learn(self, model: str, **caps: Any) -> bool:
+        """Запомнить возможности модели; True, если что-то изменилось (тогда пишем на диск)."""
+        self._reload()
+        model = (model or "").strip()
+        if not model:
+            return False
+
+        current = self._caps.setdefault(model, {})
+        changed = False
+        for name, value in caps.items():
+            if name not in CAP_FIELDS or current.get(name) == value:
+                continue
+            current[name] = value
+            changed = True
+
+        if changed:
+            current["updated_at"] = time.strftime("%Y-%m-%d %H:%M:%S")
+            self.learned += 1
+            try:
+                self._save()
+            except Exception:
+                # не смогли записать — знание останется в памяти процесса
+                pass
+        return changed
+
+    def all(self) -> Dict[str, Dict[str, Any]]:
+        self._reload()
+        models = set(KNOWN_CAPS) | set(self._caps)
+        return {model: self.get(model) for model in sorted(models)}
@@ -0,0 +1,307 @@
+import sys
+sys.dont_write_bytecode = True
+
+import json
+import os
+import re
+import time
+from html import unescape
+from typing import Any, Dict, List, Optional, Tuple
+
+PRICING_URL = "https://proxyapi.ru/pricing/list"
+
+
+_RUB_NUMBER = re.compile(r"([0-9][0-9\s]*([.,][0-9]+)?)\s*₽")
+_IN_LABELED = re.compile(r"Ввод\s*:\s*([^|]+)")
+_OUT_LABELED = re.compile(r"Вывод\s*:\s*([^|]+)")
+_IN_BARE = re.compile(r"Ввод\s*([0-9][0-9\s]*([.,][0-9]+)?)\s*₽")
+_OUT_BARE = re.compile(r"Вывод\s*([0-9][0-9\s]*([.,][0-9]+)?)\s*₽")
+
+# теги, которые меняют состояние разбора; остальные внутри ячейки считаются текстом
+_STRUCT_TAG = re.compile(r"<(/?)(tr|td|table|script|style)\b[^>]*>|<!--", re.I)
+_ANY_TAG = re.compile(r"<[^>]*>")
+_SKIP_UNTIL = {
+    "script": re.compile(r"</script\s*>", re.I),
+    "style": re.compile(r"</style\s*>", re.I),
+    "!--": re.compile(r"-->"),
+}
+
+
+def _parse_rub_number(s: str) -> Optional[float]:
+    """
+    Вытаскивает число перед ₽, поддерживает пробелы и запятую:
+    'Ввод: 129 ₽ за 1M токенов' -> 129.0
+    '2 577 ₽' -> 2577.0
+    '7 895,00 ₽' -> 7895.0
+    """
+    m = _RUB_NUMBER.search(s)
+    if not m:
+        return None
+    num = m.group(1).replace(" ", "").replace("\xa0", "")
+    num = num.replace(",", ".")
+    try:
+        return float(num)
+    except Exception:
+        return None
+
+
+def parse_pricing_row(cells: List[str]) -> Optional[Tuple[str, Dict[str, float]]]:
+    """
+    Строка таблицы (тексты <td>) -> (model_id, {"in", "out"}) или None.
+
+    По факту у ProxyAPI в строке обычно:
+    0: Provider (OpenAI)
+    1: Model (gpt-3.5-turbo)
+    2..: Тарифы (ввод/вывод) текстом
+    """
+    if len(cells) < 3:
+        return None
+
+    provider, model_id = cells[0], cells[1]
+    if not provider or not model_id:
+        return None
+
+    # Склеим остальные колонки (там и "Ввод", и "Вывод")
+    prices_blob = " | ".join(cells[2:])
+
+    in_price = None
+    out_price = None
+
+    m_in = _IN_LABELED.search(prices_blob)
+    if m_in:
+        in_price = _parse_rub_number(m_in.group(1))
+
+    m_out = _OUT_LABELED.search(prices_blob)
+    if m_out:
+        out_price = _parse_rub_number(m_out.group(1))
+
+    # Иногда "Ввод" / "Вывод" могут быть без двоеточия, подстрахуемся:
+    if in_price is None:
+        m_in2 = _IN_BARE.search(prices_blob)
+        if m_in2:
+            in_price = _parse_rub_number(m_in2.group(0))
+
+    if out_price is None:
+        m_out2 = _OUT_BARE.search(prices_blob)
+        if m_out2:
+            out_price = _parse_rub_number(m_out2.group(0))
+
+    if in_price is None or out_price is None:
+        return None
+    return model_id, {"in": float(in_price), "out": float(out_price)}
+
+
+class PricingTableParser:
+    """
+    Однопроходный потоковый разбор таблицы тарифов https://proxyapi.ru/pricing/list.
+
+    feed() можно звать кусками по мере прихода ответа: строки таблицы разбираются,
+    как только закрылся их <tr> (или начался следующий), копятся в pricing и
+    отдаются через pop_rows(). <script>/<style>/комментарии пропускаются по ходу.
+
+    Смотрим только на структурные теги (tr/td/table/script/style): всё остальное
+    внутри ячейки — текст, теги в нём заменяются пробелом (как раньше). Полный
+    токенайзер html.parser.HTMLParser на той же странице в ~3 раза медленнее старых
+    регекспов — он на чистом Python разбирает каждый тег и атрибут.
+    """
+
+    def __init__(self):
+        self.pricing: Dict[str, Dict[str, float]] = {}
+        self.rows_seen = 0
+
+        self._new_rows: List[Tuple[str, Dict[str, float]]] = []
+        self._buf = ""
+        self._skip_until: Optional[re.Pattern] = None
+        self._in_row = False
+        self._cells: List[str] = []
+        self._cell: Optional[List[str]] = None
+
+    def feed(self, data: str) -> None:
+        buf = self._buf + data if self._buf else data
+        pos, n = 0, len(buf)
+
+        while True:
+            if self._skip_until is not None:
+                m = self._skip_until.search(buf, pos)
+                if m is None:
+                    # закрывающий тег может прийти разорванным между кусками
+                    pos = max(pos, n - 16)
+                    break
+                pos = m.end()
+                self._skip_until = None
+                continue
+
+            m = _STRUCT_TAG.search(buf, pos)
+            if m is None:
+                # хвост может быть началом тега: оставляем его до следующего куска
+                lt = buf.rfind("<", pos)
+                end = lt if lt >= 0 else n
+                if self._cell is not None and end > pos:
+                    self._cell.append(buf[pos:end])
+                pos = end
+                break
+
+            if self._cell is not None and m.start() > pos:
+                self._cell.append(buf[pos:m.start()])
+            pos = m.end()
+
+            tag = m.group(2)
+            if tag is None:
+                self._skip_until = _SKIP_UNTIL["!--"]
+                continue
+
+            tag = tag.lower()
+            if m.group(1):
+                if tag == "td":
+                    self._end_cell()
+                elif tag in ("tr", "table"):
+                    self._end_row()
+            elif tag == "tr":
+                # </tr> в HTML необязателен: новая строка закрывает предыдущую
+                self._end_row()
+                self._in_row = True
+            elif tag == "td":
+                if self._in_row:
+                    self._end_cell()
+                    self._cell = []
+            elif tag in _SKIP_UNTIL:
+                self._skip_until = _SKIP_UNTIL[tag]
+
+        self._buf = buf[pos:]
+
+    def close(self) -> None:
+        if self._buf and self._skip_until is None and self._cell is not None:
+            self._cell.append(self._buf)
+        self._buf = ""
+        self._end_row()
+
+    def _end_cell(self) -> None:
+        if self._cell is None:
+            return
+        text = "".join(self._cell)
+        if "<" in text:
+            text = _ANY_TAG.sub(" ", text)
+        if "&" in text:
+            text = unescape(text)
+        # split() без аргументов режет и по \xa0
+        self._cells.append(" ".join(text.split()))
+        self._cell = None
+
+    def _end_row(self) -> None:
+        if not self._in_row:
+            return
+        self._end_cell()
+        row = parse_pricing_row(self._cells)
+        self.rows_seen += 1
+        if row is not None:
+            self.pricing[row[0]] = row[1]
+            self._new_rows.append(row)
+        self._in_row = False
+        self._cells = []
+
+    def pop_rows(self) -> List[Tuple[str, Dict[str, float]]]:
+        """Строки, разобранные с прошлого вызова."""
+        rows, self._new_rows = self._new_rows, []
+        return rows
+
+
+def parse_pricing_html(html: str) -> Dict[str, Dict[str, float]]:
+    """
+    Таблица тарифов со страницы целиком:
+    {
+        "model_id": {"in": <руб за 1M>, "out": <руб за 1M>},
+        ...
+    }
+    """
+    parser = PricingTableParser()
+    parser.feed(html)
+    parser.close()
+    return parser.pricing
+
+
+class PricingStore:
+    """
+    Разобранная таблица тарифов на диске — чтобы старт агента не ждал ProxyAPI.
+
+    Файл: {"pricing", "fetched_at", "checked_at", "etag", "last_modified"}.
+    fetched_at — когда таблица последний раз реально скачивалась (200),
+    checked_at — когда последний раз сверялись с сайтом (200 или 304).
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self.data: Dict[str, Any] = {}
+        self.load()
+
+    def load(self) -> Dict[str, Any]:
+        data: Dict[str, Any] = {}
+        if self.path and os.path.exists(self.path):
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+            except Exception:
+                data = {}
+        if not isinstance(data, dict) or not isinstance(data.get("pricing"), dict):
+            data = {}
+        self.data = data
+        return data
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, self.path)
+
+    @property
+    def pricing(self) -> Dict[str, Dict[str, float]]:
+        return self.data.get("pricing") or {}
+
+    def age_sec(self) -> Optional[float]:
+        """Сколько секунд назад сверялись с сайтом (None — ни разу)."""
+        checked_at = self.data.get("checked_at")
+        if not isinstance(checked_at, (int, float)):
+            return None
+        return max(time.time() - float(checked_at), 0.0)
+
+    def validators(self) -> Dict[str, str]:
+        """Заголовки условного запроса: сайт ответит 304, если таблица не менялась."""
+        if not self.pricing:
+            return {}
+        headers: Dict[str, str] = {}
+        if self.data.get("etag"):
+            headers["If-None-Match"] = str(self.data["etag"])
+        if self.data.get("last_modified"):
+            headers["If-Modified-Since"] = str(self.data["last_modified"])
+        return headers
+
+    def update(
+        self,
+        pricing: Optional[Dict[str, Dict[str, float]]],
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+    ) -> None:
+        """pricing=None — ответ 304: таблица та же, обновляется только checked_at."""
+        now = time.time()
+        if pricing is not None:
+            self.data = {
+                "pricing": pricing,
+                "fetched_at": now,
+                "etag": etag,
+                "last_modified": last_modified,
+            }
+        self.data["checked_at"] = now
+        self.save()
+
+    def stats(self) -> Dict[str, Any]:
+        age = self.age_sec()
+        return {
+            "models": len(self.pricing),
+            "fetched_at": self.data.get("fetched_at"),
+            "checked_at": self.data.get("checked_at"),
+            "age_sec": round(age, 1) if age is not None else None,
+            "etag": bool(self.data.get("etag")),
+            "last_modified": bool(self.data.get("last_modified")),
+        }
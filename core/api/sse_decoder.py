@@ -0,0 +1,142 @@
+import sys
+sys.dont_write_bytecode = True
+
+import json
+from typing import Any, AsyncIterator, List, Optional
+
+try:
+    import orjson  # опционально: pip install orjson
+except ImportError:
+    orjson = None
+
+
+def loads_json(data: bytes) -> Any:
+    """JSON из байтов: orjson, если установлен, иначе стандартный json (он тоже принимает bytes)."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def carries_usage(data: bytes) -> bool:
+    """
+    Есть ли в событии настоящий usage. С include_usage OpenAI шлёт "usage":null
+    в каждом чанке — такие события ради usage разбирать не нужно.
+    """
+    if b'"usage"' not in data:
+        return False
+    return b'"usage":null' not in data and b'"usage": null' not in data
+
+
+class SSEEvent:
+    __slots__ = ("event", "data", "id")
+
+    def __init__(self, event: str, data: bytes, id: Optional[str] = None):
+        self.event = event
+        self.data = data
+        self.id = id
+
+    def __repr__(self) -> str:
+        return f"SSEEvent(event={self.event!r}, data={self.data[:60]!r})"
+
+
+class SSEDecoder:
+    """
+    Инкрементальный разбор text/event-stream на уровне байтов.
+
+    - на вход — куски в том виде, как пришли из сети (границы событий и строк где угодно);
+    - строки заканчиваются на \\n, \\r\\n или \\r;
+    - несколько строк "data:" одного события склеиваются через \\n;
+    - событие отдаётся по пустой строке; строки-комментарии (":keepalive") только считаются;
+    - data отдаётся байтами: json умеет разбирать их без промежуточного decode().
+    """
+
+    def __init__(self):
+        self._buf = bytearray()
+        self._cr_pending = False
+
+        self._data: List[bytes] = []
+        self._event: Optional[str] = None
+        self._id: Optional[str] = None
+
+        self.events = 0
+        self.comments = 0
+
+    def feed(self, chunk: bytes) -> List[SSEEvent]:
+        if self._cr_pending and chunk[:1] == b"\n":
+            # \r\n разорвало между кусками: \r уже считан как конец строки
+            chunk = chunk[1:]
+        self._cr_pending = chunk[-1:] == b"\r"
+        if b"\r" in chunk:
+            chunk = chunk.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+
+        buf = self._buf
+        buf += chunk
+        if b"\n" not in chunk:
+            return []
+
+        # режем по строкам одним вызовом split, хвост без \n остаётся в буфере
+        *lines, tail = bytes(buf).split(b"\n")
+        buf[:] = tail
+
+        out: List[SSEEvent] = []
+        data = self._data
+        for line in lines:
+            # горячий путь: "data: ..." и пустая строка-разделитель
+            if line[:5] == b"data:":
+                data.append(line[6:] if line[5:6] == b" " else line[5:])
+            elif not line:
+                if data:
+                    self._emit(out)
+                    data = self._data
+                else:
+                    self._event = None
+            else:
+                self._field(line)
+        return out
+
+    def close(self) -> List[SSEEvent]:
+        """Конец потока: дослать последнее событие, даже если сервер не закрыл его пустой строкой."""
+        out: List[SSEEvent] = []
+        if self._buf:
+            out.extend(self.feed(b"\n"))
+        if self._data:
+            self._emit(out)
+        return out
+
+    def _emit(self, out: List[SSEEvent]) -> None:
+        data = self._data[0] if len(self._data) == 1 else b"\n".join(self._data)
+        out.append(SSEEvent(self._event or "message", data, self._id))
+        self.events += 1
+        self._data = []
+        self._event = None
+
+    def _field(self, line: bytes) -> None:
+        if line[:1] == b":":
+            self.comments += 1
+            return
+
+        colon = line.find(b":")
+        if colon < 0:
+            field, value = line, b""
+        else:
+            field, value = line[:colon], line[colon + 1:]
+            if value[:1] == b" ":
+                value = value[1:]
+
+        if field == b"data":
+            self._data.append(value)
+        elif field == b"event":
+            self._event = value.decode("utf-8", errors="replace")
+        elif field == b"id":
+            self._id = value.decode("utf-8", errors="replace")
+        # retry и неизвестные поля игнорируем
+
+
+async def iter_sse(content: Any, decoder: Optional[SSEDecoder] = None) -> AsyncIterator[SSEEvent]:
+    """События из aiohttp StreamReader (resp.content) по мере прихода кусков (iter_any)."""
+    decoder = decoder or SSEDecoder()
+    async for chunk in content.iter_any():
+        for event in decoder.feed(chunk):
+            yield event
+    for event in decoder.close():
+        yield event
@@ -13,6 +13,7 @@ from PySide6.QtGui import QTextCursor, QFont
 from ui.custom_objects.toggle_switch import ToggleSwitch
 from ui.tabs.base_tab import BaseTab
 from core.agent.agent_client import AgentClient
+from core.agent.protocol import ProtocolError
 from extra.Global import (set_editbox_height)
 
 class ChatTab(BaseTab):
@@ -20,6 +21,18 @@ class ChatTab(BaseTab):
     file_name = f"{os.path.splitext(os.path.basename(__file__))[0]}.json"
     CONFIG_FILE = os.path.join(path, file_name)
 
+    # подписка на события агента: heartbeat и пауза перед переподключением
+    AGENT_HEARTBEAT_SEC = 2.0
+    AGENT_RECONNECT_SEC = 2.0
+
+    # история сессии грузится страницами: сначала последние N turn'ов, старые — по кнопке
+    SESSION_PAGE_TURNS = 30
+    SESSION_TURN_FIELDS = [
+        "user_text", "assistant_text", "model", "endpoint", "temperature",
+        "r_prompt_total", "r_prev_prompt_total", "c_completion",
+        "current_message_tokens", "total_tokens_call", "cost_rub",
+    ]
+
     def __init__(self, logger):
         super().__init__(logger)
 
@@ -29,9 +42,20 @@ class ChatTab(BaseTab):
         self.current_session_id = str(uuid.uuid4())
         self.sessions_index = {}
 
+        # --- каталог сессий с сервера и его версия (list_sessions отдаёт дельты)
+        self.sessions_catalog = {}
+        self.sessions_catalog_version = None
+
+        # --- загруженная в UI часть сессии (для догрузки старых / изменённых turn'ов)
+        self.loaded_session_id = None
+        self.loaded_session_version = None
+        self.loaded_session_created_at = None
+        self.loaded_turns = {}
+        self.loaded_has_older = False
+
         # --- agent connection
         self.is_agent_connected = False
-        self.agent_watchdog_task = None
+        self.agent_events_task = None
 
         # --- Служебные
         self.is_generating = False
@@ -57,9 +81,9 @@ class ChatTab(BaseTab):
         self.model_selector.currentTextChanged.connect(self.on_model_changed)
         self.on_model_changed(self.model_selector.currentText())
 
-        # --- агент: первичная проверка + вечный watchdog переподключения
+        # --- агент: первичная проверка + подписка на события (heartbeat вместо ping-watchdog)
         asyncio.get_event_loop().create_task(self.preload_agent_status())
-        self.agent_watchdog_task = asyncio.get_event_loop().create_task(self.agent_connection_watchdog())
+        self.agent_events_task = asyncio.get_event_loop().create_task(self.agent_events_loop())
 
         # --- наполним список сессий хотя бы текущей, даже если агент оффлайн
         self.render_sessions_list_offline()
@@ -83,12 +107,18 @@ class ChatTab(BaseTab):
         self.clear_session_button.setFixedHeight(34)
         self.clear_session_button.clicked.connect(self.on_clear_session_clicked)
 
+        self.load_older_button = QPushButton("Старые сообщения")
+        self.load_older_button.setFixedHeight(34)
+        self.load_older_button.setEnabled(False)
+        self.load_older_button.clicked.connect(self.on_load_older_clicked)
+
         sessions_buttons = QWidget()
         sessions_buttons_layout = QHBoxLayout(sessions_buttons)
         sessions_buttons_layout.setContentsMargins(0, 0, 0, 0)
         sessions_buttons_layout.setSpacing(6)
         sessions_buttons_layout.addWidget(self.new_session_button)
         sessions_buttons_layout.addWidget(self.clear_session_button)
+        sessions_buttons_layout.addWidget(self.load_older_button)
 
         session_container = QWidget()
         session_container.setFixedWidth(400)
@@ -123,15 +153,15 @@ class ChatTab(BaseTab):
         self.temperature_input.setValue(1.0)
 
         # --- Новые параметры под temperature
-        self.char_limit_label = QLabel("Порог длины (символы):")
-        self.char_limit_input = QSpinBox()
-        self.char_limit_input.setRange(500, 200000)
-        self.char_limit_input.setSingleStep(500)
-        self.char_limit_input.setValue(12000)
-        self.char_limit_input.setFixedWidth(140)
-        self.char_limit_input.valueChanged.connect(self.on_threshold_changed)
-
-        self.keep_last_n_label = QLabel("N последних сообщений (оригинал):")
+        self.token_limit_label = QLabel("Порог контекста (токены):")
+        self.token_limit_input = QSpinBox()
+        self.token_limit_input.setRange(200, 1000000)
+        self.token_limit_input.setSingleStep(500)
+        self.token_limit_input.setValue(4000)
+        self.token_limit_input.setFixedWidth(140)
+        self.token_limit_input.valueChanged.connect(self.on_threshold_changed)
+
+        self.keep_last_n_label = QLabel("Не больше N последних сообщений:")
         self.keep_last_n_input = QSpinBox()
         self.keep_last_n_input.setRange(1, 200)
         self.keep_last_n_input.setSingleStep(1)
@@ -285,7 +315,7 @@ class ChatTab(BaseTab):
         params_layout.addWidget(_row(self.model_label, self.model_selector))
         params_layout.addWidget(_row(self.endpoint_label, self.endpoint_selector))
         params_layout.addWidget(_row(self.temperature_label, self.temperature_input))
-        params_layout.addWidget(_row(self.char_limit_label, self.char_limit_input))
+        params_layout.addWidget(_row(self.token_limit_label, self.token_limit_input))
         params_layout.addWidget(_row(self.keep_last_n_label, self.keep_last_n_input))
         params_layout.addStretch()
 
@@ -419,11 +449,11 @@ class ChatTab(BaseTab):
     
     def on_threshold_changed(self):
         try:
-            limit = int(self.char_limit_input.value())
+            limit = int(self.token_limit_input.value())
         except Exception:
             limit = 0
 
-        # длина new_message обновляется только при отправке,
+        # токены промпта обновляются только при отправке,
         # но порог/подписи должны обновляться сразу при изменении порога.
         # Поэтому тут меняем только знаменатель.
         try:
@@ -465,22 +495,72 @@ class ChatTab(BaseTab):
             self.is_agent_connected = False
             self.logger.warning(f"Не удалось подключиться к агенту: {e}")
 
-    async def agent_connection_watchdog(self):
+    async def agent_events_loop(self):
+        """
+        Подписка на события агента вместо ping каждые 5 с: heartbeat показывает, что агент жив,
+        изменения сессий приходят сразу. Старый агент без subscribe — проверка через ping.
+        """
         while True:
             try:
-                if not self.is_agent_connected:
-                    self.logger.warning("Агент OFFLINE: попытка подключиться к серверу...")
-                    ok = await self.agent.ping()
-
-                    if ok:
+                async for event in self.agent.subscribe(heartbeat_sec=self.AGENT_HEARTBEAT_SEC):
+                    if not self.is_agent_connected:
                         self.is_agent_connected = True
                         self.logger.success("Агент ONLINE: соединение восстановлено")
                         await self.refresh_sessions_list()
+                    self.on_agent_event(event)
+            except ProtocolError as e:
+                # битый или слишком большой кадр: это не "старый агент", а сломанный поток —
+                # сообщаем и подписываемся заново на новом соединении
+                self.logger.error(f"Ошибка протокола в событиях агента: {e or type(e).__name__}")
+            except RuntimeError:
+                ok = await self.agent.ping()
+                if ok and not self.is_agent_connected:
+                    self.logger.success("Агент ONLINE: соединение восстановлено")
+                    await self.refresh_sessions_list()
+                self.is_agent_connected = bool(ok)
+                await asyncio.sleep(5)
             except Exception as e:
+                if self.is_agent_connected:
+                    self.logger.warning(f"Агент OFFLINE: {e or type(e).__name__}")
                 self.is_agent_connected = False
-                self.logger.warning(f"Ошибка проверки агента: {e}")
 
-            await asyncio.sleep(5)
+            await asyncio.sleep(self.AGENT_RECONNECT_SEC)
+
+    def on_agent_event(self, event: dict):
+        name = event.get("event")
+
+        if name in ("session_created", "session_updated"):
+            entry = event.get("session") or {}
+            sid = (entry.get("session_id") or "").strip()
+            if sid:
+                self.sessions_catalog[sid] = entry
+                self.render_sessions_catalog()
+            return
+
+        if name == "session_deleted":
+            if self.sessions_catalog.pop(event.get("session_id"), None) is not None:
+                self.render_sessions_catalog()
+            return
+
+        if name == "summary_updated":
+            if event.get("session_id") == self.current_session_id:
+                try:
+                    self.summary_output_box.setPlainText(str(event.get("history_summary") or ""))
+                except Exception:
+                    pass
+            return
+
+        if name == "resync":
+            asyncio.get_event_loop().create_task(self.refresh_sessions_list())
+            return
+
+        if name == "server_draining":
+            self.logger.warning("Агент останавливается")
+            return
+
+        if name == "pricing_reloaded":
+            self.logger.info(f"Агент обновил тарифы: моделей {event.get('models')}")
+            return
 
     async def refresh_sessions_list(self):
         if not self.is_agent_connected:
@@ -488,12 +568,32 @@ class ChatTab(BaseTab):
             return
 
         try:
-            sessions = await self.agent.list_sessions()
+            delta = await self.agent.list_sessions_delta(self.sessions_catalog_version)
         except Exception as e:
             self.logger.warning(f"Не удалось получить список сессий: {e}")
             self.render_sessions_list_offline()
             return
 
+        # локальная копия каталога: сервер шлёт только изменения с прошлой версии
+        if delta["full"]:
+            self.sessions_catalog = {}
+        for sid in delta["deleted"]:
+            self.sessions_catalog.pop(sid, None)
+        for s in delta["sessions"]:
+            sid = (s.get("session_id") or "").strip()
+            if sid:
+                self.sessions_catalog[sid] = s
+        self.sessions_catalog_version = delta["version"]
+
+        self.render_sessions_catalog()
+
+    def render_sessions_catalog(self):
+        sessions = sorted(
+            self.sessions_catalog.values(),
+            key=lambda s: s.get("updated_at") or "",
+            reverse=True,
+        )
+
         self.sessions_list.blockSignals(True)
         self.sessions_list.clear()
         self.sessions_index = {}
@@ -545,8 +645,22 @@ class ChatTab(BaseTab):
             self.logger.warning("Агент OFFLINE: не могу загрузить историю")
             return
 
+        # та же сессия уже загружена -> догружаем только изменённые turn'ы
+        incremental = (session_id == self.loaded_session_id and self.loaded_session_version is not None)
+
         try:
-            session = await self.agent.get_session(session_id)
+            if incremental:
+                session = await self.agent.get_session(
+                    session_id,
+                    fields=self.SESSION_TURN_FIELDS,
+                    since_version=self.loaded_session_version,
+                )
+            else:
+                session = await self.agent.get_session(
+                    session_id,
+                    limit=self.SESSION_PAGE_TURNS,
+                    fields=self.SESSION_TURN_FIELDS,
+                )
         except Exception as e:
             self.logger.warning(f"Не удалось загрузить сессию {session_id}: {e}")
             return
@@ -554,19 +668,85 @@ class ChatTab(BaseTab):
         if not session:
             return
 
+        page = session.get("page") or {}
         history = session.get("history")
-        messages = session.get("messages")
-
         if not isinstance(history, dict):
             history = {}
 
-        if not isinstance(messages, list):
-            messages = []
+        # сессию пересоздали (reset) -> версия клиента недействительна, грузим с нуля
+        if incremental and (page.get("reset") or session.get("created_at") != self.loaded_session_created_at):
+            self.loaded_session_id = None
+            self.loaded_session_version = None
+            await self.load_session_to_ui(session_id)
+            return
+
+        if incremental:
+            self.loaded_turns.update(history)
+        else:
+            self.loaded_turns = dict(history)
+            self.loaded_has_older = bool(page.get("has_older"))
+
+        self.loaded_session_id = session_id
+        self.loaded_session_version = int(session.get("version") or 0)
+        self.loaded_session_created_at = session.get("created_at")
+
+        self.render_loaded_turns(str(session.get("history_summary") or ""), apply_last_turn=True)
+
+    async def load_older_turns(self):
+        session_id = self.loaded_session_id
+        if not session_id or not self.loaded_has_older:
+            return
+
+        if not self.is_agent_connected:
+            self.logger.warning("Агент OFFLINE: не могу загрузить историю")
+            return
+
+        try:
+            first_turn = min(int(k) for k in self.loaded_turns.keys())
+        except Exception:
+            return
+
+        from_turn = max(first_turn - self.SESSION_PAGE_TURNS, 1)
+
+        try:
+            session = await self.agent.get_session(
+                session_id,
+                from_turn=from_turn,
+                limit=first_turn - from_turn,
+                fields=self.SESSION_TURN_FIELDS,
+            )
+        except Exception as e:
+            self.logger.warning(f"Не удалось загрузить старые сообщения: {e}")
+            return
+
+        # пока ждали ответ, пользователь мог переключить сессию
+        if not session or session_id != self.loaded_session_id:
+            return
+
+        history = session.get("history")
+        if isinstance(history, dict):
+            self.loaded_turns.update(history)
+        self.loaded_has_older = bool((session.get("page") or {}).get("has_older"))
+
+        self.render_loaded_turns(str(session.get("history_summary") or ""), apply_last_turn=False)
+
+    def reset_loaded_session(self):
+        self.loaded_session_id = None
+        self.loaded_session_version = None
+        self.loaded_session_created_at = None
+        self.loaded_turns = {}
+        self.loaded_has_older = False
+        self.load_older_button.setEnabled(False)
+
+    def on_load_older_clicked(self):
+        asyncio.get_event_loop().create_task(self.load_older_turns())
+
+    def render_loaded_turns(self, history_summary: str, apply_last_turn: bool):
+        history = self.loaded_turns
 
         # --- подтягиваем history_summary
-        history_summary = session.get("history_summary") or ""
         try:
-            self.summary_output_box.setPlainText(str(history_summary))
+            self.summary_output_box.setPlainText(history_summary)
         except Exception:
             pass
 
@@ -577,80 +757,70 @@ class ChatTab(BaseTab):
         except Exception:
             pass
 
+        self.load_older_button.setEnabled(self.loaded_has_older)
+        if self.loaded_has_older:
+            self.output_editbox.append("… (есть более старые сообщения)")
+            self.output_editbox.append("")
+
         last_turn = None
 
-        if history:
-            try:
-                keys = sorted(history.keys(), key=lambda x: int(x))
-            except Exception:
-                keys = list(history.keys())
+        try:
+            keys = sorted(history.keys(), key=lambda x: int(x))
+        except Exception:
+            keys = list(history.keys())
 
-            for k in keys:
-                turn = history.get(k) or {}
-                user_text = turn.get("user_text") or ""
-                assistant_text = turn.get("assistant_text") or ""
+        for k in keys:
+            turn = history.get(k) or {}
+            user_text = turn.get("user_text") or ""
+            assistant_text = turn.get("assistant_text") or ""
 
-                if user_text:
-                    self.output_editbox.append("Ты: " + user_text)
-                    self.output_editbox.append("")
-                if assistant_text:
-                    self.output_editbox.append("GPT: " + assistant_text)
-                    self.output_editbox.append("")
+            if user_text:
+                self.output_editbox.append("Ты: " + user_text)
+                self.output_editbox.append("")
+            if assistant_text:
+                self.output_editbox.append("GPT: " + assistant_text)
+                self.output_editbox.append("")
 
-                model = (turn.get("model") or "N/A").strip()
-                endpoint = (turn.get("endpoint") or "N/A").strip()
+            model = (turn.get("model") or "N/A").strip()
+            endpoint = (turn.get("endpoint") or "N/A").strip()
 
-                r = int(turn.get("r_prompt_total") or 0)
-                r_prev = int(turn.get("r_prev_prompt_total") or 0)
-                c = int(turn.get("c_completion") or 0)
+            r = int(turn.get("r_prompt_total") or 0)
+            r_prev = int(turn.get("r_prev_prompt_total") or 0)
+            c = int(turn.get("c_completion") or 0)
 
-                current_message_tokens = int(turn.get("current_message_tokens") or 0)
-                total_tokens_call = int(turn.get("total_tokens_call") or 0)
+            current_message_tokens = int(turn.get("current_message_tokens") or 0)
+            total_tokens_call = int(turn.get("total_tokens_call") or 0)
 
-                cost_rub = turn.get("cost_rub", None)
-                cost_str = f"{float(cost_rub):.4f} ₽" if isinstance(cost_rub, (int, float)) else "N/A"
+            cost_rub = turn.get("cost_rub", None)
+            cost_str = f"{float(cost_rub):.4f} ₽" if isinstance(cost_rub, (int, float)) else "N/A"
 
-                temp_val = turn.get("temperature", None)
-                if isinstance(temp_val, (int, float)):
-                    temp_str = f"{float(temp_val)}"
-                else:
-                    temp_str = "locked(1.0)"
-
-                result_line = (
-                    f"Model={model} | "
-                    f"Endpoint={endpoint} | "
-                    f"Temp={temp_str} | "
-                    f"TTFT=N/A | "
-                    f"Total=N/A | "
-                    f"prompt(r)={r} (prev_r={r_prev}) | "
-                    f"completion(c)={c} | "
-                    f"current_message_tokens={current_message_tokens} | "
-                    f"total_tokens={total_tokens_call} | "
-                    f"Cost={cost_str}"
-                )
+            temp_val = turn.get("temperature", None)
+            if isinstance(temp_val, (int, float)):
+                temp_str = f"{float(temp_val)}"
+            else:
+                temp_str = "locked(1.0)"
 
-                try:
-                    self.metrics_box.append(result_line)
-                except Exception:
-                    pass
+            result_line = (
+                f"Model={model} | "
+                f"Endpoint={endpoint} | "
+                f"Temp={temp_str} | "
+                f"TTFT=N/A | "
+                f"Total=N/A | "
+                f"prompt(r)={r} (prev_r={r_prev}) | "
+                f"completion(c)={c} | "
+                f"current_message_tokens={current_message_tokens} | "
+                f"total_tokens={total_tokens_call} | "
+                f"Cost={cost_str}"
+            )
 
-                last_turn = turn
-        else:
-            for m in messages:
-                role = (m.get("role") or "").strip()
-                content = m.get("content") or ""
-
-                if role == "user":
-                    prefix = "Ты: "
-                elif role == "assistant":
-                    prefix = "GPT: "
-                else:
-                    prefix = f"{role}: " if role else ""
+            try:
+                self.metrics_box.append(result_line)
+            except Exception:
+                pass
 
-                self.output_editbox.append(prefix + content)
-                self.output_editbox.append("")
+            last_turn = turn
 
-        if isinstance(last_turn, dict):
+        if apply_last_turn and isinstance(last_turn, dict):
             last_model = (last_turn.get("model") or "").strip()
             last_endpoint = (last_turn.get("endpoint") or "").strip()
             last_temp = last_turn.get("temperature", None)
@@ -680,6 +850,7 @@ class ChatTab(BaseTab):
             return
 
         self.current_session_id = str(uuid.uuid4())
+        self.reset_loaded_session()
 
         try:
             self.output_editbox.clear()
@@ -707,6 +878,7 @@ class ChatTab(BaseTab):
             try:
                 ok = await self.agent.reset_session(self.current_session_id)
                 if ok:
+                    self.reset_loaded_session()
                     try:
                         self.output_editbox.clear()
                         self.output_editbox_with_condition.clear()
@@ -727,17 +899,38 @@ class ChatTab(BaseTab):
     def on_model_changed(self, model_text: str):
         model_text = (model_text or "").strip()
 
-        # Для openai/gpt-5.2-chat-latest ProxyAPI запрещает temperature != 1
-        is_gpt52_locked = (model_text == "gpt-5.2-chat-latest")
+        # Пока агент не ответил: для openai/gpt-5.2-chat-latest ProxyAPI запрещает temperature != 1
+        locked = (model_text == "gpt-5.2-chat-latest")
+        self.set_temperature_locked(model_text, locked)
+        if not locked:
+            self.logger.info(f"Выбрана модель {model_text}. temperature доступна.")
+
+        # --- агент помнит, что модель реально принимает (учится на ошибках апстрима)
+        asyncio.get_event_loop().create_task(self.apply_model_caps(model_text))
 
-        self.temperature_input.setEnabled(not is_gpt52_locked)
+    def set_temperature_locked(self, model_text: str, locked: bool):
+        was_enabled = self.temperature_input.isEnabled()
+        self.temperature_input.setEnabled(not locked)
 
-        if is_gpt52_locked:
+        if locked:
             # Сбрасываем в 1.0, чтобы было очевидно, что иначе нельзя
             self.temperature_input.setValue(1.0)
-            self.logger.warning("Для gpt-5.2-chat-latest temperature заблокирована ProxyAPI. Установлено 1.0.")
-        else:
-            self.logger.info(f"Выбрана модель {model_text}. temperature доступна.")
+            if was_enabled:
+                self.logger.warning(f"Для {model_text} temperature заблокирована ProxyAPI. Установлено 1.0.")
+
+    async def apply_model_caps(self, model_text: str):
+        try:
+            caps = await self.agent.model_caps(model_text)
+        except Exception:
+            return
+
+        # пока ждали ответ, могли выбрать другую модель
+        if (self.model_selector.currentText() or "").strip() != model_text:
+            return
+
+        temperature = caps.get("temperature")
+        if temperature is not None:
+            self.set_temperature_locked(model_text, not temperature)
 
     def set_enable_clear_button_plain(self):
         state = True if self.output_editbox.toPlainText().strip() != "" else False
@@ -842,9 +1035,9 @@ class ChatTab(BaseTab):
 
         # --- параметры “сжатия”
         try:
-            char_limit = int(self.char_limit_input.value())
+            token_limit = int(self.token_limit_input.value())
         except Exception:
-            char_limit = 12000
+            token_limit = 4000
 
         try:
             keep_last_n = int(self.keep_last_n_input.value())
@@ -862,7 +1055,7 @@ class ChatTab(BaseTab):
                 target_output,
                 use_conditions,
                 max_tokens,
-                char_limit,
+                token_limit,
                 keep_last_n,
                 summary_model,
                 summary_endpoint,
@@ -875,7 +1068,7 @@ class ChatTab(BaseTab):
         target_output: QTextEdit,
         use_conditions: bool,
         max_tokens: int,
-        char_limit: int,
+        token_limit: int,
         keep_last_n: int,
         summary_model: str,
         summary_endpoint: str,
@@ -925,10 +1118,11 @@ class ChatTab(BaseTab):
                 max_tokens=max_tokens,
                 temperature=selected_temperature,
                 session_id=self.current_session_id,
-                char_limit=int(char_limit),
+                token_limit=int(token_limit),
                 keep_last_n=int(keep_last_n),
                 summary_model=str(summary_model or "").strip(),
                 summary_endpoint=str(summary_endpoint or "chat"),
+                on_queued=lambda pos: self.logger.warning(f"Агент занят: запрос в очереди, позиция {pos}"),
             )
 
             async for chunk in gen:
@@ -1004,15 +1198,25 @@ class ChatTab(BaseTab):
 
             cost_rub = getattr(self.agent, "last_cost_rub", None)
 
+            # агент мог узнать о модели новое (например, что temperature не принимается)
+            asyncio.get_event_loop().create_task(self.apply_model_caps(selected_model))
+
             ms = getattr(self.agent, "last_message_stats", None) or {}
             r_prev_prompt_total = int(ms.get("r_prev_prompt_total") or 0)
             current_message_tokens = int(ms.get("current_message_tokens") or 0)
 
             # --- NEW stats
             new_message_len = int(ms.get("new_message_len") or 0)
-            char_limit_used = int(ms.get("char_limit") or char_limit)
-            history_summarized = bool(ms.get("history_summarized") or False)
+            prompt_tokens_est = int(ms.get("prompt_tokens_est") or 0)
+            token_limit_used = int(ms.get("token_limit") or token_limit)
+            tail_messages = int(ms.get("tail_messages") or 0)
+            tail_truncated = int(ms.get("tail_truncated") or 0)
+            summary_scheduled = bool(ms.get("summary_scheduled") or False)
+            summary_pending = bool(ms.get("summary_pending") or False)
             history_summary_text = ms.get("history_summary") or ""
+            chunks_upstream = int(ms.get("chunks_upstream") or 0)
+            chunks_sent = int(ms.get("chunks_sent") or 0)
+            queue_wait_ms = float(ms.get("queue_wait_ms") or 0.0)
 
             # --- обновим summary в UI если агент прислал
             if isinstance(history_summary_text, str) and history_summary_text.strip():
@@ -1024,15 +1228,18 @@ class ChatTab(BaseTab):
             # --- обновим лейблы длины (ТОЛЬКО при отправке — как ты и хотел)
             try:
                 if use_conditions:
-                    self.condition_len_label.setText(f"{new_message_len} / {char_limit_used}")
+                    self.condition_len_label.setText(f"{prompt_tokens_est} / {token_limit_used}")
                 else:
-                    self.plain_len_label.setText(f"{new_message_len} / {char_limit_used}")
+                    self.plain_len_label.setText(f"{prompt_tokens_est} / {token_limit_used}")
             except Exception:
                 pass
 
             ttft_str = f"{ttft_sec:.3f}s" if isinstance(ttft_sec, (int, float)) else "N/A"
             temp_str = f"{selected_temperature}" if selected_temperature is not None else "locked(1.0)"
             cost_str = f"{cost_rub:.4f} ₽" if isinstance(cost_rub, (int, float)) else "N/A"
+            # выжимку агент готовит в фоне; придёт событием summary_updated
+            summary_str = "pending" if summary_pending else ("scheduled" if summary_scheduled else "-")
+            tail_str = f"{tail_messages}" + (f" (truncated={tail_truncated})" if tail_truncated else "")
 
             result_line = (
                 f"Model={selected_model} | "
@@ -1045,8 +1252,11 @@ class ChatTab(BaseTab):
                 f"current_message_tokens={current_message_tokens} | "
                 f"total_tokens={total_tokens_call} | "
                 f"Cost={cost_str} | "
-                f"new_message_len={new_message_len}/{char_limit_used} | "
-                f"summarized={history_summarized}"
+                f"prompt_tokens~{prompt_tokens_est}/{token_limit_used} ({new_message_len} chars) | "
+                f"tail={tail_str} | "
+                f"summary={summary_str} | "
+                f"chunks={chunks_sent}/{chunks_upstream} | "
+                f"queue_wait={queue_wait_ms:.0f}ms"
             )
 
             if error_text: